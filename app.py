@@ -306,7 +306,7 @@ def main():
     # 如果同时启用了API，则使用挂载到fastAPI的方式启动
     if app_config.also_enable_api == True:
         import uvicorn
-        from pure_api import tts, character_list, set_tts_synthesizer
+        from pure_api import tts, character_list, queue_status, cache_status, model_status, set_tts_synthesizer
         from fastapi import FastAPI
         from fastapi.middleware.cors import CORSMiddleware
         from gpt_sovits.src.api_utils import get_gradio_frp, get_localhost_ipv4_address
@@ -315,6 +315,9 @@ def main():
         fastapi_app:FastAPI = app.app
         fastapi_app.add_api_route("/tts", tts, methods=["POST", "GET"])
         fastapi_app.add_api_route("/character_list", character_list, methods=["GET"])
+        fastapi_app.add_api_route("/queue_status", queue_status, methods=["GET"])
+        fastapi_app.add_api_route("/cache_status", cache_status, methods=["GET"])
+        fastapi_app.add_api_route("/model_status", model_status, methods=["GET"])
         
         fastapi_app.add_middleware(
                 CORSMiddleware,
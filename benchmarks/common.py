@@ -0,0 +1,52 @@
+# Helpers shared by the benchmarks (and tests/): models randomly initialized from the default configs,
+# configs/s1longer.yaml for the T2S model and configs/s2.json for VITS. The latency doesn't depend on the weights.
+import json
+import os
+
+import torch
+import yaml
+
+from gpt_sovits.GPT_SoVITS.AR.models.t2s_model import Text2SemanticDecoder
+from gpt_sovits.GPT_SoVITS.module.models import SynthesizerTrn
+
+config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpt_sovits", "GPT_SoVITS", "configs")
+
+
+def build_t2s_model(n_layer:int, device:str="cpu", weights_path:str=None)->Text2SemanticDecoder:
+    '''
+    A Text2SemanticDecoder with `n_layer` layers (seeded with 0), or loaded from a trained checkpoint.
+    '''
+    if weights_path is not None:
+        from gpt_sovits.GPT_SoVITS.AR.models.t2s_lightning_module import Text2SemanticLightningModule
+        dict_s1 = torch.load(weights_path, map_location=device)
+        t2s_model = Text2SemanticLightningModule(dict_s1["config"], "****", is_train=False)
+        t2s_model.load_state_dict(dict_s1["weight"])
+        return t2s_model.model.eval().to(device)
+    with open(os.path.join(config_dir, "s1longer.yaml"), "r") as f:
+        config = yaml.safe_load(f)
+    config["model"]["n_layer"] = n_layer
+    torch.manual_seed(0)
+    return Text2SemanticDecoder(config).eval().to(device)
+
+
+def build_vits_model(device:str="cpu", prepare:bool=True):
+    '''
+    Returns (SynthesizerTrn seeded with 0, the config of configs/s2.json),
+        with `prepare_for_inference` applied unless `prepare` is False.
+    '''
+    with open(os.path.join(config_dir, "s2.json"), "r") as f:
+        hps = json.load(f)
+    torch.manual_seed(0)
+    model = SynthesizerTrn(
+        hps["data"]["filter_length"] // 2 + 1,
+        hps["train"]["segment_size"] // hps["data"]["hop_length"],
+        n_speakers=hps["data"]["n_speakers"],
+        **hps["model"]
+    )
+    model = model.eval().to(device)
+    return (model.prepare_for_inference() if prepare else model), hps
+
+
+def synchronize(device:str):
+    if "cuda" in device:
+        torch.cuda.synchronize()
@@ -0,0 +1,79 @@
+# Per-token latency of the T2S decode loop: the eager loop (jit-scripted blocks, eager embedding and sampling)
+# vs the compiled decode step (`Text2SemanticDecoder.set_compiled_decode`, torch.compile with kv cache buckets).
+#
+#   python benchmarks/t2s_compile.py --n_layer 24 --steps 500 --bucket_size 128 256
+#
+# The first run of every bucket size compiles the graphs and is reported separately.
+# "same tokens" compares greedy decodes of both loops (the sampled ones use different random streams),
+# the compiled kernels round differently, so near-ties of the randomly initialized decoder can flip.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+import contextlib
+import io
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_t2s_model, synchronize
+
+
+@torch.no_grad()
+def decode(model, inputs, steps:int, device:str, top_k:int=15):
+    '''
+    Returns (the latency (s) of the whole decode, y).
+    '''
+    x, bert, prompt = inputs
+    torch.manual_seed(0)
+    synchronize(device)
+    t0 = perf_counter()
+    # 不打印每次decode的日志
+    with contextlib.redirect_stdout(io.StringIO()):
+        y, _ = model.infer_panel_with_flash_attn_only(x, torch.LongTensor([x.shape[1]]), prompt, bert,
+                                                      top_k=top_k, early_stop_num=steps)
+    synchronize(device)
+    return perf_counter() - t0, y
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=24)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--bucket_size", type=int, nargs="+", default=[128, 256])
+    parser.add_argument("--backend", type=str, default="inductor")
+    parser.add_argument("--text_len", type=int, default=60)
+    parser.add_argument("--prompt_len", type=int, default=150)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model = build_t2s_model(args.n_layer, args.device)
+    g = torch.Generator().manual_seed(0)
+    inputs = (torch.randint(0, 512, (1, args.text_len), generator=g).to(args.device),
+              torch.randn(1, 1024, args.text_len, generator=g).to(args.device),
+              torch.randint(0, 1024, (1, args.prompt_len), generator=g).to(args.device))
+
+    # 预热
+    decode(model, inputs, 10, args.device)
+    eager, y = min(decode(model, inputs, args.steps, args.device) for _ in range(args.repeat))
+    y_eager = decode(model, inputs, args.steps, args.device, top_k=1)[1]
+    num_tokens = y.shape[1] - args.prompt_len
+    print(f"{model.num_layers} layers, {num_tokens} tokens, {torch.get_num_threads()} threads, device {args.device}")
+    print(f"{'':>18} {'first run s':>12} {'ms/token':>9} {'speedup':>8} {'same tokens':>12}")
+    print(f"{'eager':>18} {'':>12} {eager/num_tokens*1000:>9.2f}")
+    for bucket_size in args.bucket_size:
+        model.set_compiled_decode(True, bucket_size, args.backend)
+        first, _ = decode(model, inputs, args.steps, args.device)
+        compiled, _ = min(decode(model, inputs, args.steps, args.device) for _ in range(args.repeat))
+        y = decode(model, inputs, args.steps, args.device, top_k=1)[1]
+        n = min(y.shape[1], y_eager.shape[1])
+        same = (y[0, args.prompt_len:n] == y_eager[0, args.prompt_len:n]).float().mean().item()
+        print(f"{'compiled, bucket ' + str(bucket_size):>18} {first:>12.1f} {compiled/num_tokens*1000:>9.2f} "
+              f"{eager/compiled:>7.2f}x {same:>12.2%}")
+        model.set_compiled_decode(False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Throughput of the T2S scheduler under Poisson arrivals:
+# static batching (a batch runs until its longest segment is done) vs iteration-level batching.
+#
+#   python benchmarks/t2s_continuous_batching.py --n_layer 4 --rates 2 5 10
+#
+# The decoder is randomly initialized, segment lengths are controlled by early_stop_num.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+import queue
+import threading
+from concurrent.futures import Future
+from time import perf_counter, sleep
+
+import numpy as np
+import torch
+
+from benchmarks.common import build_t2s_model
+from gpt_sovits.GPT_SoVITS.TTS_infer_pack.BatchScheduler import T2SBatchScheduler
+
+
+def make_request(rng:np.random.Generator, device:str):
+    phones_len = int(rng.integers(10, 60))
+    # 长尾分布的目标长度
+    num_tokens = int(min(rng.pareto(1.5) * 30 + 20, 400))
+    phones = torch.from_numpy(rng.integers(0, 512, phones_len)).long().to(device)
+    bert = torch.from_numpy(rng.standard_normal((1024, phones_len)).astype(np.float32)).to(device)
+    return phones, bert, num_tokens
+
+
+class StaticBatchScheduler:
+    '''
+    Baseline: collect waiting segments and decode them to completion as one batch.
+    '''
+    def __init__(self, max_batch_size:int, max_wait_ms:float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, t2s_model, phones, bert_features, prompt, **sampling)->Future:
+        future = Future()
+        self._queue.put((t2s_model, phones, bert_features, prompt, sampling, future))
+        return future
+
+    def close(self):
+        self._closed = True
+        self._thread.join(timeout=1)
+
+    @torch.no_grad()
+    def _loop(self):
+        while not self._closed:
+            try:
+                jobs = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = perf_counter() + self.max_wait
+            while len(jobs) < self.max_batch_size and perf_counter() < deadline:
+                try:
+                    jobs.append(self._queue.get(timeout=max(deadline - perf_counter(), 0)))
+                except queue.Empty:
+                    break
+            t2s_model, _, _, prompt, sampling, _ = jobs[0]
+            sampling = dict(sampling)
+            sampling["early_stop_num"] = max(job[4]["early_stop_num"] for job in jobs)
+            phones = [job[1] for job in jobs]
+            phones_len = torch.LongTensor([item.shape[-1] for item in phones]).to(phones[0].device)
+            pred_semantic_list, idx_list = t2s_model.infer_panel_batch_infer_with_flash_attn(
+                phones, phones_len, prompt.expand(len(jobs), -1), [job[2] for job in jobs],
+                max_len=int(phones_len.max()), **sampling)
+            for job, pred_semantic, idx in zip(jobs, pred_semantic_list, idx_list):
+                # 静态batch里短句也要等最长的句子, 结果按各自的长度截断
+                n = job[4]["early_stop_num"]
+                job[5].set_result((pred_semantic[:n+1], min(idx, n)))
+
+
+def run(scheduler, t2s_model, prompt, rate:float, num_requests:int, seed:int, device:str):
+    rng = np.random.default_rng(seed)
+    requests = [make_request(rng, device) for _ in range(num_requests)]
+    gaps = rng.exponential(1 / rate, num_requests)
+    latencies = [0.0]*num_requests
+    tokens = [0]*num_requests
+    threads = []
+
+    def client(i, phones, bert, num_tokens):
+        t0 = perf_counter()
+        future = scheduler.submit(t2s_model, phones, bert, prompt,
+                                  top_k=5, top_p=1, temperature=1, repetition_penalty=1.35,
+                                  early_stop_num=num_tokens)
+        _, idx = future.result()
+        latencies[i] = perf_counter() - t0
+        tokens[i] = idx
+
+    start = perf_counter()
+    for i, (phones, bert, num_tokens) in enumerate(requests):
+        sleep(gaps[i])
+        thread = threading.Thread(target=client, args=(i, phones, bert, num_tokens))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    return sum(tokens) / elapsed, float(np.mean(latencies)), float(np.percentile(latencies, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=4)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--rates", type=float, nargs="+", default=[2, 5, 10])
+    parser.add_argument("--num_requests", type=int, default=40)
+    parser.add_argument("--max_batch_size", type=int, default=20)
+    parser.add_argument("--max_wait_ms", type=float, default=10)
+    args = parser.parse_args()
+
+    t2s_model = build_t2s_model(args.n_layer, args.device)
+    prompt = torch.randint(0, 1024, (50,)).to(args.device)
+
+    print(f"{'rate(req/s)':>12} {'scheduler':>12} {'tokens/s':>10} {'mean lat(s)':>12} {'p95 lat(s)':>11}")
+    for rate in args.rates:
+        for name, scheduler_cls in (("static", StaticBatchScheduler), ("iteration", T2SBatchScheduler)):
+            scheduler = scheduler_cls(args.max_batch_size, args.max_wait_ms)
+            throughput, mean_latency, p95_latency = run(scheduler, t2s_model, prompt, rate, args.num_requests, 0, args.device)
+            scheduler.close()
+            print(f"{rate:>12.1f} {name:>12} {throughput:>10.1f} {mean_latency:>12.2f} {p95_latency:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Per-token latency of the batched T2S decode loop for different intervals of the EOS check:
+# sync_every=1 reads the EOS flags back to the host after every token, larger values only every N tokens.
+#
+#   python benchmarks/t2s_decode_sync.py --n_layer 2 --sync_every 1 8 32
+#
+# The decoder is randomly initialized and decodes `--steps` tokens, a small n_layer makes the loop overhead visible.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_t2s_model, synchronize
+
+
+@torch.no_grad()
+def decode(model, bsz:int, steps:int, sync_every:int, device:str)->float:
+    '''
+    Returns the latency (s) of the whole decode.
+    '''
+    g = torch.Generator().manual_seed(0)
+    x = [torch.randint(0, 512, (40,), generator=g).to(device) for _ in range(bsz)]
+    bert = [torch.randn(1024, 40, generator=g).to(device) for _ in range(bsz)]
+    prompt = torch.randint(0, 1024, (100,), generator=g).to(device)
+    x_lens = torch.LongTensor([40]*bsz).to(device)
+    synchronize(device)
+    t0 = perf_counter()
+    model.infer_panel_batch_infer_with_flash_attn(x, x_lens, prompt.expand(bsz, -1), bert,
+                                                  top_k=15, early_stop_num=steps - 1, sync_every=sync_every)
+    synchronize(device)
+    return perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=2)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--bsz", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--sync_every", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model = build_t2s_model(args.n_layer, args.device)
+    # 预热
+    decode(model, 1, 20, 1, args.device)
+
+    print(f"{'bsz':>4} {'sync_every':>11} {'ms/token':>9}")
+    for bsz in args.bsz:
+        for sync_every in args.sync_every:
+            latency = min(decode(model, bsz, args.steps, sync_every, args.device) for _ in range(args.repeat))
+            print(f"{bsz:>4} {sync_every:>11} {latency / args.steps * 1000:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# CPU inference of the T2S decoder with int8 dynamic quantization (`Text2SemanticDecoder.set_dynamic_quantization`)
+# against fp32: latency of the prefill and of a decode step, and the drift of the predicted tokens.
+#
+#   python benchmarks/t2s_int8.py --weights GPT_weights/xxx.ckpt --threads 4
+#
+# The drift is measured with teacher forcing: both models read the same token history (decoded by the fp32 model)
+# and the top-1 agreement of the next token is reported, with the max abs difference of the log-probabilities.
+# Without --weights the decoder is randomly initialized, its nearly flat logits make the agreement pessimistic.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+import contextlib
+import io
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_t2s_model
+
+
+@torch.no_grad()
+def decode(model, inputs, steps:int):
+    '''
+    Returns (the latency (s) of the prefill and the first token, the latency (s) per decoded token, y).
+    '''
+    x, bert, prompt = inputs
+    kwargs = dict(top_k=1, early_stop_num=steps)
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = perf_counter()
+        model.infer_panel_with_flash_attn_only(x, torch.LongTensor([x.shape[1]]), prompt, bert, top_k=1, early_stop_num=1)
+        t1 = perf_counter()
+        y, _ = model.infer_panel_with_flash_attn_only(x, torch.LongTensor([x.shape[1]]), prompt, bert, **kwargs)
+        t2 = perf_counter()
+    num_tokens = y.shape[1] - prompt.shape[1]
+    return t1 - t0, ((t2 - t1) - (t1 - t0)) / max(num_tokens - 1, 1), y
+
+
+@torch.no_grad()
+def next_token_logprobs(model, inputs, y):
+    '''
+    The log-probabilities of the next token at every position of y, (y_len, vocab_size).
+    '''
+    x, bert, _ = inputs
+    xy_dec = model.prefill_batch([x[0]], torch.LongTensor([x.shape[1]]), y, [bert[0]], x.shape[1])[0]
+    return torch.log_softmax(model.predict_logits(xy_dec[0, x.shape[1]:]), dim=-1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", type=str, default=None, help="a trained GPT checkpoint (.ckpt), random weights if not set")
+    parser.add_argument("--n_layer", type=int, default=24)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--text_len", type=int, default=60)
+    parser.add_argument("--prompt_len", type=int, default=150)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = build_t2s_model(args.n_layer, "cpu", args.weights).float()
+    g = torch.Generator().manual_seed(0)
+    inputs = (torch.randint(0, 512, (1, args.text_len), generator=g),
+              torch.randn(1, 1024, args.text_len, generator=g),
+              torch.randint(0, 1024, (1, args.prompt_len), generator=g))
+
+    results = {}
+    for name, quantized in (("fp32", False), ("int8", True)):
+        model.set_dynamic_quantization(quantized)
+        # 预热
+        decode(model, inputs, 10)
+        results[name] = decode(model, inputs, args.steps)
+    y = results["fp32"][2]
+
+    model.set_dynamic_quantization(False)
+    ref = next_token_logprobs(model, inputs, y)
+    model.set_dynamic_quantization(True)
+    out = next_token_logprobs(model, inputs, y)
+    model.set_dynamic_quantization(False)
+    agreement = (ref.argmax(dim=-1) == out.argmax(dim=-1)).float().mean().item()
+    generated = (ref[args.prompt_len - 1:-1].argmax(dim=-1) == out[args.prompt_len - 1:-1].argmax(dim=-1)).float().mean().item()
+    max_diff = (ref - out).abs().max().item()
+
+    print(f"{model.num_layers} layers, {torch.get_num_threads()} threads, {y.shape[1] - args.prompt_len} tokens")
+    print(f"{'':>5} {'prefill ms':>11} {'ms/token':>9}")
+    for name in ("fp32", "int8"):
+        prefill, per_token, _ = results[name]
+        print(f"{name:>5} {prefill*1000:>11.1f} {per_token*1000:>9.2f}")
+    print(f"speedup: prefill {results['fp32'][0]/results['int8'][0]:.2f}x, decode {results['fp32'][1]/results['int8'][1]:.2f}x")
+    print(f"top-1 agreement (teacher forced): {agreement:.2%} of all positions, {generated:.2%} of the generated tokens, "
+          f"max |logprob diff| {max_diff:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Per-token decode latency of the T2S transformer:
+# concatenating the kv cache at every step vs the preallocated T2SKVCache written in place.
+#
+#   python benchmarks/t2s_kv_cache.py --n_layer 24 --steps 100 500 1500
+#
+# The decoder is randomly initialized, only the cost of a step matters here.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_t2s_model, synchronize
+from gpt_sovits.GPT_SoVITS.AR.models.t2s_model import T2SKVCache
+
+
+@torch.no_grad()
+def decode(model, prompt_len:int, bsz:int, steps:int, static:bool, device:str):
+    '''
+    Returns the latency (s) of every decode step.
+    '''
+    transformer = model.t2s_transformer
+    x = torch.randn(bsz, prompt_len, model.model_dim, device=device)
+    attn_mask = torch.zeros(bsz, model.num_head, prompt_len, prompt_len, device=device)
+    _, k_cache, v_cache = transformer.process_prompt(x, attn_mask, None)
+    padding_mask = torch.zeros(bsz, prompt_len, dtype=torch.bool, device=device)
+    kv_cache = T2SKVCache(k_cache, v_cache, padding_mask, capacity=prompt_len + steps) if static else None
+
+    latencies = []
+    xy_pos = torch.randn(bsz, 1, model.model_dim, device=device)
+    for _ in range(steps):
+        synchronize(device)
+        t0 = perf_counter()
+        if static:
+            xy_dec = kv_cache.decode(transformer, xy_pos)
+        else:
+            padding_mask = torch.nn.functional.pad(padding_mask, (0, 1), value=False)
+            xy_dec, k_cache, v_cache = transformer.decode_next_token(xy_pos, k_cache, v_cache, padding_mask.view(bsz, 1, 1, -1))
+        synchronize(device)
+        latencies.append(perf_counter() - t0)
+        xy_pos = xy_dec[:, -1:]
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=24)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--bsz", type=int, default=1)
+    parser.add_argument("--prompt_len", type=int, default=200)
+    parser.add_argument("--steps", type=int, nargs="+", default=[100, 500, 1500])
+    parser.add_argument("--window", type=int, default=20, help="the latency at step N is averaged over the last `window` steps")
+    args = parser.parse_args()
+
+    model = build_t2s_model(args.n_layer, args.device)
+    # 预热
+    decode(model, args.prompt_len, args.bsz, 10, True, args.device)
+    decode(model, args.prompt_len, args.bsz, 10, False, args.device)
+
+    print(f"{'steps':>6} {'kv cache':>10} {'mean ms/token':>14} {'ms/token at N':>14}")
+    for steps in args.steps:
+        for name, static in (("concat", False), ("static", True)):
+            latencies = decode(model, args.prompt_len, args.bsz, steps, static, args.device)
+            mean_ms = sum(latencies) / len(latencies) * 1000
+            last = latencies[-args.window:]
+            last_ms = sum(last) / len(last) * 1000
+            print(f"{steps:>6} {name:>10} {mean_ms:>14.2f} {last_ms:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
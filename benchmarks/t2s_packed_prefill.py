@@ -0,0 +1,69 @@
+# Latency of the batched T2S prefill: padded to the longest text vs packed without padding.
+#
+#   python benchmarks/t2s_packed_prefill.py --n_layer 24 --bsz 8 20
+#
+# Text lengths follow a skewed (long tail) distribution, so most of a padded batch is padding.
+# The decoder is randomly initialized.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+import torch
+
+from benchmarks.common import build_t2s_model, synchronize
+
+
+def make_batch(rng:np.random.Generator, bsz:int, min_len:int, max_len:int, prompt_len:int, device:str):
+    # 长尾分布: 大部分是短句, 少数长句
+    lens = np.minimum(rng.pareto(1.2, bsz) * min_len + min_len, max_len).astype(int).tolist()
+    x = [torch.from_numpy(rng.integers(0, 512, l)).long().to(device) for l in lens]
+    bert = [torch.from_numpy(rng.standard_normal((1024, l)).astype(np.float32)).to(device) for l in lens]
+    prompt = torch.from_numpy(rng.integers(0, 1024, prompt_len)).long().to(device)
+    return x, torch.LongTensor(lens).to(device), prompt.expand(bsz, -1), bert
+
+
+@torch.no_grad()
+def prefill(model, batch, packed:bool, device:str)->float:
+    x, x_lens, prompts, bert = batch
+    synchronize(device)
+    t0 = perf_counter()
+    model.prefill_batch(x, x_lens, prompts, bert, int(x_lens.max()), packed=packed)
+    synchronize(device)
+    return perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=24)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--bsz", type=int, nargs="+", default=[8, 20])
+    parser.add_argument("--min_len", type=int, default=15)
+    parser.add_argument("--max_len", type=int, default=300)
+    parser.add_argument("--prompt_len", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model = build_t2s_model(args.n_layer, args.device)
+    rng = np.random.default_rng(0)
+    # 预热
+    warmup = make_batch(rng, 2, args.min_len, args.max_len, args.prompt_len, args.device)
+    prefill(model, warmup, False, args.device)
+    prefill(model, warmup, True, args.device)
+
+    print(f"{'bsz':>4} {'real tokens':>12} {'padded tokens':>14} {'padded ms':>10} {'packed ms':>10}")
+    for bsz in args.bsz:
+        batch = make_batch(rng, bsz, args.min_len, args.max_len, args.prompt_len, args.device)
+        x_lens = batch[1]
+        real = int(x_lens.sum()) + bsz * args.prompt_len
+        padded = bsz * (int(x_lens.max()) + args.prompt_len)
+        padded_ms = min(prefill(model, batch, False, args.device) for _ in range(args.repeat)) * 1000
+        packed_ms = min(prefill(model, batch, True, args.device) for _ in range(args.repeat)) * 1000
+        print(f"{bsz:>4} {real:>12} {padded:>14} {padded_ms:>10.1f} {packed_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
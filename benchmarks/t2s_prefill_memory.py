@@ -0,0 +1,92 @@
+# Peak memory and latency of the batched T2S prefill (`Text2SemanticDecoder.prefill_batch`).
+#
+#   python benchmarks/t2s_prefill_memory.py --n_layer 24 --bsz 1 8 20
+#
+# On CUDA the peak is torch.cuda.max_memory_allocated, on CPU it is the peak RSS of the process (Linux only),
+# both relative to the memory in use before the prefill. The decoder is randomly initialized.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_t2s_model
+
+
+def rss_peak_kb()->int:
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def rss_kb()->int:
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def reset_peak(device:str)->int:
+    if "cuda" in device:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        return torch.cuda.memory_allocated()
+    # 重置进程的峰值RSS
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return rss_kb() * 1024
+
+
+def read_peak(device:str)->int:
+    if "cuda" in device:
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated()
+    return rss_peak_kb() * 1024
+
+
+@torch.no_grad()
+def prefill(model, bsz:int, min_len:int, max_len:int, prompt_len:int, device:str):
+    g = torch.Generator().manual_seed(0)
+    lens = torch.randint(min_len, max_len + 1, (bsz,), generator=g).tolist()
+    x = [torch.randint(0, 512, (l,), generator=g).to(device) for l in lens]
+    bert = [torch.randn(1024, l, generator=g).to(device) for l in lens]
+    prompt = torch.randint(0, 1024, (prompt_len,), generator=g).to(device)
+    x_lens = torch.LongTensor(lens).to(device)
+
+    base = reset_peak(device)
+    t0 = perf_counter()
+    outputs = model.prefill_batch(x, x_lens, prompt.expand(bsz, -1), bert, max(lens))
+    peak = read_peak(device)
+    latency = perf_counter() - t0
+    del outputs
+    return (peak - base) / 1024 / 1024, latency
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=24)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--bsz", type=int, nargs="+", default=[1, 8, 20])
+    parser.add_argument("--min_len", type=int, default=30)
+    parser.add_argument("--max_len", type=int, default=150)
+    parser.add_argument("--prompt_len", type=int, default=150)
+    args = parser.parse_args()
+
+    model = build_t2s_model(args.n_layer, args.device)
+    # 预热
+    prefill(model, 2, args.min_len, args.max_len, args.prompt_len, args.device)
+
+    print(f"{'bsz':>4} {'peak MB':>9} {'latency ms':>11}")
+    for bsz in args.bsz:
+        peak_mb, latency = prefill(model, bsz, args.min_len, args.max_len, args.prompt_len, args.device)
+        print(f"{bsz:>4} {peak_mb:>9.1f} {latency*1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Cost of the sampling step over a long utterance:
+# repetition penalty gathered over the whole token history vs the incremental token presence bitmap.
+#
+#   python benchmarks/t2s_repetition_penalty.py --steps 1500 --bsz 1 8
+#
+# Only the sampler runs here, the logits are random, so the numbers are the overhead added to every decode step.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import synchronize
+from gpt_sovits.GPT_SoVITS.AR.models.utils import sample, token_presence
+
+
+@torch.no_grad()
+def decode(bsz:int, prompt_len:int, steps:int, vocab_size:int, incremental:bool, device:str):
+    '''
+    Returns the latency (s) of the sampling part of every decode step.
+    '''
+    torch.manual_seed(0)
+    y = torch.randint(0, vocab_size, (bsz, prompt_len), device=device)
+    presence = token_presence(y, vocab_size) if incremental else None
+    all_logits = torch.randn(16, bsz, vocab_size, device=device)
+    latencies = []
+    for idx in range(steps):
+        logits = all_logits[idx % 16].clone()
+        synchronize(device)
+        t0 = perf_counter()
+        if incremental:
+            samples = sample(logits, top_k=15, top_p=1, temperature=1, repetition_penalty=1.35, presence=presence)[0]
+            presence.scatter_(1, samples.long(), True)
+        else:
+            samples = sample(logits, y, top_k=15, top_p=1, temperature=1, repetition_penalty=1.35)[0]
+        synchronize(device)
+        latencies.append(perf_counter() - t0)
+        y = torch.concat([y, samples], dim=1)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--bsz", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--prompt_len", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=1500)
+    parser.add_argument("--vocab_size", type=int, default=1025)
+    parser.add_argument("--window", type=int, default=50, help="the latency at the end is averaged over the last `window` steps")
+    args = parser.parse_args()
+
+    # 预热
+    decode(1, args.prompt_len, 20, args.vocab_size, True, args.device)
+    decode(1, args.prompt_len, 20, args.vocab_size, False, args.device)
+
+    print(f"{'bsz':>4} {'penalty':>10} {'total ms':>10} {'ms/step first':>14} {'ms/step last':>13}")
+    for bsz in args.bsz:
+        for name, incremental in (("gather", False), ("presence", True)):
+            latencies = decode(bsz, args.prompt_len, args.steps, args.vocab_size, incremental, args.device)
+            first = latencies[:args.window]
+            last = latencies[-args.window:]
+            print(f"{bsz:>4} {name:>10} {sum(latencies)*1000:>10.1f} "
+                  f"{sum(first)/len(first)*1000:>14.3f} {sum(last)/len(last)*1000:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Self-speculative T2S decoding (`Text2SemanticDecoder.infer_panel_speculative`):
+# the first `draft_layers` layers propose `num_draft_tokens` tokens, the full model verifies them in one forward.
+# Prints the acceptance rate of the draft tokens and the per-token latency against the normal decoding.
+#
+#   python benchmarks/t2s_speculative.py --weights GPT_weights/xxx.ckpt --draft_layers 4 8 12 --num_draft_tokens 2 4 8
+#
+# Without --weights the decoder is randomly initialized, the latency of a round is still meaningful
+# but the acceptance rate is not, a trained model is needed for the speedup.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+import contextlib
+import io
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_t2s_model, synchronize
+
+
+@torch.no_grad()
+def decode(model, inputs, steps:int, top_k:int, device:str, draft_layers:int=0, num_draft_tokens:int=4, seed:int=0):
+    '''
+    Returns (the latency (s) per token, the number of tokens, the stats of the speculative decoding).
+    '''
+    x, bert, prompt = inputs
+    stats = {}
+    kwargs = dict(top_k=top_k, top_p=1, temperature=1, repetition_penalty=1.35, early_stop_num=steps)
+    torch.manual_seed(seed)
+    synchronize(device)
+    t0 = perf_counter()
+    # 不打印每次decode的日志
+    with contextlib.redirect_stdout(io.StringIO()):
+        if draft_layers > 0:
+            y, _ = model.infer_panel_speculative(x, torch.LongTensor([x.shape[1]]), prompt, bert,
+                                                 draft_layers=draft_layers, num_draft_tokens=num_draft_tokens,
+                                                 stats=stats, **kwargs)
+        else:
+            y, _ = model.infer_panel_with_flash_attn_only(x, torch.LongTensor([x.shape[1]]), prompt, bert, **kwargs)
+    synchronize(device)
+    num_tokens = y.shape[1] - prompt.shape[1]
+    return (perf_counter() - t0) / max(num_tokens, 1), num_tokens, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", type=str, default=None, help="a trained GPT checkpoint (.ckpt), random weights if not set")
+    parser.add_argument("--n_layer", type=int, default=24)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--draft_layers", type=int, nargs="+", default=[4, 8, 12])
+    parser.add_argument("--num_draft_tokens", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--top_k", type=int, default=15)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--text_len", type=int, default=60)
+    parser.add_argument("--prompt_len", type=int, default=150)
+    args = parser.parse_args()
+
+    model = build_t2s_model(args.n_layer, args.device, args.weights)
+    g = torch.Generator().manual_seed(0)
+    inputs = (torch.randint(0, 512, (1, args.text_len), generator=g).to(args.device),
+              torch.randn(1, 1024, args.text_len, generator=g).to(args.device),
+              torch.randint(0, 1024, (1, args.prompt_len), generator=g).to(args.device))
+    # 预热
+    decode(model, inputs, 10, args.top_k, args.device)
+    decode(model, inputs, 10, args.top_k, args.device, args.draft_layers[0], args.num_draft_tokens[0])
+
+    base, num_tokens, _ = decode(model, inputs, args.steps, args.top_k, args.device)
+    print(f"{model.num_layers} layers, top_k {args.top_k}, normal decoding: {num_tokens} tokens, {base*1000:.2f} ms/token")
+    print(f"{'draft_layers':>12} {'draft_tokens':>12} {'tokens':>7} {'accept rate':>12} {'tokens/round':>13} {'ms/token':>9} {'speedup':>8}")
+    for draft_layers in args.draft_layers:
+        for num_draft_tokens in args.num_draft_tokens:
+            latency, num_tokens, stats = decode(model, inputs, args.steps, args.top_k, args.device, draft_layers, num_draft_tokens)
+            accept_rate = stats["accepted"] / max(stats["drafted"], 1)
+            tokens_per_round = (stats["accepted"] + stats["rounds"]) / max(stats["rounds"], 1)
+            print(f"{draft_layers:>12} {num_draft_tokens:>12} {num_tokens:>7} {accept_rate:>12.2%} "
+                  f"{tokens_per_round:>13.2f} {latency*1000:>9.2f} {base/latency:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
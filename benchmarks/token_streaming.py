@@ -0,0 +1,108 @@
+# Latency until the first audio of one segment in return_fragment mode:
+#   segment:          T2S generates the whole segment, then VITS decodes it at once (`SynthesizerTrn.decode`)
+#   chunked vits:     T2S generates the whole segment, then VITS decodes it chunk by chunk (`SynthesizerTrn.decode_streaming`)
+#   token streaming:  VITS decodes the chunks while T2S is still generating
+#                     (`Text2SemanticDecoder.infer_panel_stream` -> `SynthesizerTrn.decode_streaming_tokens`)
+#
+#   python benchmarks/token_streaming.py --tokens 200 --chunk_size 25 --lookahead 4
+#
+# Both models are randomly initialized (configs/s1longer.yaml, configs/s2.json) and never reach EOS,
+# the segment is stopped after --tokens semantic tokens. The tokens are decoded greedily and every mode gets the same latent noise,
+# "max diff" is the largest absolute difference of the audio against the whole decode.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+import contextlib
+import io
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_t2s_model, build_vits_model, synchronize
+
+
+def measure(fn, device:str):
+    '''
+    Returns (seconds until the first audio, seconds until the last audio, the audio chunks).
+    '''
+    synchronize(device)
+    t0 = perf_counter()
+    first = None
+    chunks = []
+    # 不打印每次decode的日志
+    with contextlib.redirect_stdout(io.StringIO()):
+        for chunk in fn():
+            synchronize(device)
+            if first is None:
+                first = perf_counter() - t0
+            chunks.append(chunk)
+    return first, perf_counter() - t0, chunks
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=24)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--tokens", type=int, default=200, help="semantic tokens of the segment (25 per second)")
+    parser.add_argument("--chunk_size", type=int, default=25)
+    parser.add_argument("--lookahead", type=int, default=4)
+    parser.add_argument("--crossfade", type=int, default=1)
+    parser.add_argument("--latent_window", type=int, default=150)
+    parser.add_argument("--noise_scale", type=float, default=0.5)
+    parser.add_argument("--text_len", type=int, default=60)
+    parser.add_argument("--prompt_len", type=int, default=150)
+    args = parser.parse_args()
+
+    device = args.device
+    t2s_model = build_t2s_model(args.n_layer, device)
+    vits_model, hps = build_vits_model(device)
+    g = torch.Generator().manual_seed(0)
+    x = torch.randint(0, 512, (1, args.text_len), generator=g).to(device)
+    bert = torch.randn(1, 1024, args.text_len, generator=g).to(device)
+    prompt = torch.randint(0, 1024, (1, args.prompt_len), generator=g).to(device)
+    phones = torch.randint(1, 300, (1, args.text_len), generator=g).to(device)
+    refer = torch.rand(1, hps["data"]["filter_length"] // 2 + 1, 250, generator=g).to(device)
+    ge = vits_model.extract_ge(refer)
+    noise = torch.randn(1, vits_model.inter_channels, args.tokens * 2, generator=g).to(device)
+
+    def token_stream():
+        for y, idx, finished in t2s_model.infer_panel_stream(x, torch.LongTensor([args.text_len]), prompt, bert,
+                                                              top_k=1, early_stop_num=args.tokens):
+            yield y[0, -idx:].view(1, 1, -1), finished
+
+    def generate():
+        for codes, finished in token_stream():
+            pass
+        return codes
+
+    def segment():
+        yield vits_model.decode(generate(), phones, refer, noise_scale=args.noise_scale, ge=ge, noise=noise)[0, 0]
+
+    def chunked_vits():
+        yield from vits_model.decode_streaming(generate(), phones, refer, noise_scale=args.noise_scale, ge=ge,
+                                               chunk_size=args.chunk_size, crossfade=args.crossfade, noise=noise)
+
+    def token_streaming():
+        yield from vits_model.decode_streaming_tokens(token_stream(), phones, refer, noise_scale=args.noise_scale, ge=ge,
+                                                      chunk_size=args.chunk_size, lookahead=args.lookahead,
+                                                      crossfade=args.crossfade, latent_window=args.latent_window, noise=noise)
+
+    print(f"{t2s_model.num_layers} layers, {args.tokens} tokens, chunk {args.chunk_size} tokens, lookahead {args.lookahead} tokens, "
+          f"latent window {args.latent_window} tokens, noise scale {args.noise_scale}, device {device}, {torch.get_num_threads()} threads")
+    print(f"{'':>16} {'first audio ms':>15} {'total ms':>9} {'max diff':>9}")
+    reference = None
+    for name, fn in (("segment", segment), ("chunked vits", chunked_vits), ("token streaming", token_streaming)):
+        # 预热
+        measure(fn, device)
+        first, total, chunks = measure(fn, device)
+        audio = torch.cat(chunks)
+        reference = audio if reference is None else reference
+        max_diff = (audio - reference).abs().max().item() if audio.shape == reference.shape else float("nan")
+        print(f"{name:>16} {first*1000:>15.1f} {total*1000:>9.1f} {max_diff:>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
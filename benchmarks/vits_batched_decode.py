@@ -0,0 +1,83 @@
+# VITS decode of the segments of one batch: concatenated into one long sequence (the default of TTS.run),
+# one by one, and as the rows of a padded batch masked by their lengths (`SynthesizerTrn.batched_decode`).
+#
+#   python benchmarks/vits_batched_decode.py --lens 20 40 60 80 --device cuda
+#
+# "max diff" is the largest absolute difference of every segment's audio against decoding it alone
+# (noise_scale=0), the concatenated decode leaks across the segment boundaries.
+# The model is randomly initialized from configs/s2.json, the latency doesn't depend on the weights.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+import math
+from time import perf_counter
+
+import torch
+import torch.nn.functional as F
+
+from benchmarks.common import build_vits_model, synchronize
+
+
+def measure(fn, device:str, repeat:int):
+    '''
+    Returns (the best latency (s) of `repeat` calls, the output of the last call).
+    '''
+    best = float("inf")
+    for _ in range(repeat):
+        synchronize(device)
+        t0 = perf_counter()
+        output = fn()
+        synchronize(device)
+        best = min(best, perf_counter() - t0)
+    return best, output
+
+
+def pad(sequences):
+    length = max(item.shape[-1] for item in sequences)
+    return torch.stack([F.pad(item, (0, length - item.shape[-1])) for item in sequences])
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--lens", type=int, nargs="+", default=[20, 40, 60, 80], help="semantic tokens of every segment")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model, hps = build_vits_model(args.device)
+    device = args.device
+    g = torch.Generator().manual_seed(0)
+    refer = torch.rand(1, hps["data"]["filter_length"] // 2 + 1, 250, generator=g).to(device)
+    ge = model.extract_ge(refer)
+    codes = [torch.randint(0, 1024, (n,), generator=g).to(device) for n in args.lens]
+    phones = [torch.randint(1, 300, (max(n // 2, 1),), generator=g).to(device) for n in args.lens]
+    upsample_rate = 2 * math.prod(model.upsample_rates)
+
+    def one_by_one():
+        return [model.decode(c.view(1, 1, -1), p.unsqueeze(0), refer, noise_scale=0, ge=ge)[0, 0] for c, p in zip(codes, phones)]
+
+    def concatenated():
+        audio = model.decode(torch.cat(codes).view(1, 1, -1), torch.cat(phones).unsqueeze(0), refer, noise_scale=0, ge=ge)[0, 0]
+        return list(torch.split(audio, [n * upsample_rate for n in args.lens]))
+
+    def batched():
+        return model.batched_decode(pad(codes).unsqueeze(0), torch.LongTensor(args.lens).to(device),
+                                    pad(phones), torch.LongTensor([p.shape[0] for p in phones]).to(device),
+                                    refer, noise_scale=0, ge=ge)
+
+    one_by_one()
+    results = {name: measure(fn, device, args.repeat) for name, fn in
+               (("one by one", one_by_one), ("concatenated", concatenated), ("batched", batched))}
+    reference = results["one by one"][1]
+    print(f"segments {args.lens} (semantic tokens), device {device}, {torch.get_num_threads()} threads")
+    print(f"{'':>13} {'ms':>8} {'max diff':>9}")
+    for name, (latency, audio) in results.items():
+        max_diff = max((a - b).abs().max().item() for a, b in zip(reference, audio))
+        print(f"{name:>13} {latency*1000:>8.1f} {max_diff:>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
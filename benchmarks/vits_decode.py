@@ -0,0 +1,62 @@
+# Latency of SynthesizerTrn.decode for one fragment, with the reference style embedding `ge`
+# recomputed from the reference spectrogram at every call vs passed in precomputed (`SynthesizerTrn.extract_ge`).
+#
+#   python benchmarks/vits_decode.py --tokens 25 50 100 --ref_sec 5
+#
+# The model is randomly initialized from configs/s2.json, the latency doesn't depend on the weights.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_vits_model, synchronize
+
+
+def measure(fn, device:str, repeat:int)->float:
+    '''
+    Returns the best latency (s) of `repeat` calls.
+    '''
+    fn()
+    best = float("inf")
+    for _ in range(repeat):
+        synchronize(device)
+        t0 = perf_counter()
+        fn()
+        synchronize(device)
+        best = min(best, perf_counter() - t0)
+    return best
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--tokens", type=int, nargs="+", default=[25, 50, 100], help="semantic tokens of the fragment (25 per second)")
+    parser.add_argument("--ref_sec", type=float, default=5, help="length of the reference audio")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    model, hps = build_vits_model(args.device, prepare=False)
+    del model.enc_q
+    g = torch.Generator().manual_seed(0)
+    ref_frames = int(args.ref_sec * hps["data"]["sampling_rate"] / hps["data"]["hop_length"])
+    refer = torch.rand(1, hps["data"]["filter_length"] // 2 + 1, ref_frames, generator=g).to(args.device)
+    ge = model.extract_ge(refer)
+    ref_enc = measure(lambda: model.extract_ge(refer), args.device, args.repeat)
+
+    print(f"reference {args.ref_sec:.1f}s, ref_enc {ref_enc*1000:.1f} ms, device {args.device}, {torch.get_num_threads()} threads")
+    print(f"{'tokens':>7} {'recompute ge ms':>16} {'cached ge ms':>13} {'speedup':>8}")
+    for num_tokens in args.tokens:
+        codes = torch.randint(0, 1024, (1, 1, num_tokens), generator=g).to(args.device)
+        text = torch.randint(0, 300, (1, num_tokens), generator=g).to(args.device)
+        recompute = measure(lambda: model.decode(codes, text, refer), args.device, args.repeat)
+        cached = measure(lambda: model.decode(codes, text, refer, ge=ge), args.device, args.repeat)
+        print(f"{num_tokens:>7} {recompute*1000:>16.1f} {cached*1000:>13.1f} {recompute/cached:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
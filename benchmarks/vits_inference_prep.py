@@ -0,0 +1,84 @@
+# Latency of SynthesizerTrn.decode as loaded (weight norm recomputed from weight_g/weight_v at every forward),
+# after `SynthesizerTrn.prepare_for_inference` (weight norm folded, training-only modules dropped)
+# and with the Generator traced and frozen (`SynthesizerTrn.set_frozen_decoder`).
+#
+#   python benchmarks/vits_inference_prep.py --tokens 25 50 100 --threads 4
+#
+# The model is randomly initialized from configs/s2.json, the latency doesn't depend on the weights.
+# "max diff" is the largest absolute difference of the audio against the model as loaded.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_vits_model, synchronize
+
+
+def measure(fn, device:str, repeat:int)->float:
+    '''
+    Returns the best latency (s) of `repeat` calls.
+    '''
+    best = float("inf")
+    for _ in range(repeat):
+        synchronize(device)
+        t0 = perf_counter()
+        fn()
+        synchronize(device)
+        best = min(best, perf_counter() - t0)
+    return best
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[25, 50, 100], help="semantic tokens of the fragment (25 per second)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model, hps = build_vits_model(args.device, prepare=False)
+    num_params = sum(p.numel() for p in model.parameters())
+    g = torch.Generator().manual_seed(0)
+    refer = torch.rand(1, hps["data"]["filter_length"] // 2 + 1, 250, generator=g).to(args.device)
+    inputs = []
+    for num_tokens in args.tokens:
+        inputs.append((torch.randint(0, 1024, (1, 1, num_tokens), generator=g).to(args.device),
+                       torch.randint(0, 300, (1, num_tokens), generator=g).to(args.device)))
+
+    def decode(codes, text):
+        torch.manual_seed(0)
+        return model.decode(codes, text, refer)
+
+    results = {}
+    outputs = {}
+    for name in ("as loaded", "prepared", "prepared+frozen"):
+        if name == "prepared":
+            model.prepare_for_inference()
+        elif name == "prepared+frozen":
+            model.set_frozen_decoder(True)
+            t0 = perf_counter()
+            decode(*inputs[0])
+            print(f"tracing and freezing the Generator: {perf_counter() - t0:.1f} s")
+        decode(*inputs[0])
+        results[name] = [measure(lambda: decode(codes, text), args.device, args.repeat) for codes, text in inputs]
+        outputs[name] = [decode(codes, text) for codes, text in inputs]
+
+    print(f"parameters: {num_params/1e6:.1f}M as loaded, {sum(p.numel() for p in model.parameters())/1e6:.1f}M prepared, "
+          f"device {args.device}, {torch.get_num_threads()} threads")
+    print(f"{'':>16} " + " ".join(f"{str(n) + ' tokens ms':>15}" for n in args.tokens) + f" {'speedup':>8} {'max diff':>9}")
+    base = results["as loaded"]
+    for name, latency in results.items():
+        speedup = sum(base) / sum(latency)
+        max_diff = max((a - b).abs().max().item() for a, b in zip(outputs["as loaded"], outputs[name]))
+        print(f"{name:>16} " + " ".join(f"{item*1000:>15.1f}" for item in latency) + f" {speedup:>7.2f}x {max_diff:>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# VITS decode of one segment at once (`SynthesizerTrn.decode`) vs chunk by chunk (`SynthesizerTrn.decode_streaming`):
+# the latency until the first audio, the total latency, and on cuda the peak memory.
+#
+#   python benchmarks/vits_streaming_decode.py --tokens 100 250 500 --chunk_size 25
+#
+# "max diff" is the largest absolute difference of the chunks against the whole decode (noise_scale=0).
+# The model is randomly initialized from configs/s2.json, the latency doesn't depend on the weights.
+import os, sys
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+from time import perf_counter
+
+import torch
+
+from benchmarks.common import build_vits_model, synchronize
+
+
+def measure(fn, device:str):
+    '''
+    Returns (seconds until the first chunk, seconds until the last chunk, peak memory MB or None, the chunks).
+    '''
+    if "cuda" in device:
+        torch.cuda.reset_peak_memory_stats()
+    synchronize(device)
+    t0 = perf_counter()
+    first = None
+    chunks = []
+    for chunk in fn():
+        synchronize(device)
+        if first is None:
+            first = perf_counter() - t0
+        chunks.append(chunk)
+    total = perf_counter() - t0
+    peak = torch.cuda.max_memory_allocated() / 2**20 if "cuda" in device else None
+    return first, total, peak, chunks
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--tokens", type=int, nargs="+", default=[100, 250, 500], help="semantic tokens of the segment (25 per second)")
+    parser.add_argument("--chunk_size", type=int, default=25, help="semantic tokens per chunk")
+    parser.add_argument("--crossfade", type=int, default=1)
+    args = parser.parse_args()
+
+    model, hps = build_vits_model(args.device)
+    device = args.device
+    g = torch.Generator().manual_seed(0)
+    refer = torch.rand(1, hps["data"]["filter_length"] // 2 + 1, 250, generator=g).to(device)
+    ge = model.extract_ge(refer)
+
+    print(f"chunk {args.chunk_size} tokens, context {model.dec.receptive_field()} frames, "
+          f"crossfade {args.crossfade} frames, device {device}, {torch.get_num_threads()} threads")
+    print(f"{'tokens':>7} {'mode':>8} {'first ms':>9} {'total ms':>9} {'peak MB':>8} {'max diff':>9}")
+    for num_tokens in args.tokens:
+        codes = torch.randint(0, 1024, (1, 1, num_tokens), generator=g).to(device)
+        text = torch.randint(1, 300, (1, max(num_tokens // 2, 1)), generator=g).to(device)
+        whole = lambda: [model.decode(codes, text, refer, noise_scale=0, ge=ge)[0, 0]]
+        chunked = lambda: model.decode_streaming(codes, text, refer, noise_scale=0, ge=ge,
+                                                 chunk_size=args.chunk_size, crossfade=args.crossfade)
+        reference = None
+        for name, fn in (("whole", whole), ("chunked", chunked)):
+            measure(fn, device)
+            first, total, peak, chunks = measure(fn, device)
+            audio = torch.cat(chunks)
+            reference = audio if reference is None else reference
+            peak = "-" if peak is None else f"{peak:.0f}"
+            print(f"{num_tokens:>7} {name:>8} {first*1000:>9.1f} {total*1000:>9.1f} {peak:>8} "
+                  f"{(audio - reference).abs().max().item():>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# one decode step of Text2SemanticDecoder compiled into a single graph with torch.compile:
+# audio embedding, position encoding, all blocks, ar_predict_layer and sampling.
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from gpt_sovits.GPT_SoVITS.AR.models.t2s_model import T2SKVCache
+from gpt_sovits.GPT_SoVITS.AR.models.utils import sample
+
+
+class T2SDecodeGraph:
+    '''
+    Compiled "decode one token" step of a Text2SemanticDecoder.
+
+    The jit-scripted blocks can't be traced by torch.compile, the step reads their weights
+        and runs the same math in plain torch ops, so the whole step becomes one graph.
+    The kv cache capacity is rounded up to a multiple of `bucket_size` and the attention covers the whole
+        buffer with the unused positions masked out: the shapes only change when the cache moves to the next bucket,
+        every bucket (and batch size) is compiled once and reused by the next requests.
+    The sampling settings are passed as tensors, changing them doesn't recompile,
+        except top_k: its max is rounded up to a power of two, so nearby values share a graph.
+    Compiling a bucket takes from seconds on GPU to minutes on CPU, `warmup` compiles them before the first request.
+
+    Args:
+        model: Text2SemanticDecoder.
+        bucket_size: int, the kv cache capacity is a multiple of it.
+        backend: str, the torch.compile backend, "inductor" by default.
+        mode: optional str, the torch.compile mode.
+        cache_size_limit: int, the number of graphs kept for the step,
+            `torch._dynamo.config.cache_size_limit` is raised to it only while the step runs.
+    '''
+    def __init__(self, model, bucket_size:int=256, backend:str="inductor", mode:Optional[str]=None,
+                 cache_size_limit:int=64):
+        self.model = model
+        self.bucket_size = max(int(bucket_size), 1)
+        self.backend = backend
+        self.num_heads:int = model.num_head
+        self.hidden_dim:int = model.model_dim
+        self.layers:List[Tuple[torch.Tensor, ...]] = [
+            (block.qkv_w, block.qkv_b, block.out_w, block.out_b,
+             block.norm_w1, block.norm_b1, block.norm_w2, block.norm_b2,
+             block.mlp.w1, block.mlp.b1, block.mlp.w2, block.mlp.b2)
+            for block in model.t2s_transformer.blocks
+        ]
+        self.norm_eps:List[Tuple[float, float]] = [(block.norm_eps1, block.norm_eps2) for block in model.t2s_transformer.blocks]
+        # 每个bucket和batch size各编译一次, 默认的缓存上限(8)不够
+        self.cache_size_limit = max(int(cache_size_limit), 1)
+        self._step = torch.compile(self._decode_step, backend=backend, mode=mode, dynamic=False)
+
+    def _decode_step(self,
+                     tokens:torch.Tensor,
+                     positions:torch.Tensor,
+                     kv_len:torch.Tensor,
+                     k_cache:List[torch.Tensor],
+                     v_cache:List[torch.Tensor],
+                     padding_mask:Optional[torch.Tensor],
+                     presence:torch.Tensor,
+                     top_k:torch.Tensor,
+                     top_p:torch.Tensor,
+                     temperature:torch.Tensor,
+                     repetition_penalty:torch.Tensor,
+                     max_top_k:int,
+                     ):
+        model = self.model
+        bsz = tokens.shape[0]
+        capacity = k_cache[0].shape[1]
+
+        y_emb = model.ar_audio_embedding(tokens)
+        pe = model.ar_audio_position.pe[0, positions].unsqueeze(1).to(dtype=y_emb.dtype)
+        x = y_emb * model.ar_audio_position.x_scale + model.ar_audio_position.alpha * pe
+
+        # (bsz, 1, 1, capacity) bool, True表示参与attention
+        attn_mask = (torch.arange(capacity, device=tokens.device) <= kv_len).view(1, capacity)
+        if padding_mask is not None:
+            attn_mask = attn_mask.logical_and(padding_mask.logical_not())
+        attn_mask = attn_mask.expand(bsz, capacity).view(bsz, 1, 1, capacity)
+
+        for i, (qkv_w, qkv_b, out_w, out_b, norm_w1, norm_b1, norm_w2, norm_b2, w1, b1, w2, b2) in enumerate(self.layers):
+            norm_eps1, norm_eps2 = self.norm_eps[i]
+            q, k, v = F.linear(x, qkv_w, qkv_b).chunk(3, dim=-1)
+            k_cache[i].index_copy_(1, kv_len, k)
+            v_cache[i].index_copy_(1, kv_len, v)
+
+            q = q.view(bsz, 1, self.num_heads, -1).transpose(1, 2)
+            k = k_cache[i].view(bsz, capacity, self.num_heads, -1).transpose(1, 2)
+            v = v_cache[i].view(bsz, capacity, self.num_heads, -1).transpose(1, 2)
+            attn = F.scaled_dot_product_attention(q, k, v, attn_mask)
+            attn = F.linear(attn.transpose(1, 2).reshape(bsz, 1, self.hidden_dim), out_w, out_b)
+
+            x = F.layer_norm(x + attn, [self.hidden_dim], norm_w1, norm_b1, norm_eps1)
+            x = F.layer_norm(x + F.linear(F.relu(F.linear(x, w1, b1)), w2, b2), [self.hidden_dim], norm_w2, norm_b2, norm_eps2)
+
+        logits = F.linear(x[:, -1], model.ar_predict_layer.weight, model.ar_predict_layer.bias)
+        samples = sample(logits, top_k=top_k, top_p=top_p, temperature=temperature,
+                         repetition_penalty=repetition_penalty, max_top_k=max_top_k, presence=presence)[0]
+        presence.scatter_(1, samples.long(), True)
+        return samples, logits
+
+    def step(self,
+             kv_cache:T2SKVCache,
+             tokens:torch.Tensor,
+             positions:torch.Tensor,
+             presence:torch.Tensor,
+             top_k:int=-100,
+             top_p:float=100,
+             temperature:float=1.0,
+             repetition_penalty:float=1.35,
+             )->Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        Decode the next token of every row.
+
+        Args:
+            kv_cache: T2SKVCache, the kv of `tokens` is appended to it, resized to the bucket capacity when needed.
+            tokens: (bsz, 1), the last sampled token of every row.
+            positions: (bsz,) long, the positions of `tokens` in the audio position encoding.
+            presence: (bsz, vocab_size) bool from `token_presence`, updated in place with the new tokens.
+            top_k, top_p, temperature, repetition_penalty: the sampling settings, same as `sample`.
+        Returns:
+            (samples, logits): (bsz, 1) int tensor and the (bsz, vocab_size) logits after the repetition penalty.
+        '''
+        capacity = -(-(kv_cache.length + 1) // self.bucket_size) * self.bucket_size
+        if kv_cache.capacity != capacity:
+            kv_cache.resize(capacity)
+            # attention覆盖整个buffer, 未初始化的位置即使被mask, 其中的nan/inf也会污染输出(0*nan)
+            for item in kv_cache.k_cache + kv_cache.v_cache:
+                item[:, kv_cache.length:].zero_()
+        if kv_cache.padding_mask is not None:
+            kv_cache.padding_mask[:, kv_cache.length] = False
+
+        bsz = tokens.shape[0]
+        device = tokens.device
+        vocab_size = self.model.vocab_size
+        max_top_k = top_k if top_k > 0 else vocab_size
+        # 候选数取2的幂, 相近的top_k共用一个图; 多出的候选按每行的top_k屏蔽, 结果不变
+        num_candidates = min(1 << (max(max_top_k, 1) - 1).bit_length(), vocab_size)
+        # 只在调用期间放宽全局的编译缓存上限
+        with torch._dynamo.config.patch(cache_size_limit=max(torch._dynamo.config.cache_size_limit, self.cache_size_limit)):
+            samples, logits = self._step(
+                # tokens通常是y的切片, storage offset每步都不同, stride随y的长度变化, 拷贝成连续的一份避免重新编译
+                tokens.clone(memory_format=torch.contiguous_format),
+                positions,
+                torch.full((1,), kv_cache.length, dtype=torch.long, device=device),
+                kv_cache.k_cache,
+                kv_cache.v_cache,
+                kv_cache.padding_mask,
+                presence,
+                torch.full((bsz,), max_top_k, dtype=torch.long, device=device),
+                torch.full((bsz,), top_p, dtype=torch.float32, device=device),
+                torch.full((bsz,), temperature, dtype=torch.float32, device=device),
+                torch.full((bsz,), repetition_penalty, dtype=torch.float32, device=device),
+                num_candidates,
+            )
+        kv_cache.length += 1
+        return samples, logits
+
+    @torch.no_grad()
+    def warmup(self, max_tokens:int, top_k:int=5, batch_size:int=1):
+        '''
+        Compile the step for every bucket up to `max_tokens` kv cache positions (prompt, text and semantic tokens),
+            so the first requests don't wait for the compilation.
+        Args:
+            max_tokens: int, the largest kv cache length to compile for.
+            top_k: int, the top_k of the requests, values up to the next power of two share the graph.
+            batch_size: int, the number of rows decoded together, 1 when the segments are decoded one by one.
+        '''
+        weight = self.layers[0][0]
+        device = weight.device
+        for capacity in range(self.bucket_size, max(int(max_tokens), 1) + self.bucket_size, self.bucket_size):
+            # 长度为capacity-1的kv cache, 下一步正好落在这个bucket
+            k_cache = [torch.zeros((batch_size, capacity - 1, self.hidden_dim), dtype=weight.dtype, device=device)
+                       for _ in self.layers]
+            kv_cache = T2SKVCache(k_cache, [item.clone() for item in k_cache], capacity=capacity)
+            self.step(kv_cache,
+                      torch.zeros((batch_size, 1), dtype=torch.long, device=device),
+                      torch.zeros((batch_size,), dtype=torch.long, device=device),
+                      torch.zeros((batch_size, self.model.vocab_size), dtype=torch.bool, device=device),
+                      top_k=top_k)
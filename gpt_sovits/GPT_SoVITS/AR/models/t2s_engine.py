@@ -0,0 +1,322 @@
+# iteration-level batching for Text2SemanticDecoder:
+# new sequences are prefilled and spliced into the running decode batch between two decode steps.
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+import torch.nn.functional as F
+
+from gpt_sovits.GPT_SoVITS.AR.models.t2s_model import T2SKVCache
+from gpt_sovits.GPT_SoVITS.AR.models.utils import sample, token_presence
+
+
+class T2SSequence:
+    '''
+    Bookkeeping of one row of the live decode batch.
+    '''
+    def __init__(self,
+                 seq_id:int,
+                 prefix_len:int,
+                 early_stop_num:int,
+                 ref_free:bool,
+                 sampling:Dict[str, float],
+                 generator:Optional[torch.Generator]=None,
+                 ):
+        self.seq_id = seq_id
+        self.prefix_len = prefix_len
+        self.early_stop_num = early_stop_num
+        self.ref_free = ref_free
+        self.sampling = sampling
+        self.generator = generator
+        # 已采样的token数(包括prefill之后采样的第一个token)
+        self.steps = 0
+
+
+class T2SDecodeEngine:
+    '''
+    A live T2S decode batch that sequences can join and leave at every step.
+
+    Rows are right aligned: the kv cache and the token history of a shorter row are left padded,
+        the padding is masked out in attention and ignored by the repetition penalty.
+        Every row has its own sampling settings and optionally its own random generator.
+        Like `infer_panel_batch_infer_with_flash_attn`, the token history is preallocated and EOS is only recorded on the device,
+        the finished rows are checked on the host every `sync_every` steps, when a row reaches its limit,
+        and when sequences are added or cancelled.
+
+    Args:
+        model: Text2SemanticDecoder.
+        top_k, top_p, temperature, repetition_penalty: the default sampling settings of new rows.
+        max_steps: int, the maximum number of tokens sampled for one sequence.
+        chunk_size: int, the kv cache grows by this many positions when full.
+        packed_prefill: bool, prefill the new sequences packed without padding, see `Text2SemanticDecoder.prefill_packed`.
+        sync_every: int, decode steps between two checks of the finished rows,
+            a row that sampled EOS decodes at most sync_every-1 extra steps, which are dropped from its result.
+    '''
+    def __init__(self,
+                 model,
+                 top_k:int=-100,
+                 top_p:float=100,
+                 temperature:float=1.0,
+                 repetition_penalty:float=1.35,
+                 max_steps:int=1500,
+                 chunk_size:int=256,
+                 packed_prefill:bool=False,
+                 sync_every:int=8,
+                 ):
+        self.model = model
+        self.sampling = dict(top_k=top_k, top_p=top_p, temperature=temperature, repetition_penalty=repetition_penalty)
+        self.max_steps = max_steps
+        self.chunk_size = chunk_size
+        self.packed_prefill = packed_prefill
+        self.sync_every = max(int(sync_every), 1)
+        # 词表外的token, 用于左pad历史token, 对应的logit恒为-inf
+        self.pad_token:int = model.vocab_size
+        self.sequences:List[T2SSequence] = []
+        self.kv_cache:T2SKVCache = None           # 预分配的kv cache, 包括padding mask
+        self.y:torch.Tensor = None                # (bsz, capacity), 预分配的历史token, 前y_len列有效, 其余为pad token
+        self.y_len:int = 0
+        self.eos_col:torch.LongTensor = None      # (bsz,), 采样到EOS的列(y中的下标), -1表示还没有. 只在device上更新
+        self.presence:torch.Tensor = None         # (bsz, pad_token + 1) bool, 出现过的token, 用于repetition penalty
+        self.y_pos:torch.LongTensor = None        # (bsz,), 最后一个token在位置编码中的下标
+        self._sampling_args:dict = None           # 各行的采样参数, batch组成变化时重新构造
+        self._next_id:int = 0
+        self._num_steps:int = 0
+
+    @property
+    def num_active(self)->int:
+        return len(self.sequences)
+
+    @torch.no_grad()
+    def add(self,
+            x:List[torch.LongTensor],
+            x_lens:torch.LongTensor,
+            prompts:Union[torch.LongTensor, List[torch.LongTensor], None],
+            bert_feature:List[torch.Tensor],
+            early_stop_num:Union[int, List[int]]=-1,
+            sampling:Optional[Union[Dict[str, float], List[Dict[str, float]]]]=None,
+            generators:Optional[List[Optional[torch.Generator]]]=None,
+            )->Tuple[List[int], List[Tuple[int, torch.LongTensor, int]]]:
+        '''
+        Prefill new sequences and splice them into the live batch.
+
+        Args:
+            x, x_lens, prompts, bert_feature: same as `Text2SemanticDecoder.prefill_batch`,
+                the new sequences can use different references.
+            early_stop_num: int or a list of int (one for each sequence).
+            sampling: optional, a dict of top_k, top_p, temperature, repetition_penalty or a list of them (one for each sequence),
+                missing settings fall back to the defaults of the engine.
+            generators: optional, a torch.Generator on the model device (or None) for each sequence.
+        Returns:
+            (seq_ids, finished), finished is a list of (seq_id, pred_semantic, idx)
+                for the sequences which already stopped after the first token.
+        '''
+        bsz = len(x)
+        if not isinstance(early_stop_num, (list, tuple)):
+            early_stop_num = [early_stop_num]*bsz
+        if not isinstance(sampling, (list, tuple)):
+            sampling = [sampling]*bsz
+        if generators is None:
+            generators = [None]*bsz
+        xy_dec, k_cache, v_cache, kv_padding_mask, y, y_lens = \
+            self.model.prefill_batch(x, x_lens, prompts, bert_feature, int(x_lens.max()),
+                                     packed=self.packed_prefill)
+
+        ref_free = prompts is None
+        prefix_lens = y_lens.tolist()
+        sequences = []
+        for i in range(bsz):
+            seq = T2SSequence(self._next_id, prefix_lens[i], early_stop_num[i], ref_free,
+                              dict(self.sampling, **(sampling[i] or {})), generators[i])
+            seq.steps = 1
+            self._next_id += 1
+            sequences.append(seq)
+
+        logits = self.model.predict_logits(xy_dec[:, -1])[:, :-1]
+        presence = token_presence(y, self.pad_token + 1)
+        samples = sample(logits, presence=presence, **self._make_sampling_args(sequences, logits.device))[0]
+        y = torch.concat([y, samples], dim=1)
+        presence.scatter_(1, samples.long(), True)
+        # prompt左pad的部分换成pad token
+        y_starts = (y.shape[1] - 1 - y_lens).view(bsz, 1)
+        y = y.masked_fill(torch.arange(y.shape[1], device=y.device).view(1, -1) < y_starts, self.pad_token)
+        y_pos = y_lens.to(device=y.device, dtype=torch.long)
+        eos_col = torch.where(samples[:, 0] == self.model.EOS, y.shape[1] - 1, -1)
+
+        self._splice(sequences, k_cache, v_cache, kv_padding_mask, y, y_pos, presence, eos_col)
+        # prefill已经同步过, 顺便检查所有行
+        finished = self._remove_finished()
+        return [seq.seq_id for seq in sequences], finished
+
+    @torch.no_grad()
+    def step(self)->List[Tuple[int, torch.LongTensor, int]]:
+        '''
+        Decode one token for every live sequence.
+
+        Returns:
+            a list of (seq_id, pred_semantic, idx) for the sequences finished at this step,
+                pred_semantic and idx have the same meaning as in `infer_panel_batch_infer_with_flash_attn`.
+        '''
+        if self.num_active == 0:
+            return []
+        model = self.model
+        y_emb = model.ar_audio_embedding(self.y[:, self.y_len - 1:self.y_len])
+        pe = model.ar_audio_position.pe[0, self.y_pos].unsqueeze(1).to(dtype=y_emb.dtype, device=y_emb.device)
+        xy_pos = y_emb * model.ar_audio_position.x_scale + model.ar_audio_position.alpha * pe
+
+        xy_dec = self.kv_cache.decode(model.t2s_transformer, xy_pos)
+
+        logits = model.predict_logits(xy_dec[:, -1])
+        # 给pad token留一列, 采样时永远不会被选中
+        logits = F.pad(logits, (0, 1), value=-float("inf"))
+        samples = sample(logits, presence=self.presence, **self._sampling_args)[0]
+        if self.y_len == self.y.shape[1]:
+            self.y = F.pad(self.y, (0, self.chunk_size), value=self.pad_token)
+        self.y[:, self.y_len] = samples[:, 0]
+        self.eos_col.masked_fill_((samples[:, 0] == model.EOS).logical_and(self.eos_col < 0), self.y_len)
+        self.y_len += 1
+        self.presence.scatter_(1, samples.long(), True)
+        self.y_pos = self.y_pos + 1
+        for seq in self.sequences:
+            seq.steps += 1
+        self._num_steps += 1
+        # 每sync_every步, 或有行到达上限时才同步到host检查
+        if self._num_steps % self.sync_every != 0 and not any(self._capped(seq) for seq in self.sequences):
+            return []
+        return self._remove_finished()
+
+    def cancel(self, seq_ids:List[int])->List[Tuple[int, torch.LongTensor, int]]:
+        '''
+        Stop the given sequences at their current length and remove them from the live batch.
+
+        Returns:
+            a list of (seq_id, pred_semantic, idx), same as `step`.
+        '''
+        if self.num_active == 0 or len(seq_ids) == 0:
+            return []
+        return self._remove_finished(stopped=set(seq_ids))
+
+    def _make_sampling_args(self, sequences:List[T2SSequence], device)->dict:
+        top_k = [seq.sampling["top_k"] if seq.sampling["top_k"] is not None and seq.sampling["top_k"] > 0 else self.pad_token
+                 for seq in sequences]
+        return dict(
+            top_k=torch.tensor(top_k, dtype=torch.long, device=device),
+            max_top_k=max(top_k),
+            top_p=torch.tensor([seq.sampling["top_p"] for seq in sequences], dtype=torch.float32, device=device),
+            temperature=torch.tensor([seq.sampling["temperature"] for seq in sequences], dtype=torch.float32, device=device),
+            repetition_penalty=torch.tensor([seq.sampling["repetition_penalty"] for seq in sequences], dtype=torch.float32, device=device),
+            generators=[seq.generator for seq in sequences],
+        )
+
+    def _reserve_size(self, sequences:List[T2SSequence])->int:
+        # 预分配的kv cache长度: 各行剩下最多还要decode的步数(由early_stop_num限制), 不超过chunk_size
+        remaining = [min(seq.early_stop_num if seq.early_stop_num != -1 else self.max_steps, self.max_steps) - seq.steps + 1
+                     for seq in sequences]
+        return max(1, min(self.chunk_size, max(remaining)))
+
+    def _capped(self, seq:T2SSequence)->bool:
+        return (seq.early_stop_num != -1 and seq.steps > seq.early_stop_num) or seq.steps >= self.max_steps
+
+    def _splice(self, sequences, k_cache, v_cache, kv_padding_mask, y, y_pos, presence, eos_col):
+        reserve_size = self._reserve_size(self.sequences + sequences)
+        if self.num_active == 0:
+            self.sequences = sequences
+            self.kv_cache = T2SKVCache(k_cache, v_cache, kv_padding_mask,
+                                       capacity=kv_padding_mask.shape[1] + reserve_size,
+                                       chunk_size=self.chunk_size)
+            self.y = F.pad(y, (0, reserve_size), value=self.pad_token)
+            self.y_len = y.shape[1]
+            self.y_pos, self.presence, self.eos_col = y_pos, presence, eos_col
+            self._sampling_args = self._make_sampling_args(self.sequences, y.device)
+            return
+
+        # 新序列加入时才重新分配kv cache
+        cur_k_cache, cur_v_cache, cur_kv_padding_mask = self.kv_cache.valid()
+        kv_len = max(cur_kv_padding_mask.shape[1], kv_padding_mask.shape[1])
+        y_len = max(self.y_len, y.shape[1])
+
+        def left_pad(item:torch.Tensor, length:int, value=0):
+            pad = length - item.shape[1]
+            if pad == 0:
+                return item
+            padding = [0, 0]*(item.dim()-2) + [pad, 0]
+            return F.pad(item, padding, value=value)
+
+        k_cache = [torch.concat([left_pad(cur_k_cache[i], kv_len), left_pad(k_cache[i], kv_len)], dim=0)
+                   for i in range(len(k_cache))]
+        v_cache = [torch.concat([left_pad(cur_v_cache[i], kv_len), left_pad(v_cache[i], kv_len)], dim=0)
+                   for i in range(len(v_cache))]
+        kv_padding_mask = torch.concat([left_pad(cur_kv_padding_mask, kv_len, True),
+                                        left_pad(kv_padding_mask, kv_len, True)], dim=0)
+        self.kv_cache = T2SKVCache(k_cache, v_cache, kv_padding_mask,
+                                   capacity=kv_len + reserve_size,
+                                   chunk_size=self.chunk_size)
+        # 左pad之后采样到EOS的列也要跟着右移
+        def shift(cols:torch.LongTensor, pad:int):
+            return torch.where(cols >= 0, cols + pad, cols)
+
+        self.eos_col = torch.concat([shift(self.eos_col, y_len - self.y_len), shift(eos_col, y_len - y.shape[1])], dim=0)
+        y = torch.concat([left_pad(self.y[:, :self.y_len], y_len, self.pad_token),
+                          left_pad(y.to(self.y.dtype), y_len, self.pad_token)], dim=0)
+        self.y = F.pad(y, (0, reserve_size), value=self.pad_token)
+        self.y_len = y_len
+        self.y_pos = torch.concat([self.y_pos, y_pos], dim=0)
+        self.presence = torch.concat([self.presence, presence], dim=0)
+        self.sequences = self.sequences + sequences
+        self._sampling_args = self._make_sampling_args(self.sequences, self.y.device)
+
+    def _remove_finished(self, stopped:Optional[set]=None):
+        '''
+        Remove the sequences which sampled EOS, hit early_stop_num or max_steps, or whose seq_id is in `stopped`.
+            The steps decoded after EOS are dropped.
+        '''
+        eos_col = self.eos_col.tolist()
+        last_col = self.y_len - 1
+        finished = []
+        reserved = []
+        for i in range(self.num_active):
+            seq = self.sequences[i]
+            if eos_col[i] >= 0:
+                # EOS之后多decode了last_col - eos_col[i]步
+                idx = seq.steps - 2 - (last_col - eos_col[i])
+                end = eos_col[i]
+            elif self._capped(seq) or (stopped is not None and seq.seq_id in stopped):
+                idx = seq.steps - 1
+                end = last_col
+            else:
+                reserved.append(i)
+                continue
+            # 最后一个token(EOS或到达上限时采样的token)不返回
+            tokens = self.y[i, :end]
+            tokens = tokens[tokens != self.pad_token]
+            finished.append((seq.seq_id, tokens, 0 if seq.ref_free else idx))
+        if len(finished) == 0:
+            return finished
+        if len(reserved) == 0:
+            self._reset()
+            return finished
+
+        index = torch.LongTensor(reserved).to(self.y.device)
+        self.sequences = [self.sequences[i] for i in reserved]
+        kv_padding_mask = torch.index_select(self.kv_cache.valid()[2], dim=0, index=index)
+        self.y = torch.index_select(self.y, dim=0, index=index)
+        self.y_pos = torch.index_select(self.y_pos, dim=0, index=index)
+        self.presence = torch.index_select(self.presence, dim=0, index=index)
+        # 剩下的行都还没有采样到EOS
+        self.eos_col = torch.index_select(self.eos_col, dim=0, index=index)
+        # 去掉所有行都是padding的列
+        kv_start = int(kv_padding_mask.all(dim=0).long().cumprod(dim=0).sum())
+        y_start = int((self.y[:, :self.y_len] == self.pad_token).all(dim=0).long().cumprod(dim=0).sum())
+        self.y = self.y[:, y_start:]
+        self.y_len -= y_start
+        self.kv_cache.select(index, kv_start)
+        self._sampling_args = self._make_sampling_args(self.sequences, self.y.device)
+        return finished
+
+    def _reset(self):
+        self.sequences = []
+        self.kv_cache = None
+        self._sampling_args = None
+        self.y = None
+        self.y_len = 0
+        self.eos_col = None
+        self.y_pos = None
+        self.presence = None
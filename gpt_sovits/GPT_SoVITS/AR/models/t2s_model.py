@@ -3,7 +3,7 @@
 import os, sys
 now_dir = os.getcwd()
 sys.path.append(now_dir)
-from typing import List
+from typing import Dict, List, Optional, Tuple, Union
 import torch
 from tqdm import tqdm
 
@@ -11,6 +11,7 @@ from gpt_sovits.GPT_SoVITS.AR.models.utils import make_pad_mask
 from gpt_sovits.GPT_SoVITS.AR.models.utils import (
     topk_sampling,
     sample,
+    token_presence,
     logits_to_probs,
     multinomial_sample_one_no_sync,
     dpo_loss,
@@ -39,6 +40,26 @@ default_config = {
 }
 
 
+def quantize_linear(weight:torch.Tensor, bias:Optional[torch.Tensor]=None):
+    '''
+    Quantize the weight of a linear layer to int8 (symmetric, per output channel)
+        and pack it for `torch.ops.quantized.linear_dynamic`, the activations are quantized on the fly.
+    '''
+    weight = weight.detach().float().cpu()
+    scale = (weight.abs().amax(dim=1) / 127).clamp(min=1e-8).double()
+    qweight = torch.quantize_per_channel(weight, scale, torch.zeros_like(scale, dtype=torch.long), 0, torch.qint8)
+    return torch.ops.quantized.linear_prepack(qweight, bias.detach().float().cpu() if bias is not None else None)
+
+
+@torch.jit.script
+def dynamic_linear(x:torch.Tensor, w:torch.Tensor, b:Optional[torch.Tensor],
+                   packed:Optional[torch.classes.quantized.LinearPackedParamsBase]):
+    # 有int8权重且输入是CPU上的fp32时用动态量化的kernel, 否则用原来的权重
+    if packed is not None and x.device.type == "cpu" and x.dtype == torch.float32:
+        return torch.ops.quantized.linear_dynamic(x.contiguous(), packed, True)
+    return F.linear(x, w, b)
+
+
 @torch.jit.script
 class T2SMLP:
     def __init__(self, w1, b1, w2, b2):
@@ -46,10 +67,18 @@ class T2SMLP:
         self.b1 = b1
         self.w2 = w2
         self.b2 = b2
+        self.w1_packed = torch.jit.annotate(Optional[torch.classes.quantized.LinearPackedParamsBase], None)
+        self.w2_packed = torch.jit.annotate(Optional[torch.classes.quantized.LinearPackedParamsBase], None)
+
+    def set_quantized(self,
+                      w1_packed:Optional[torch.classes.quantized.LinearPackedParamsBase],
+                      w2_packed:Optional[torch.classes.quantized.LinearPackedParamsBase]):
+        self.w1_packed = w1_packed
+        self.w2_packed = w2_packed
 
     def forward(self, x):
-        x = F.relu(F.linear(x, self.w1, self.b1))
-        x = F.linear(x, self.w2, self.b2)
+        x = F.relu(dynamic_linear(x, self.w1, self.b1, self.w1_packed))
+        x = dynamic_linear(x, self.w2, self.b2, self.w2_packed)
         return x
 
 
@@ -84,6 +113,15 @@ class T2SBlock:
         self.norm_w2 = norm_w2
         self.norm_b2 = norm_b2
         self.norm_eps2 = norm_eps2
+        # int8 动态量化的权重, 见 Text2SemanticDecoder.set_dynamic_quantization
+        self.qkv_packed = torch.jit.annotate(Optional[torch.classes.quantized.LinearPackedParamsBase], None)
+        self.out_packed = torch.jit.annotate(Optional[torch.classes.quantized.LinearPackedParamsBase], None)
+
+    def set_quantized(self,
+                      qkv_packed:Optional[torch.classes.quantized.LinearPackedParamsBase],
+                      out_packed:Optional[torch.classes.quantized.LinearPackedParamsBase]):
+        self.qkv_packed = qkv_packed
+        self.out_packed = out_packed
 
     @torch.jit.ignore
     def to_mask(self, x, padding_mask):
@@ -92,7 +130,7 @@ class T2SBlock:
     def process_prompt(self, x, attn_mask : torch.Tensor, padding_mask:torch.Tensor=None):
 
             
-        q, k, v = F.linear(self.to_mask(x, padding_mask), self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+        q, k, v = dynamic_linear(self.to_mask(x, padding_mask), self.qkv_w, self.qkv_b, self.qkv_packed).chunk(3, dim=-1)
 
         batch_size = q.shape[0]
         q_len = q.shape[1]
@@ -110,7 +148,7 @@ class T2SBlock:
 
         attn = attn.permute(2, 0, 1, 3).reshape(batch_size*q_len, self.hidden_dim)
         attn = attn.view(q_len, batch_size, self.hidden_dim).transpose(1, 0)
-        attn = F.linear(self.to_mask(attn, padding_mask), self.out_w, self.out_b)
+        attn = dynamic_linear(self.to_mask(attn, padding_mask), self.out_w, self.out_b, self.out_packed)
 
         x = self.to_mask(x + attn, padding_mask)
         x = F.layer_norm(
@@ -126,12 +164,54 @@ class T2SBlock:
         )
         return x, k_cache, v_cache
 
-    def decode_next_token(self, x, k_cache, v_cache):
-        q, k, v = F.linear(x, self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+    def process_prompt_packed(self, x, attn_masks:List[torch.Tensor], cu_seqlens:List[int]):
+        # x: (1, total_len, hidden_dim), 所有序列首尾相接不做padding, 第i个序列是 [cu_seqlens[i], cu_seqlens[i+1]).
+        # attention只在各自的序列内部计算, attn_masks[i]: (1, 1, seq_len, seq_len) bool, True表示参与attention
+        q, k_cache, v_cache = dynamic_linear(x, self.qkv_w, self.qkv_b, self.qkv_packed).chunk(3, dim=-1)
+
+        attn_list: List[torch.Tensor] = []
+        for i in range(len(attn_masks)):
+            start = cu_seqlens[i]
+            end = cu_seqlens[i + 1]
+            seq_len = end - start
+            q_i = q[:, start:end].view(1, seq_len, self.num_heads, -1).transpose(1, 2)
+            k_i = k_cache[:, start:end].view(1, seq_len, self.num_heads, -1).transpose(1, 2)
+            v_i = v_cache[:, start:end].view(1, seq_len, self.num_heads, -1).transpose(1, 2)
+            attn_i = F.scaled_dot_product_attention(q_i, k_i, v_i, attn_masks[i])
+            attn_list.append(attn_i.transpose(1, 2).reshape(1, seq_len, self.hidden_dim))
+        attn = dynamic_linear(torch.cat(attn_list, dim=1), self.out_w, self.out_b, self.out_packed)
+
+        x = F.layer_norm(
+            x + attn, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1
+        )
+        x = F.layer_norm(
+            x + self.mlp.forward(x),
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        return x, k_cache, v_cache
+
+    def decode_next_token(self, x, k_cache, v_cache, attn_mask:Optional[torch.Tensor]=None):
+        q, k, v = dynamic_linear(x, self.qkv_w, self.qkv_b, self.qkv_packed).chunk(3, dim=-1)
 
         k_cache = torch.cat([k_cache, k], dim=1)
         v_cache = torch.cat([v_cache, v], dim=1)
-        
+        x = self.decode_attention(x, q, k_cache, v_cache, attn_mask)
+        return x, k_cache, v_cache
+
+    def decode_next_token_static(self, x, k_cache, v_cache, kv_len:int, attn_mask:Optional[torch.Tensor]=None):
+        # k_cache, v_cache: 预分配的 (bsz, capacity, hidden_dim), 前 kv_len 个位置有效, 新的kv原地写入
+        q, k, v = dynamic_linear(x, self.qkv_w, self.qkv_b, self.qkv_packed).chunk(3, dim=-1)
+
+        q_len = q.shape[1]
+        k_cache[:, kv_len:kv_len + q_len] = k
+        v_cache[:, kv_len:kv_len + q_len] = v
+        kv_len = kv_len + q_len
+        return self.decode_attention(x, q, k_cache[:, :kv_len], v_cache[:, :kv_len], attn_mask)
+
+    def decode_attention(self, x, q, k_cache, v_cache, attn_mask:Optional[torch.Tensor]=None):
         batch_size = q.shape[0]
         q_len = q.shape[1]
         kv_len = k_cache.shape[1]
@@ -140,12 +220,15 @@ class T2SBlock:
         k = k_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
         v = v_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
 
-
-        attn = F.scaled_dot_product_attention(q, k, v)
+        # attn_mask: (bsz, 1, 1 or q_len, kv_len), True 表示padding
+        if attn_mask is not None:
+            attn = F.scaled_dot_product_attention(q, k, v, ~attn_mask)
+        else:
+            attn = F.scaled_dot_product_attention(q, k, v)
 
         attn = attn.permute(2, 0, 1, 3).reshape(batch_size*q_len, self.hidden_dim)
         attn = attn.view(q_len, batch_size, self.hidden_dim).transpose(1, 0)
-        attn = F.linear(attn, self.out_w, self.out_b)
+        attn = dynamic_linear(attn, self.out_w, self.out_b, self.out_packed)
 
         x = x + attn
         x = F.layer_norm(
@@ -159,7 +242,7 @@ class T2SBlock:
             self.norm_b2,
             self.norm_eps2,
         )
-        return x, k_cache, v_cache
+        return x
 
 
 @torch.jit.script
@@ -180,13 +263,160 @@ class T2STransformer:
             v_cache.append(v_cache_)
         return x, k_cache, v_cache
 
+    def process_prompt_packed(
+        self, x, attn_masks : List[torch.Tensor],
+        cu_seqlens : List[int],
+        ):
+        k_cache : List[torch.Tensor] = []
+        v_cache : List[torch.Tensor] = []
+        for i in range(self.num_blocks):
+            x, k_cache_, v_cache_ = self.blocks[i].process_prompt_packed(x, attn_masks, cu_seqlens)
+            k_cache.append(k_cache_)
+            v_cache.append(v_cache_)
+        return x, k_cache, v_cache
+
     def decode_next_token(
-        self, x, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor]
+        self, x, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor],
+        attn_mask : Optional[torch.Tensor]=None,
     ):
         for i in range(self.num_blocks):
-            x, k_cache[i], v_cache[i] = self.blocks[i].decode_next_token(x, k_cache[i], v_cache[i])
+            x, k_cache[i], v_cache[i] = self.blocks[i].decode_next_token(x, k_cache[i], v_cache[i], attn_mask)
         return x, k_cache, v_cache
 
+    def decode_next_token_static(
+        self, x, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor], kv_len: int,
+        attn_mask : Optional[torch.Tensor]=None,
+    ):
+        for i in range(self.num_blocks):
+            x = self.blocks[i].decode_next_token_static(x, k_cache[i], v_cache[i], kv_len, attn_mask)
+        return x
+
+    def decode_layers_static(
+        self, x, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor], kv_len: int,
+        start: int, end: int, attn_mask : Optional[torch.Tensor]=None,
+    ):
+        # 只运行第 [start, end) 层, 用于投机解码: 前几层作为draft模型, 其余层验证draft的token
+        for i in range(start, end):
+            x = self.blocks[i].decode_next_token_static(x, k_cache[i], v_cache[i], kv_len, attn_mask)
+        return x
+
+
+class T2SKVCache:
+    '''
+    Preallocated kv cache of all layers, new tokens are written in place instead of
+        concatenated to the cache at every step.
+
+    The buffers grow by `chunk_size` positions when full, so the cost of a step
+        doesn't depend on how many tokens are already cached.
+
+    Args:
+        k_cache, v_cache: the kv cache of every layer returned by `process_prompt`, (bsz, kv_len, hidden_dim).
+        padding_mask: optional, (bsz, kv_len) bool, True for the padding positions.
+        capacity: int, the number of positions to preallocate, at least kv_len.
+        chunk_size: int, how many positions are added when the buffers are full.
+    '''
+    def __init__(self,
+                 k_cache:List[torch.Tensor],
+                 v_cache:List[torch.Tensor],
+                 padding_mask:Optional[torch.Tensor]=None,
+                 capacity:int=0,
+                 chunk_size:int=256,
+                 ):
+        self.chunk_size = max(int(chunk_size), 1)
+        self.length:int = k_cache[0].shape[1]
+        self.capacity:int = max(int(capacity), self.length)
+        self.k_cache:List[torch.Tensor] = [self._alloc(item) for item in k_cache]
+        self.v_cache:List[torch.Tensor] = [self._alloc(item) for item in v_cache]
+        # 没有padding时decode不需要mask
+        self.padding_mask:Optional[torch.Tensor] = None
+        if padding_mask is not None:
+            self.padding_mask = torch.ones((padding_mask.shape[0], self.capacity), dtype=torch.bool, device=padding_mask.device)
+            self.padding_mask[:, :self.length] = padding_mask
+
+    @property
+    def batch_size(self)->int:
+        return self.k_cache[0].shape[0]
+
+    def _alloc(self, item:torch.Tensor)->torch.Tensor:
+        buffer = torch.empty((item.shape[0], self.capacity, item.shape[2]), dtype=item.dtype, device=item.device)
+        buffer[:, :item.shape[1]] = item
+        return buffer
+
+    def reserve(self, num_tokens:int):
+        '''
+        Make sure there is room for `num_tokens` more positions.
+        '''
+        if self.length + num_tokens <= self.capacity:
+            return
+        self.resize(max(self.length + num_tokens, self.capacity + self.chunk_size))
+
+    def resize(self, capacity:int):
+        '''
+        Reallocate the buffers with `capacity` positions, at least the current length.
+        '''
+        self.capacity = max(int(capacity), self.length)
+        self.k_cache = [self._alloc(item[:, :self.length]) for item in self.k_cache]
+        self.v_cache = [self._alloc(item[:, :self.length]) for item in self.v_cache]
+        if self.padding_mask is not None:
+            padding_mask = self.padding_mask[:, :self.length]
+            self.padding_mask = torch.ones((padding_mask.shape[0], self.capacity), dtype=torch.bool, device=padding_mask.device)
+            self.padding_mask[:, :self.length] = padding_mask
+
+    def decode(self, transformer:T2STransformer, x:torch.Tensor, layers:Optional[Tuple[int, int]]=None)->torch.Tensor:
+        '''
+        Run x (bsz, q_len, hidden_dim) through the transformer and append its kv to the cache.
+            the new tokens attend to the cached positions and causally to each other.
+
+        Args:
+            layers: optional, (start, end), only run the layers in [start, end) and write their cache,
+                the cache of the other layers at the new positions is left untouched.
+        '''
+        q_len = x.shape[1]
+        self.reserve(q_len)
+        kv_len = self.length + q_len
+        attn_mask = None
+        if self.padding_mask is not None:
+            self.padding_mask[:, self.length:kv_len] = False
+            attn_mask = self.padding_mask[:, :kv_len].view(self.batch_size, 1, 1, kv_len)
+        if q_len > 1:
+            causal_mask = F.pad(torch.ones((q_len, q_len), dtype=torch.bool, device=x.device).triu(diagonal=1),
+                                (self.length, 0), value=False).view(1, 1, q_len, kv_len)
+            attn_mask = causal_mask if attn_mask is None else attn_mask.logical_or(causal_mask)
+        if layers is None:
+            x = transformer.decode_next_token_static(x, self.k_cache, self.v_cache, self.length, attn_mask)
+        else:
+            x = transformer.decode_layers_static(x, self.k_cache, self.v_cache, self.length, layers[0], layers[1], attn_mask)
+        self.length = kv_len
+        return x
+
+    def truncate(self, length:int):
+        '''
+        Roll back to the first `length` positions, the positions after them are overwritten by the next decode.
+        '''
+        if self.padding_mask is not None and length < self.length:
+            self.padding_mask[:, length:self.length] = True
+        self.length = min(length, self.length)
+
+    def select(self, index:torch.LongTensor, start:int=0):
+        '''
+        Keep the rows in `index` and drop the first `start` positions.
+        '''
+        self.length = self.length - start
+        end = start + self.length
+        self.k_cache = [self._alloc(torch.index_select(item[:, start:end], dim=0, index=index)) for item in self.k_cache]
+        self.v_cache = [self._alloc(torch.index_select(item[:, start:end], dim=0, index=index)) for item in self.v_cache]
+        if self.padding_mask is not None:
+            padding_mask = torch.index_select(self.padding_mask[:, start:end], dim=0, index=index)
+            self.padding_mask = torch.ones((padding_mask.shape[0], self.capacity), dtype=torch.bool, device=padding_mask.device)
+            self.padding_mask[:, :self.length] = padding_mask
+
+    def valid(self)->Tuple[List[torch.Tensor], List[torch.Tensor], Optional[torch.Tensor]]:
+        '''
+        Return the valid part (k_cache, v_cache, padding_mask) of the buffers.
+        '''
+        padding_mask = self.padding_mask[:, :self.length] if self.padding_mask is not None else None
+        return [item[:, :self.length] for item in self.k_cache], [item[:, :self.length] for item in self.v_cache], padding_mask
+
 
 class Text2SemanticDecoder(nn.Module):
     def __init__(self, config, norm_first=False, top_k=3):
@@ -272,6 +502,55 @@ class Text2SemanticDecoder(nn.Module):
             blocks.append(block)
         
         self.t2s_transformer = T2STransformer(self.num_layers, blocks)
+        # int8 动态量化的ar_predict_layer权重, 见 set_dynamic_quantization
+        self.dynamic_quantization:bool = False
+        self.ar_predict_packed = None
+        # 编译好的单步decode, 见 set_compiled_decode
+        self.decode_graph = None
+
+    def set_dynamic_quantization(self, enable:bool=True):
+        '''
+        Run the linear layers of the inference transformer (qkv, out, mlp) and `ar_predict_layer` with int8 weights
+            (per channel) and dynamically quantized activations, only used for fp32 inputs on CPU.
+            The fp32 weights are kept, the model falls back to them on other devices and when disabled.
+        Args:
+            enable: bool, quantize the current weights, or drop the quantized weights.
+        '''
+        if enable == self.dynamic_quantization:
+            return
+        self.dynamic_quantization = enable
+
+        def pack(weight, bias=None):
+            return quantize_linear(weight, bias) if enable else None
+
+        for block in self.t2s_transformer.blocks:
+            block.set_quantized(pack(block.qkv_w, block.qkv_b), pack(block.out_w, block.out_b))
+            block.mlp.set_quantized(pack(block.mlp.w1, block.mlp.b1), pack(block.mlp.w2, block.mlp.b2))
+        self.ar_predict_packed = pack(self.ar_predict_layer.weight, self.ar_predict_layer.bias)
+
+    def set_compiled_decode(self, enable:bool=True, bucket_size:int=256, backend:str="inductor"):
+        '''
+        Decode the tokens of `infer_panel_with_flash_attn_only` with a compiled step (see `T2SDecodeGraph`):
+            embedding, position encoding, all blocks, ar_predict_layer and sampling in one graph.
+            Not used when the int8 dynamic quantization is enabled.
+        Args:
+            enable: bool, create the compiled step (compiled lazily for every kv cache bucket) or drop it.
+            bucket_size: int, the kv cache capacity is rounded up to a multiple of it.
+            backend: str, the torch.compile backend.
+        '''
+        if not enable:
+            self.decode_graph = None
+            return
+        from gpt_sovits.GPT_SoVITS.AR.models.t2s_compile import T2SDecodeGraph
+        graph = self.decode_graph
+        if graph is None or graph.bucket_size != bucket_size or graph.backend != backend:
+            self.decode_graph = T2SDecodeGraph(self, bucket_size, backend)
+
+    def predict_logits(self, x:torch.Tensor)->torch.Tensor:
+        '''
+        `ar_predict_layer` for inference, with the int8 weights if `set_dynamic_quantization` is enabled.
+        '''
+        return dynamic_linear(x, self.ar_predict_layer.weight, self.ar_predict_layer.bias, self.ar_predict_packed)
 
     def make_input_data(self, x, x_lens, y, y_lens, bert_feature):
         x = self.ar_text_embedding(x)
@@ -506,19 +785,42 @@ class Text2SemanticDecoder(nn.Module):
         # 错位
         return targets[:, :-1], targets[:, 1:]
 
-    def infer_panel_batch_infer_with_flash_attn(
+    def embed_text(
         self,
-        x:torch.LongTensor,  #####全部文本token
+        x:torch.LongTensor,
+        bert_feature:torch.Tensor,
+    )->torch.Tensor:
+        """
+        Embed the phones (x_len,) and bert features (1024, x_len) of one item, without the position embedding.
+        """
+        return self.ar_text_embedding(x) + self.bert_proj(bert_feature.transpose(0, 1))
+
+    def prefill_batch(
+        self,
+        x:List[torch.LongTensor],  #####全部文本token
         x_lens:torch.LongTensor,
-        prompts:torch.LongTensor,  ####参考音频token
-        bert_feature:torch.LongTensor,
-        top_k: int = -100,
-        top_p: int = 100,
-        early_stop_num: int = -1,
-        temperature: float = 1.0,
-        repetition_penalty: float = 1.35,
-        **kwargs,
+        prompts:Union[torch.LongTensor, List[torch.LongTensor], None],  ####参考音频token
+        bert_feature:List[torch.Tensor],
+        max_len:int=None,
+        packed:bool=False,
     ):
+        """
+        Embed a batch of texts and prompts, and run the whole prompt through the transformer.
+
+        Args:
+            prompts: (bsz, y_len) if all items share one reference, or a list of non-empty 1-D tensors
+                of different lengths (one reference for each item), or None if ref free.
+                the prompts are left padded, so the last prompt token of every item is in the last column.
+            packed: run the transformer on the concatenated items without padding, see `prefill_packed`.
+                ignored if ref free.
+        Returns:
+            xy_dec: the hidden states of the prompt, (bsz, src_len, model_dim).
+            k_cache, v_cache: the kv cache of every layer.
+            kv_padding_mask: (bsz, src_len) bool, True for the padding positions.
+            y: the prompt semantic tokens, (bsz, y_len), left padded with the first token of each item,
+                which doesn't change the repetition penalty.
+            y_lens: (bsz,), the prompt length of each item, 0 if ref free.
+        """
         # # fp16 会对结果产生影响（和没pad相比）
         # bert_feature_dtype = bert_feature[0].dtype
         # if not hasattr(self.bert_proj, "dtype"):
@@ -527,21 +829,20 @@ class Text2SemanticDecoder(nn.Module):
 
         ## 先对phones进行embedding、对bert_features进行project，再pad到相同长度（padding策略会影响T2S模型生成的结果。）
         ## pad之后再进行Linear会有误差（和没pad相比），就离谱。。。
-        max_len = kwargs.get("max_len",x_lens.max())
+        if max_len is None:
+            max_len = x_lens.max()
         # for x_item, bert_item in zip(x, bert_feature):
         #     max_len = max(max_len, x_item.shape[0], bert_item.shape[1])
-        x_list = [self.ar_text_embedding(item) for item in x]
+        x_list = [self.embed_text(x_item, bert_item) for x_item, bert_item in zip(x, bert_feature)]
+        if packed and prompts is not None:
+            # x可能是已经pad过的batch, 只打包每一项的有效部分
+            x_list = [item[:int(x_len)] for item, x_len in zip(x_list, x_lens)]
+            return self.prefill_packed(x_list, prompts, int(max_len))
         x_list = [F.pad(item,(0,0,0,max_len-item.shape[0]),value=0) if item.shape[0]<max_len else item for item in x_list]
         x = torch.stack(x_list, dim=0)
 
-        bert_features_list = [self.bert_proj(item.transpose(0, 1)) for item in bert_feature]
-        bert_features_list = [F.pad(item,(0,0,0,max_len-item.shape[0]), value=0) if item.shape[0]<max_len else item for item in bert_features_list]
-        bert_feature = torch.stack(bert_features_list, dim=0)
-
-
         # bert_feature = self.bert_proj(bert_feature.transpose(1, 2).float()).to(dtype=bert_feature_dtype)
         # x = self.ar_text_embedding(x)
-        x = x + bert_feature 
         x = self.ar_text_position(x)
 
         # AR Decoder
@@ -549,38 +850,40 @@ class Text2SemanticDecoder(nn.Module):
         
         x_len = x.shape[1]
         x_attn_mask = torch.zeros((x_len, x_len), dtype=torch.bool)
-        stop = False
 
-        k_cache = None
-        v_cache = None
         ###################  first step ##########################
-        if y is not None:
-            y_emb = self.ar_audio_embedding(y)
-            y_len = y_emb.shape[1]
-            prefix_len = y.shape[1]
-            y_lens = torch.LongTensor([y_emb.shape[1]]*y_emb.shape[0]).to(x.device)
-            y_pos = self.ar_audio_position(y_emb)
+        if isinstance(y, torch.Tensor):
+            y_pos = self.ar_audio_position(self.ar_audio_embedding(y))
+            y_len = y_pos.shape[1]
+            y_lens = torch.LongTensor([y_len]*y_pos.shape[0]).to(x.device)
+            xy_pos = torch.concat([x, y_pos], dim=1)
+        elif y is not None:
+            # 每一行的参考音频不同: 位置编码各自从0开始, 再左pad到相同长度
+            y_lens = torch.LongTensor([item.shape[-1] for item in y]).to(x.device)
+            y_len = int(y_lens.max())
+            y_pos = [self.ar_audio_position(self.ar_audio_embedding(item.unsqueeze(0))) for item in y]
+            y_pos = torch.concat([F.pad(item, (0, 0, y_len - item.shape[1], 0), value=0) for item in y_pos], dim=0)
+            y = torch.stack([torch.concat([item[:1].expand(y_len - item.shape[-1]), item]) for item in y], dim=0)
             xy_pos = torch.concat([x, y_pos], dim=1)
-            ref_free = False
         else:
             y_emb = None
             y_len = 0
-            prefix_len = 0
             y_lens = torch.LongTensor([y_len]*x.shape[0]).to(x.device)
             y_pos = None
             xy_pos = x
             y = torch.zeros(x.shape[0], 0, dtype=torch.int, device=x.device)
-            ref_free = True
 
 
         ##### create mask #####
         bsz = x.shape[0]
         src_len = x_len + y_len
-        y_paddind_mask = make_pad_mask(y_lens, y_len)
+        # prompt是左pad的
+        y_paddind_mask = make_pad_mask(y_lens, y_len).flip(1)
         x_paddind_mask = make_pad_mask(x_lens, max_len)
         
         # (bsz, x_len + y_len)
-        xy_padding_mask = torch.concat([x_paddind_mask, y_paddind_mask], dim=1)
+        xy_padding_mask = torch.concat([x_paddind_mask, y_paddind_mask], dim=1).to(x.device)
+        kv_padding_mask = xy_padding_mask
 
         x_mask = F.pad(
             x_attn_mask,
@@ -593,95 +896,189 @@ class Text2SemanticDecoder(nn.Module):
             value=False,
         )
         
-        xy_mask = torch.concat([x_mask, y_mask], dim=0).view(1 , src_len, src_len).expand(bsz, -1, -1).to(x.device)
-        # xy_mask = torch.triu(torch.ones(src_len, src_len, dtype=torch.bool, device=x.device), diagonal=1).view(1 , src_len, src_len).expand(bsz, -1, -1).to(x.device)
-        _xy_padding_mask = xy_padding_mask.view(bsz, 1, src_len).expand(-1, src_len, src_len)
-        xy_attn_mask = xy_mask.logical_or(_xy_padding_mask)
-        xy_attn_mask = xy_attn_mask.unsqueeze(1).expand(-1, self.num_head, -1, -1)
-        new_attn_mask = torch.zeros_like(xy_attn_mask, dtype=x.dtype)
-        xy_attn_mask = new_attn_mask.masked_fill(xy_attn_mask, float("-inf"))
+        xy_mask = torch.concat([x_mask, y_mask], dim=0).view(1, 1, src_len, src_len).to(x.device)
+        # (bsz, 1, src_len, src_len) bool, 在head维度上广播, 传给SDPA的bool mask中True表示参与attention.
+        # padding位置的输出不会被任何有效位置用到, 不需要在每一层都乘0
+        xy_attn_mask = xy_mask.logical_or(xy_padding_mask.view(bsz, 1, 1, src_len)).logical_not()
+
+        # 参考音频的部分(prompt文本的phones和prompt_semantic)每个片段都一样, 但它的K/V不能在片段之间复用:
+        # phones部分(prompt phones + 目标文本)是双向attention, prompt_semantic又attend所有phones,
+        # 所以从第二层开始prompt位置的K/V都依赖各片段自己的文本. 只有第一层的K/V与文本无关, 复用省下的计算很少.
+        xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None)
+        return xy_dec, k_cache, v_cache, kv_padding_mask, y, y_lens
+
+    def prefill_packed(
+        self,
+        x_list:List[torch.Tensor],
+        prompts:Union[torch.LongTensor, List[torch.LongTensor]],
+        max_len:int,
+    ):
+        """
+        Packed version of `prefill_batch`: the items are concatenated into one sequence without padding,
+            and attention is computed inside each item, so the cost only depends on the real tokens.
+
+        Args:
+            x_list: the text embedding of each item without the position embedding, see `embed_text`.
+            prompts: same as `prefill_batch`.
+            max_len: the padded text length of the returned kv cache.
+        Returns:
+            same as `prefill_batch`, the kv cache is scattered back to the padded layout [x, pad][pad, y].
+        """
+        bsz = len(x_list)
+        device = x_list[0].device
+        if isinstance(prompts, torch.Tensor):
+            y_pos_list = list(self.ar_audio_position(self.ar_audio_embedding(prompts)).split(1, dim=0))
+            prompts = list(prompts)
+        else:
+            y_pos_list = [self.ar_audio_position(self.ar_audio_embedding(item.unsqueeze(0))) for item in prompts]
+        x_lens = [item.shape[0] for item in x_list]
+        y_lens = [item.shape[-1] for item in prompts]
+        y_len = max(y_lens)
+        src_len = max_len + y_len
+
+        xy_pos = torch.concat([torch.concat([self.ar_text_position(x_item.unsqueeze(0)), y_pos], dim=1)
+                               for x_item, y_pos in zip(x_list, y_pos_list)], dim=1)
+        cu_seqlens = [0]
+        # 每个序列的mask: 文本部分双向, 语音部分因果; 长度相同的序列共用同一个mask
+        masks:Dict[Tuple[int, int], torch.Tensor] = {}
+        attn_masks = []
+        for x_len_i, y_len_i in zip(x_lens, y_lens):
+            cu_seqlens.append(cu_seqlens[-1] + x_len_i + y_len_i)
+            if (x_len_i, y_len_i) not in masks:
+                seq_len = x_len_i + y_len_i
+                mask = torch.ones((seq_len, seq_len), dtype=torch.bool, device=device)
+                mask[:x_len_i, x_len_i:] = False
+                mask[x_len_i:, x_len_i:] = torch.tril(mask[x_len_i:, x_len_i:])
+                masks[(x_len_i, y_len_i)] = mask.view(1, 1, seq_len, seq_len)
+            attn_masks.append(masks[(x_len_i, y_len_i)])
+
+        xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt_packed(xy_pos, attn_masks, cu_seqlens)
+
+        # 还原成和prefill_batch相同的padding布局, 之后的decode不需要区分
+        index = torch.concat([torch.concat([torch.arange(x_len_i), torch.arange(src_len - y_len_i, src_len)]) + i * src_len
+                              for i, (x_len_i, y_len_i) in enumerate(zip(x_lens, y_lens))]).to(device)
+
+        def unpack(item:torch.Tensor)->torch.Tensor:
+            return item.new_zeros((bsz * src_len, item.shape[-1])).index_copy_(0, index, item[0]).view(bsz, src_len, -1)
+
+        xy_dec = unpack(xy_dec)
+        k_cache = [unpack(item) for item in k_cache]
+        v_cache = [unpack(item) for item in v_cache]
+        kv_padding_mask = torch.ones((bsz * src_len,), dtype=torch.bool, device=device).index_fill_(0, index, False).view(bsz, src_len)
+        y = torch.stack([torch.concat([item[:1].expand(y_len - item.shape[-1]), item]) for item in prompts], dim=0)
+        y_lens = torch.LongTensor(y_lens).to(device)
+        return xy_dec, k_cache, v_cache, kv_padding_mask, y, y_lens
 
-        xy_padding_mask = ~xy_padding_mask.view(bsz, src_len, 1).expand(-1, -1, self.model_dim)
-        xy_padding_mask = xy_padding_mask.to(dtype=x.dtype)
+    def infer_panel_batch_infer_with_flash_attn(
+        self,
+        x:torch.LongTensor,  #####全部文本token
+        x_lens:torch.LongTensor,
+        prompts:Union[torch.LongTensor, List[torch.LongTensor], None],  ####参考音频token
+        bert_feature:torch.LongTensor,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: Union[int, List[int]] = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        **kwargs,
+    ):
+        # prompts可以是各行长度不同的参考音频token列表, 不同音色的片段可以放进同一个batch
+        max_len = kwargs.get("max_len",x_lens.max())
+        # threading.Event, 被设置后尽快结束decode
+        cancel_event = kwargs.get("cancel_event", None)
+        # packed_prefill: prefill时不做padding, 长度差异大的batch计算量更少
+        xy_dec, k_cache, v_cache, kv_padding_mask, y, y_lens = self.prefill_batch(x, x_lens, prompts, bert_feature, max_len,
+                                                                                 packed=kwargs.get("packed_prefill", False))
+        ref_free = prompts is None
+        prefix_len = y.shape[1]
+        # 每一行左pad的长度, 返回结果时去掉
+        y_starts = (prefix_len - y_lens).tolist()
+        # 每一行出现过的token, 每步只更新新token, repetition penalty不用再遍历整个历史
+        presence = token_presence(y, self.vocab_size)
+        bsz = y.shape[0]
+        # early_stop_num可以是每一行各自的上限(例如按估计的长度), -1表示不限制
+        if not isinstance(early_stop_num, (list, tuple)):
+            early_stop_num = [early_stop_num]*bsz
+        # 每一行最后一步的下标, 到达后该行按当前长度结束
+        row_caps = [1499 if num == -1 else min(int(num), 1499) for num in early_stop_num]
+        # 预分配kv cache, decode时原地写入, 不再每一步拼接整个cache
+        max_steps = max(row_caps) + 1
+        kv_cache = T2SKVCache(k_cache, v_cache, kv_padding_mask, capacity=kv_padding_mask.shape[1] + max_steps)
+        # 历史token也预分配, 每步写入一列
+        y = F.pad(y, (0, max_steps), value=0)
+        # EOS只记录在device上(采样到EOS的步数, -1表示还没有), 每隔sync_every步才同步到host检查一次,
+        # 已经结束的序列最多多算sync_every-1步, 结果按记录的步数截断
+        sync_every = max(int(kwargs.get("sync_every", 8)), 1)
+        eos_idx = torch.full((bsz,), -1, dtype=torch.long, device=y.device)
 
         ###### decode #####
-        y_list = [None]*y.shape[0]
-        batch_idx_map = list(range(y.shape[0]))
-        idx_list = [None]*y.shape[0]
-        for idx in tqdm(range(1500)):
-            if idx == 0:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, xy_padding_mask)
-            else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache)
-
-            logits = self.ar_predict_layer(
+        y_list = [None]*bsz
+        batch_idx_map = list(range(bsz))
+        idx_list = [None]*bsz
+        for idx in range(1500):
+            if idx != 0:
+                xy_dec = kv_cache.decode(self.t2s_transformer, xy_pos)
+
+            logits = self.predict_logits(
                 xy_dec[:, -1]
             )
 
             if idx == 0:
-                xy_attn_mask = None
                 logits = logits[:, :-1]
                 
             samples = sample(
-                logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
+                logits, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature,
+                presence=presence,
             )[0]
 
-            y = torch.concat([y, samples], dim=1)
-            
-            ####### 移除batch中已经生成完毕的序列,进一步优化计算量
-            reserved_idx_of_batch_for_y = None
-            if (self.EOS in samples[:, 0]) or \
-                (self.EOS in torch.argmax(logits, dim=-1)):  ###如果生成到EOS，则停止
-                    l = samples[:, 0]==self.EOS
-                    removed_idx_of_batch_for_y = torch.where(l==True)[0].tolist()
-                    reserved_idx_of_batch_for_y = torch.where(l==False)[0]
-                    # batch_indexs = torch.tensor(batch_idx_map, device=y.device)[removed_idx_of_batch_for_y]
-                    for i in removed_idx_of_batch_for_y:
-                        batch_index = batch_idx_map[i]
-                        idx_list[batch_index] = idx - 1
-                        y_list[batch_index] = y[i, :-1]
-                
-                    batch_idx_map = [batch_idx_map[i] for i in reserved_idx_of_batch_for_y.tolist()]
-                
-            # 只保留batch中未生成完毕的序列 
-            if reserved_idx_of_batch_for_y is not None:
-                # index = torch.LongTensor(batch_idx_map).to(y.device)
-                y = torch.index_select(y, dim=0, index=reserved_idx_of_batch_for_y)
-                if k_cache is not None :
-                    for i in range(len(k_cache)):
-                        k_cache[i] = torch.index_select(k_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
-                        v_cache[i] = torch.index_select(v_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
-                
-                
-            if (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num) or idx==1499:
-                print("use early stop num:", early_stop_num)
-                stop = True
-                for i, batch_index in enumerate(batch_idx_map):
+            y[:, prefix_len + idx] = samples[:, 0]
+            presence.scatter_(1, samples.long(), True)
+            eos_idx.masked_fill_((samples[:, 0] == self.EOS).logical_and(eos_idx < 0), idx)
+
+            cancelled = cancel_event is not None and cancel_event.is_set()
+            capped = [idx >= cap for cap in row_caps]
+            stop = all(capped) or cancelled
+            if stop or any(capped) or (idx + 1) % sync_every == 0:
+                ####### 移除batch中已经生成完毕的序列,进一步优化计算量
+                reserved = []
+                for i, eos in enumerate(eos_idx.tolist()):
                     batch_index = batch_idx_map[i]
-                    idx_list[batch_index] = idx
-                    y_list[batch_index] = y[i, :-1]
-                
-            if not (None in idx_list):
-                stop = True
-                
-            if stop:
-                if y.shape[1]==0:
-                    y = torch.concat([y, torch.zeros_like(samples)], dim=1)
-                    print("bad zero prediction")
-                print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
-                break
+                    if eos >= 0:
+                        idx_list[batch_index] = eos - 1
+                        y_list[batch_index] = y[i, y_starts[batch_index]:prefix_len + eos]
+                    elif stop or capped[i]:
+                        # 达到最大长度或请求被取消时, 剩下的序列按当前长度结束
+                        idx_list[batch_index] = idx
+                        y_list[batch_index] = y[i, y_starts[batch_index]:prefix_len + idx]
+                    else:
+                        reserved.append(i)
+                if cancelled:
+                    print("T2S decoding cancelled")
+                elif any(capped):
+                    print(f"use early stop num: {max(cap for cap, done in zip(row_caps, capped) if done)}")
+                if stop or len(reserved) == 0:
+                    print(f"T2S Decoding EOS [{prefix_len} -> {prefix_len + idx + 1}]")
+                    break
+
+                # 只保留batch中未生成完毕的序列
+                if len(reserved) < len(batch_idx_map):
+                    index = torch.LongTensor(reserved).to(y.device)
+                    y = torch.index_select(y, dim=0, index=index)
+                    y_lens = torch.index_select(y_lens, dim=0, index=index)
+                    presence = torch.index_select(presence, dim=0, index=index)
+                    eos_idx = torch.index_select(eos_idx, dim=0, index=index)
+                    kv_cache.select(index)
+                    batch_idx_map = [batch_idx_map[i] for i in reserved]
+                    row_caps = [row_caps[i] for i in reserved]
 
             ####################### update next step ###################################
-            y_emb = self.ar_audio_embedding(y[:, -1:])
-            xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[:, y_len + idx].to( dtype= y_emb.dtype,device=y_emb.device)            
-
-        if (None in idx_list):
-            for i in range(x.shape[0]):
-                if idx_list[i] is None:
-                    idx_list[i] = 1500-1  ###如果没有生成到EOS，就用最大长度代替
-                    
+            y_emb = self.ar_audio_embedding(y[:, prefix_len + idx:prefix_len + idx + 1])
+            # 每一行的位置接着各自的prompt
+            pe = self.ar_audio_position.pe[0, y_lens + idx].unsqueeze(1).to(dtype=y_emb.dtype, device=y_emb.device)
+            xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * pe
+
         if ref_free:
-            return y_list, [0]*x.shape[0]
+            return y_list, [0]*bsz
         return y_list, idx_list
     
     def infer_panel_0307(self,
@@ -691,21 +1088,26 @@ class Text2SemanticDecoder(nn.Module):
         bert_feature:torch.LongTensor,
         top_k: int = -100,
         top_p: int = 100,
-        early_stop_num: int = -1,
+        early_stop_num: Union[int, List[int]] = -1,
         temperature: float = 1.0,
         repetition_penalty: float = 1.35,
         **kwargs
         ):
         y_list = []
         idx_list = []
+        # draft_layers > 0: 投机解码, 见 infer_panel_speculative
+        infer_panel = self.infer_panel_speculative if kwargs.get("draft_layers", 0) > 0 \
+                        else self.infer_panel_with_flash_attn_only
+        if not isinstance(early_stop_num, (list, tuple)):
+            early_stop_num = [early_stop_num]*len(x)
         for i in range(len(x)):
-            y, idx = self.infer_panel_with_flash_attn_only(x[i].unsqueeze(0), 
+            y, idx = infer_panel(x[i].unsqueeze(0), 
                                                   x_lens[i], 
                                                   prompts[i].unsqueeze(0), 
                                                   bert_feature[i].unsqueeze(0), 
                                                   top_k, 
                                                   top_p, 
-                                                  early_stop_num, 
+                                                  early_stop_num[i], 
                                                   temperature,
                                                   repetition_penalty,
                                                   **kwargs)
@@ -727,8 +1129,35 @@ class Text2SemanticDecoder(nn.Module):
         repetition_penalty: float = 1.35,
         **kwargs
     ):
-        x = self.ar_text_embedding(x)
-        x = x + self.bert_proj(bert_feature.transpose(1, 2))
+        for y, idx, finished in self.infer_panel_stream(x, x_lens, prompts, bert_feature, top_k, top_p,
+                                                        early_stop_num, temperature, repetition_penalty, **kwargs):
+            pass
+        return y, idx
+
+    def infer_panel_stream(
+        self,
+        x:torch.LongTensor,  #####全部文本token
+        x_lens:torch.LongTensor,
+        prompts:torch.LongTensor,  ####参考音频token
+        bert_feature:torch.LongTensor,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        **kwargs
+    ):
+        '''
+        Same as `infer_panel_with_flash_attn_only`, but yields the semantic tokens decoded so far
+            every time the stop flag is synchronized to the host (every `sync_every` steps).
+
+        Yields:
+            (y, idx, finished): y[:, -idx:] (all of y if idx is 0) are the semantic tokens decoded so far,
+                the last yield has finished=True and is the result of `infer_panel_with_flash_attn_only`.
+                A yielded prefix never changes afterwards.
+        '''
+        cancel_event = kwargs.get("cancel_event", None)
+        x = torch.stack([self.embed_text(x_item, bert_item) for x_item, bert_item in zip(x, bert_feature)], dim=0)
         x = self.ar_text_position(x)
 
         # AR Decoder
@@ -743,10 +1172,9 @@ class Text2SemanticDecoder(nn.Module):
         v_cache = None
         ###################  first step ##########################
         if y is not None:
-            y_emb = self.ar_audio_embedding(y)
-            y_len = y_emb.shape[1]
+            y_pos = self.ar_audio_position(self.ar_audio_embedding(y))
+            y_len = y_pos.shape[1]
             prefix_len = y.shape[1]
-            y_pos = self.ar_audio_position(y_emb)
             xy_pos = torch.concat([x, y_pos], dim=1)
             ref_free = False
         else:
@@ -757,6 +1185,7 @@ class Text2SemanticDecoder(nn.Module):
             xy_pos = x
             y = torch.zeros(x.shape[0], 0, dtype=torch.int, device=x.device)
             ref_free = True
+        presence = token_presence(y, self.vocab_size)
 
         bsz = x.shape[0]
         src_len = x_len + y_len
@@ -770,46 +1199,221 @@ class Text2SemanticDecoder(nn.Module):
             (x_len, 0),
             value=False,
         )
-        xy_attn_mask = torch.concat([x_attn_mask_pad, y_attn_mask], dim=0).unsqueeze(0).expand(bsz*self.num_head, -1, -1).view(bsz, self.num_head, src_len, src_len).to(x.device)
-        new_attn_mask = torch.zeros_like(xy_attn_mask, dtype=x.dtype)
-        xy_attn_mask = new_attn_mask.masked_fill(xy_attn_mask, float("-inf"))
-        for idx in tqdm(range(1500)):
+        # (1, 1, src_len, src_len) bool, True表示参与attention
+        xy_attn_mask = torch.concat([x_attn_mask_pad, y_attn_mask], dim=0).view(1, 1, src_len, src_len).logical_not().to(x.device)
+        max_steps = min(early_stop_num + 2 if early_stop_num != -1 else 1500, 1500)
+        # 历史token预分配, 每步写入一列
+        y = F.pad(y, (0, max_steps), value=0)
+        # 停止的步数只记录在device上, 每隔sync_every步才同步到host检查一次, 结果按记录的步数截断
+        sync_every = max(int(kwargs.get("sync_every", 8)), 1)
+        eos_idx = torch.full((), -1, dtype=torch.long, device=y.device)
+        kv_cache = None
+        # 编译好的单步decode(见 set_compiled_decode), int8量化时不使用
+        decode_graph = self.decode_graph if not self.dynamic_quantization else None
+        for idx in range(1500):
             if xy_attn_mask is not None:
                 xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None)
+                kv_cache = T2SKVCache(k_cache, v_cache, capacity=src_len + max_steps)
+            elif decode_graph is not None:
+                # embedding, 所有层, ar_predict_layer 和采样在同一个图里, presence也在图里更新
+                positions = torch.full((bsz,), y_len + idx - 1, dtype=torch.long, device=y.device)
+                samples, logits = decode_graph.step(kv_cache, y[:, prefix_len + idx - 1:prefix_len + idx], positions, presence,
+                                                    top_k, top_p, temperature, repetition_penalty)
             else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache)
+                xy_dec = kv_cache.decode(self.t2s_transformer, xy_pos)
 
-            logits = self.ar_predict_layer(
-                xy_dec[:, -1]
-            )
+            if idx == 0 or decode_graph is None:
+                logits = self.predict_logits(
+                    xy_dec[:, -1]
+                )
 
-            if idx == 0:
-                xy_attn_mask = None
-                logits = logits[:, :-1]
+                if idx == 0:
+                    xy_attn_mask = None
+                    logits = logits[:, :-1]
 
-            samples = sample(
-                logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
-            )[0]
+                samples = sample(
+                    logits, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature,
+                    presence=presence,
+                )[0]
+                presence.scatter_(1, samples.long(), True)
 
-            y = torch.concat([y, samples], dim=1)
+            y[:, prefix_len + idx] = samples[:, 0]
+            eos = (torch.argmax(logits[0], dim=-1) == self.EOS).logical_or(samples[0, 0] == self.EOS)
+            eos_idx.masked_fill_(eos.logical_and(eos_idx < 0), idx)
 
-            if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
+            if early_stop_num != -1 and idx + 1 > early_stop_num:
                 print("use early stop num:", early_stop_num)
                 stop = True
 
-            if torch.argmax(logits, dim=-1)[0] == self.EOS or samples[0, 0] == self.EOS:
+            if cancel_event is not None and cancel_event.is_set():
+                print("T2S decoding cancelled")
                 stop = True
-            if stop:
-                if y.shape[1]==0:
-                    y = torch.concat([y, torch.zeros_like(samples)], dim=1)
-                    print("bad zero prediction")
-                print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
-                break
+
+            if stop or idx == 1499 or (idx + 1) % sync_every == 0:
+                eos = int(eos_idx)
+                if eos >= 0:
+                    idx = eos
+                    stop = True
+                if stop:
+                    print(f"T2S Decoding EOS [{prefix_len} -> {prefix_len + idx + 1}]")
+                    break
+                # 到这一步还没有EOS, 这些token和停止后的结果一致.
+                # 最后一步(1499)采样的token不在最终结果里, 不返回
+                if idx < 1499:
+                    yield y[:, :prefix_len + idx + 1], 0 if ref_free else idx, False
 
             ####################### update next step ###################################
-            y_emb = self.ar_audio_embedding(y[:, -1:])
-            xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[:, y_len + idx].to(dtype=y_emb.dtype,device=y_emb.device)
+            if decode_graph is None:
+                y_emb = self.ar_audio_embedding(y[:, prefix_len + idx:prefix_len + idx + 1])
+                xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[:, y_len + idx].to(dtype=y_emb.dtype,device=y_emb.device)
 
+        # 不包括最后一步采样的token
+        y = y[:, :prefix_len + idx]
+        if ref_free:
+            yield y, 0, True
+        else:
+            yield y, idx - 1, True
+
+    def infer_panel_speculative(
+        self,
+        x:torch.LongTensor,  #####全部文本token
+        x_lens:torch.LongTensor,
+        prompts:torch.LongTensor,  ####参考音频token
+        bert_feature:torch.LongTensor,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        draft_layers: int = 4,
+        num_draft_tokens: int = 4,
+        **kwargs
+    ):
+        """
+        Speculative version of `infer_panel_with_flash_attn_only` for a single sequence.
+
+        The first `draft_layers` layers with the same prediction head are the draft model,
+            it proposes `num_draft_tokens` tokens one by one, then the other layers verify all of them in one forward.
+            The draft layers share the kv cache with the full model, their work is not repeated by the verification.
+        A draft token is accepted with probability min(1, p/q), p and q being the distributions of the full and
+            the draft model after the repetition penalty, top-k, top-p and temperature, the first rejected one
+            is resampled from max(p - q, 0), so the tokens follow the same distribution as the normal decoding.
+
+        Args:
+            same as `infer_panel_with_flash_attn_only`.
+            draft_layers: int, how many of the first layers are used as the draft model.
+            num_draft_tokens: int, how many tokens the draft model proposes in each round.
+            stats: optional dict in kwargs, the numbers of "rounds", "drafted" and "accepted" tokens are added to it.
+        Returns:
+            (y, idx) same as `infer_panel_with_flash_attn_only`.
+        """
+        cancel_event = kwargs.get("cancel_event", None)
+        stats = kwargs.get("stats", None)
+        num_layers = self.t2s_transformer.num_blocks
+        draft_layers = min(max(int(draft_layers), 1), num_layers)
+        num_draft_tokens = max(int(num_draft_tokens), 1)
+
+        xy_dec, k_cache, v_cache, _, y, y_lens = self.prefill_batch(
+            [x[0]], x_lens.view(-1)[:1], prompts, [bert_feature[0]], x.shape[1])
+        ref_free = prompts is None
+        prefix_len = y.shape[1]
+        y_len = int(y_lens[0])
+        presence = token_presence(y, self.vocab_size)
+
+        max_steps = min(early_stop_num + 2 if early_stop_num != -1 else 1500, 1500)
+        # 历史token预分配, 最后一轮可能多写num_draft_tokens个
+        y = F.pad(y, (0, max_steps + num_draft_tokens + 1), value=0)
+        kv_cache = T2SKVCache(k_cache, v_cache, capacity=k_cache[0].shape[1] + max_steps + num_draft_tokens + 1)
+
+        def embed(token:torch.Tensor, step:int)->torch.Tensor:
+            # token: (1, 1), 第step步采样的token
+            y_emb = self.ar_audio_embedding(token)
+            return y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * \
+                self.ar_audio_position.pe[:, y_len + step].to(dtype=y_emb.dtype, device=y_emb.device)
+
+        sampling = dict(top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature)
+        # 第一个token不能是EOS
+        samples = sample(self.predict_logits(xy_dec[:, -1])[:, :-1], presence=presence, **sampling)[0]
+        y[:, prefix_len] = samples[:, 0]
+        presence.scatter_(1, samples.long(), True)
+
+        idx = 0
+        rounds = drafted = accepted = 0
+        stop = early_stop_num != -1 and idx + 1 > early_stop_num
+        while not stop:
+            if cancel_event is not None and cancel_event.is_set():
+                print("T2S decoding cancelled")
+                break
+            kv_len = kv_cache.length
+            # draft: 逐个生成num_draft_tokens个token, 最后一个token也过一遍draft层, 验证时用于得到额外的一个token
+            token = y[:, prefix_len + idx:prefix_len + idx + 1]
+            draft_presence = presence.clone()
+            hidden = []
+            draft_tokens = []
+            draft_probs = []
+            for j in range(num_draft_tokens + 1):
+                h = kv_cache.decode(self.t2s_transformer, embed(token, idx + j), (0, draft_layers))
+                hidden.append(h)
+                if j == num_draft_tokens:
+                    break
+                token, probs = sample(self.predict_logits(h[:, -1]), presence=draft_presence, **sampling)
+                draft_presence.scatter_(1, token.long(), True)
+                draft_tokens.append(token)
+                draft_probs.append(probs)
+            draft_tokens = torch.concat(draft_tokens, dim=1)[0].long()  # (num_draft_tokens,)
+            draft_probs = torch.concat(draft_probs, dim=0)  # (num_draft_tokens, vocab_size)
+
+            # verify: 剩下的层一次处理所有draft token, 第j行是第j个draft token的目标分布
+            kv_cache.truncate(kv_len)
+            logits = self.predict_logits(
+                kv_cache.decode(self.t2s_transformer, torch.concat(hidden, dim=1), (draft_layers, num_layers))[0]
+            )
+            # 每一行的repetition penalty包括之前的draft token
+            seen = F.one_hot(draft_tokens, presence.shape[1]).cumsum(dim=0) > 0
+            row_presence = presence.expand(num_draft_tokens + 1, -1).clone()
+            row_presence[1:] |= seen
+            bonus, target_probs = sample(logits, presence=row_presence, **sampling)
+
+            p = target_probs[:-1].gather(1, draft_tokens.view(-1, 1))[:, 0]
+            q = draft_probs.gather(1, draft_tokens.view(-1, 1))[:, 0]
+            accept = torch.rand_like(q) * q <= p
+            n = int(accept.int().cumprod(dim=0).sum())
+            if n < num_draft_tokens:
+                residual = (target_probs[n] - draft_probs[n]).clamp(min=0)
+                residual = torch.where(residual.sum() > 0, residual, target_probs[n])
+                next_token = torch.argmax(residual / torch.empty_like(residual).exponential_(1)).view(1)
+            else:
+                next_token = bonus[-1].long()
+            new_tokens = torch.concat([draft_tokens[:n], next_token])
+            eos = (torch.argmax(logits[:n + 1], dim=-1) == self.EOS).logical_or(new_tokens == self.EOS)
+            kv_cache.truncate(kv_len + n + 1)
+            rounds += 1
+            drafted += num_draft_tokens
+            accepted += n
+
+            for j, is_eos in enumerate(eos.tolist()):
+                idx += 1
+                y[:, prefix_len + idx] = new_tokens[j]
+                if is_eos:
+                    stop = True
+                elif early_stop_num != -1 and idx + 1 > early_stop_num:
+                    print("use early stop num:", early_stop_num)
+                    stop = True
+                elif idx == 1499:
+                    stop = True
+                if stop:
+                    break
+            presence.scatter_(1, new_tokens[:j + 1].view(1, -1), True)
+
+        print(f"T2S Decoding EOS [{prefix_len} -> {prefix_len + idx + 1}]")
+        if rounds > 0:
+            print(f"T2S speculative decoding: {accepted}/{drafted} draft tokens accepted in {rounds} rounds")
+        if stats is not None:
+            stats["rounds"] = stats.get("rounds", 0) + rounds
+            stats["drafted"] = stats.get("drafted", 0) + drafted
+            stats["accepted"] = stats.get("accepted", 0) + accepted
+        # 不包括最后一步采样的token
+        y = y[:, :prefix_len + idx]
         if ref_free:
-            return y[:, :-1], 0
-        return y[:, :-1], idx - 1
+            return y, 0
+        return y, idx - 1
@@ -97,7 +97,7 @@ def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
     return token
 
 
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple, Union
 
 
 def multinomial_sample_one_no_sync(
@@ -150,15 +150,107 @@ def logits_to_probs(
     return probs
 
 
+def token_presence(tokens: torch.Tensor, num_tokens: int) -> torch.Tensor:
+    """
+    (bsz, num_tokens) bool, True for the tokens that appear in each row of `tokens` (bsz, seq_len).
+        update it with `presence.scatter_(1, new_tokens.long(), True)` after every step
+        and pass it to `sample` instead of the whole token history.
+    """
+    presence = torch.zeros((tokens.shape[0], num_tokens), dtype=torch.bool, device=tokens.device)
+    return presence.scatter_(1, tokens.long(), True)
+
+
 def sample(
     logits,
     previous_tokens: Optional[torch.Tensor] = None,
-    **sampling_kwargs,
+    temperature: Union[float, torch.Tensor] = 1.0,
+    top_k: Union[int, torch.Tensor, None] = None,
+    top_p: Union[float, torch.Tensor, None] = None,
+    repetition_penalty: Union[float, torch.Tensor] = 1.0,
+    generators: Optional[List[Optional[torch.Generator]]] = None,
+    max_top_k: Optional[int] = None,
+    presence: Optional[torch.Tensor] = None,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
-    probs = logits_to_probs(
-        logits=logits, previous_tokens=previous_tokens, **sampling_kwargs
-    )
-    idx_next = multinomial_sample_one_no_sync(probs)
+    """
+    Sample the next token of every row, the sampling settings can be scalars or one value per row.
+
+    Same distribution as `logits_to_probs` (repetition penalty -> top-p on the untempered probs -> temperature -> top-k),
+        but the top-k candidates are taken first and top-p only looks at them,
+        the full vocabulary is sorted only when a row has no top-k.
+
+    Args:
+        logits: (bsz, vocab_size), modified in place by the repetition penalty.
+        previous_tokens: (bsz, seq_len), the tokens to apply the repetition penalty to.
+        temperature, top_p, repetition_penalty: float or (bsz,) tensor.
+        top_k: int or (bsz,) tensor, None or <= 0 for no top-k.
+        generators: optional, one torch.Generator (or None for the global RNG) for each row.
+        max_top_k: optional, the max of top_k when it is a tensor, avoids reading it back from the device.
+        presence: optional, (bsz, >= vocab_size) bool from `token_presence`, replaces previous_tokens.
+            the penalty is then applied densely, its cost doesn't grow with the length of the history.
+    Returns:
+        (idx_next, probs): (bsz, 1) int tensor and the (bsz, vocab_size) distribution sampled from.
+    """
+    bsz, vocab_size = logits.shape
+
+    def per_row(value, dtype)->torch.Tensor:
+        if isinstance(value, torch.Tensor):
+            return value.to(dtype=dtype, device=logits.device).view(bsz, 1)
+        return torch.full((bsz, 1), value, dtype=dtype, device=logits.device)
+
+    if (previous_tokens is not None or presence is not None) and \
+            (isinstance(repetition_penalty, torch.Tensor) or repetition_penalty != 1.0):
+        penalty = per_row(repetition_penalty, logits.dtype)
+        if presence is not None:
+            score = torch.where(logits < 0, logits * penalty, logits / penalty)
+            logits.copy_(torch.where(presence[:, :vocab_size], score, logits))
+        else:
+            previous_tokens = previous_tokens.long()
+            score = torch.gather(logits, dim=1, index=previous_tokens)
+            score = torch.where(score < 0, score * penalty, score / penalty)
+            logits.scatter_(dim=1, index=previous_tokens, src=score)
+
+    # 先取top-k候选, 之后只在候选集合上做top-p
+    if top_k is None:
+        top_k = 0
+    if isinstance(top_k, torch.Tensor):
+        top_k = top_k.to(device=logits.device).view(bsz, 1)
+        top_k = torch.where(top_k > 0, top_k, vocab_size)
+        if max_top_k is None:
+            max_top_k = int(top_k.max())
+    else:
+        top_k = top_k if top_k > 0 else vocab_size
+        max_top_k = top_k
+    max_top_k = min(max(max_top_k, 1), vocab_size)
+    candidate_logits, candidate_indices = torch.topk(logits, max_top_k, dim=-1)
+    if isinstance(top_k, torch.Tensor) and max_top_k > 1:
+        positions = torch.arange(max_top_k, device=logits.device).view(1, -1)
+        candidate_logits = candidate_logits.masked_fill(positions >= top_k, -float("Inf"))
+
+    if top_p is not None and (isinstance(top_p, torch.Tensor) or top_p < 1.0):
+        # 累积概率按整个词表的softmax计算, 与先排序整个词表的结果一致
+        top_p = per_row(top_p, torch.float32)
+        probs = torch.gather(torch.nn.functional.softmax(logits.float(), dim=-1), dim=1, index=candidate_indices)
+        indices_to_remove = (torch.cumsum(probs, dim=-1) > top_p).logical_and(top_p < 1.0)
+        indices_to_remove[:, 0] = False  # keep at least one option
+        candidate_logits = candidate_logits.masked_fill(indices_to_remove, -float("Inf"))
+
+    if isinstance(temperature, torch.Tensor):
+        candidate_logits = candidate_logits / per_row(temperature, candidate_logits.dtype).clamp(min=1e-5)
+    else:
+        candidate_logits = candidate_logits / max(temperature, 1e-5)
+    candidate_probs = torch.nn.functional.softmax(candidate_logits, dim=-1)
+
+    q = torch.empty_like(candidate_probs)
+    seeded = [] if generators is None else [i for i, generator in enumerate(generators) if generator is not None]
+    if len(seeded) < bsz:
+        # 没有随机数生成器的行共用一次采样
+        q.exponential_(1)
+    # 有随机数生成器的行各自采样, batch的组成不影响结果, torch.Generator 无法合并成一次调用
+    for i in seeded:
+        q[i].exponential_(1, generator=generators[i])
+    choice = torch.argmax(candidate_probs / q, dim=-1, keepdim=True)
+    idx_next = torch.gather(candidate_indices, dim=1, index=choice).to(dtype=torch.int)
+    probs = torch.zeros_like(logits).scatter_(dim=1, index=candidate_indices, src=candidate_probs.to(dtype=logits.dtype))
     return idx_next, probs
 
 def dpo_loss(policy_chosen_logps: torch.FloatTensor,
@@ -0,0 +1,289 @@
+import threading
+import queue
+from concurrent.futures import Future
+from time import time as ttime
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+from gpt_sovits.GPT_SoVITS.AR.models.t2s_engine import T2SDecodeEngine
+
+
+class T2SJob:
+    '''
+    A single text segment waiting for T2S decoding.
+
+    The scheduler splices jobs coming from different requests into a live
+    `T2SDecodeEngine` batch, and routes the result back to the request
+    through `future`.
+    '''
+    def __init__(self,
+                 t2s_model,
+                 phones:torch.LongTensor,
+                 bert_features:torch.Tensor,
+                 prompt:Optional[torch.LongTensor],
+                 sampling:Dict[str, Any],
+                 cancel_event:Optional[threading.Event]=None,
+                 generator:Optional[torch.Generator]=None,
+                 ):
+        self.t2s_model = t2s_model
+        self.phones = phones
+        self.bert_features = bert_features
+        self.prompt = prompt
+        self.cancel_event = cancel_event
+        self.generator = generator
+        self.early_stop_num:int = sampling.pop("early_stop_num", -1)
+        self.sampling = sampling
+        self.future:Future = Future()
+
+    @property
+    def group_key(self)->tuple:
+        # 同一个模型的片段放进同一个batch, 采样参数可以各不相同
+        return (id(self.t2s_model),)
+
+    @property
+    def cancelled(self)->bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    @property
+    def ref_free(self)->bool:
+        return self.prompt is None
+
+
+class T2SBatchScheduler:
+    '''
+    Central scheduler that merges T2S segments of all in-flight requests into shared decode batches.
+
+    Batching happens at iteration level: between two decode steps, waiting segments
+        are prefilled and join the running batch, finished segments leave it at once.
+
+    Args:
+        max_batch_size: int, the maximum number of segments decoded together.
+        max_wait_ms: float, how long to wait for more segments before the first step when idle.
+        packed_prefill: bool, prefill the admitted segments packed without padding.
+    '''
+    def __init__(self, max_batch_size:int=20, max_wait_ms:float=10, packed_prefill:bool=False):
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.max_wait = max(float(max_wait_ms), 0) / 1000
+        self.packed_prefill = packed_prefill
+        self._queue:queue.Queue = queue.Queue()
+        self._closed = False
+        # submit 和 close 互斥, 关闭之后不会再有片段进入队列
+        self._submit_lock = threading.Lock()
+        self._pending:Dict[tuple, List[T2SJob]] = {}
+        self._engines:Dict[tuple, T2SDecodeEngine] = {}
+        self._running:Dict[tuple, Dict[int, T2SJob]] = {}
+        self.stats:Dict[str, float] = {
+            "steps": 0,
+            "segments": 0,
+            "occupancy": 0.0,
+            "decode_time": 0.0,
+        }
+        self._thread = threading.Thread(target=self._loop, name="T2SBatchScheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self)->int:
+        return self._queue.qsize()
+
+    def submit(self,
+               t2s_model,
+               phones:torch.LongTensor,
+               bert_features:torch.Tensor,
+               prompt:Optional[torch.LongTensor],
+               cancel_event:Optional[threading.Event]=None,
+               generator:Optional[torch.Generator]=None,
+               **sampling,
+               )->Future:
+        '''
+        Submit one segment, returns a future resolving to (pred_semantic, idx).
+            once `cancel_event` is set, the segment leaves the batch and resolves with the tokens decoded so far.
+            `generator` (on the model device) makes the sampled tokens independent of the other segments in the batch.
+        '''
+        job = T2SJob(t2s_model, phones, bert_features, prompt, sampling, cancel_event, generator)
+        with self._submit_lock:
+            if self._closed:
+                raise RuntimeError("T2SBatchScheduler is closed")
+            self._queue.put(job)
+        return job.future
+
+    def infer(self,
+              t2s_model,
+              all_phoneme_ids:List[torch.LongTensor],
+              prompt:Optional[torch.LongTensor],
+              all_bert_features:List[torch.Tensor],
+              cancel_event:Optional[threading.Event]=None,
+              generators:Optional[List[torch.Generator]]=None,
+              **sampling,
+              )->Tuple[List[torch.LongTensor], List[int]]:
+        '''
+        Drop-in replacement of `infer_panel` for one request's batch,
+            blocks until all segments are decoded.
+
+        Args:
+            prompt: the prompt semantic of the reference audio (1-D), or None if ref free.
+            cancel_event: optional threading.Event, set it to stop decoding the segments of this request.
+            generators: optional, one torch.Generator for each segment, for reproducible sampling.
+            early_stop_num (in sampling): int or a list of int (one for each segment).
+        Returns:
+            (pred_semantic_list, idx_list), same as `infer_panel`.
+        '''
+        if generators is None:
+            generators = [None]*len(all_phoneme_ids)
+        early_stop_num = sampling.pop("early_stop_num", -1)
+        if not isinstance(early_stop_num, (list, tuple)):
+            early_stop_num = [early_stop_num]*len(all_phoneme_ids)
+        futures = [self.submit(t2s_model, phones, bert_features, prompt, cancel_event, generator,
+                               early_stop_num=num, **sampling)
+                   for phones, bert_features, generator, num in zip(all_phoneme_ids, all_bert_features, generators, early_stop_num)]
+        results = [future.result() for future in futures]
+        return [item[0] for item in results], [item[1] for item in results]
+
+    def close(self):
+        '''
+        Stop the scheduler, the segments not finished yet fail with RuntimeError.
+        '''
+        with self._submit_lock:
+            self._closed = True
+        self._thread.join(timeout=1)
+        # 调度线程已退出(或fork之后不存在)时在这里结束剩下的片段, 否则由调度线程退出前结束
+        if not self._thread.is_alive():
+            self._fail_all()
+
+    def _fail_all(self):
+        e = RuntimeError("T2SBatchScheduler is closed")
+        for key in set(self._engines.keys()) | set(self._pending.keys()):
+            self._fail(key, e)
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if not job.future.done():
+                job.future.set_exception(e)
+
+    def _collect(self, block:bool)->List[T2SJob]:
+        jobs = []
+        if block:
+            try:
+                jobs.append(self._queue.get(timeout=0.1))
+            except queue.Empty:
+                return jobs
+            deadline = ttime() + self.max_wait
+            while len(jobs) < self.max_batch_size:
+                timeout = deadline - ttime()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+        while True:
+            try:
+                jobs.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def _loop(self):
+        while not self._closed:
+            idle = len(self._engines) == 0 and len(self._pending) == 0
+            for job in self._collect(block=idle):
+                if job.future.set_running_or_notify_cancel():
+                    self._pending.setdefault(job.group_key, []).append(job)
+            self._cancel()
+            self._admit()
+            self._step()
+        self._fail_all()
+
+    def _fail(self, key:tuple, e:Exception):
+        for job in list(self._running.pop(key, {}).values()) + self._pending.pop(key, []):
+            if not job.future.done():
+                job.future.set_exception(e)
+        self._engines.pop(key, None)
+
+    def _finish(self, key:tuple, finished:list):
+        running = self._running[key]
+        for seq_id, pred_semantic, idx in finished:
+            running.pop(seq_id).future.set_result((pred_semantic, idx))
+        self.stats["segments"] += len(finished)
+
+    @torch.no_grad()
+    def _cancel(self):
+        # 已取消的片段直接结束, 空出的位置留给其他请求
+        for key in list(self._pending.keys()):
+            jobs = []
+            for job in self._pending[key]:
+                if job.cancelled:
+                    job.future.set_result((job.phones.new_zeros((0,)), 0))
+                else:
+                    jobs.append(job)
+            if len(jobs) > 0:
+                self._pending[key] = jobs
+            else:
+                del self._pending[key]
+        for key, running in self._running.items():
+            seq_ids = [seq_id for seq_id, job in running.items() if job.cancelled]
+            if len(seq_ids) > 0:
+                self._finish(key, self._engines[key].cancel(seq_ids))
+
+    @torch.no_grad()
+    def _admit(self):
+        for key in list(self._pending.keys()):
+            engine = self._engines.get(key, None)
+            if engine is None:
+                jobs = self._pending[key]
+                engine = T2SDecodeEngine(jobs[0].t2s_model, packed_prefill=self.packed_prefill)
+                self._engines[key] = engine
+                self._running[key] = {}
+            free = self.max_batch_size - engine.num_active
+            if free <= 0:
+                continue
+            jobs, self._pending[key] = self._pending[key][:free], self._pending[key][free:]
+            if len(self._pending[key]) == 0:
+                del self._pending[key]
+
+            # 不同参考音频的片段也一起prefill, 只有无参考的片段要分开
+            groups:Dict[bool, List[T2SJob]] = {}
+            for job in jobs:
+                groups.setdefault(job.ref_free, []).append(job)
+            try:
+                for ref_free, group in groups.items():
+                    device = group[0].phones.device
+                    all_phoneme_ids = [job.phones for job in group]
+                    all_phoneme_lens = torch.LongTensor([item.shape[-1] for item in all_phoneme_ids]).to(device)
+                    seq_ids, finished = engine.add(all_phoneme_ids,
+                                                   all_phoneme_lens,
+                                                   None if ref_free else [job.prompt for job in group],
+                                                   [job.bert_features for job in group],
+                                                   early_stop_num=[job.early_stop_num for job in group],
+                                                   sampling=[job.sampling for job in group],
+                                                   generators=[job.generator for job in group],
+                                                   )
+                    self._running[key].update(zip(seq_ids, group))
+                    self._finish(key, finished)
+            except Exception as e:
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                self._fail(key, e)
+
+    @torch.no_grad()
+    def _step(self):
+        for key in list(self._engines.keys()):
+            engine = self._engines[key]
+            if engine.num_active == 0:
+                if key not in self._pending:
+                    del self._engines[key]
+                    del self._running[key]
+                continue
+            t0 = ttime()
+            try:
+                self.stats["occupancy"] += engine.num_active
+                finished = engine.step()
+            except Exception as e:
+                self._fail(key, e)
+                continue
+            self._finish(key, finished)
+            self.stats["steps"] += 1
+            self.stats["decode_time"] += ttime() - t0
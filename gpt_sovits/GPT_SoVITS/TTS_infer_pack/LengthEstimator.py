@@ -0,0 +1,71 @@
+import math
+import threading
+from typing import Dict, Hashable, Tuple
+
+
+class SemanticLengthEstimator:
+    '''
+    Cheap estimate of how many semantic tokens the T2S model decodes for a segment,
+        from its phone count and the tokens-per-phone ratio observed so far.
+
+    The ratio is tracked per (key, language), the key is usually the character or the T2S model, as an exponential moving average of the finished segments,
+        a new model/language starts from `default_ratio`.
+    The estimate is used to bucket the segments of a request by their decode length,
+        and to cap the decode steps of every segment (see `step_cap`), which also sizes the preallocated buffers.
+
+    Args:
+        default_ratio: float, tokens per phone before any segment of the model/language has been decoded.
+        momentum: float, the weight of the history in the moving average.
+        cap_ratio: float, the step cap is `estimate * cap_ratio + cap_margin`, 0 disables the cap.
+        cap_margin: int, added to the step cap, so short segments keep enough room.
+    '''
+    def __init__(self, default_ratio:float=2.5, momentum:float=0.9, cap_ratio:float=0, cap_margin:int=50):
+        self.default_ratio = float(default_ratio)
+        self.momentum = min(max(float(momentum), 0), 1)
+        self.cap_ratio = max(float(cap_ratio), 0)
+        self.cap_margin = max(int(cap_margin), 0)
+        # (model, language) -> (tokens per phone, 已统计的片段数)
+        self._ratios:Dict[Tuple[Hashable, str], Tuple[float, int]] = {}
+        # 并发的请求会同时更新
+        self._lock = threading.Lock()
+
+    def ratio(self, lang:str, key:Hashable=None)->float:
+        return self._ratios.get((key, lang), (self.default_ratio, 0))[0]
+
+    def estimate(self, num_phones:int, lang:str, key:Hashable=None)->float:
+        '''
+        The expected number of semantic tokens of a segment with `num_phones` phones.
+        '''
+        return num_phones * self.ratio(lang, key)
+
+    def step_cap(self, num_phones:int, lang:str, key:Hashable=None, max_steps:int=-1)->int:
+        '''
+        The early stop number of a segment: at most `max_steps` (-1 for no limit),
+            tightened to the estimated length when the cap is enabled.
+        '''
+        if self.cap_ratio <= 0:
+            return max_steps
+        cap = math.ceil(self.estimate(num_phones, lang, key) * self.cap_ratio) + self.cap_margin
+        return cap if max_steps == -1 else min(cap, max_steps)
+
+    def update(self, num_phones:int, num_tokens:int, lang:str, key:Hashable=None):
+        '''
+        Record the number of tokens decoded for a finished segment.
+            don't record the segments stopped by the step cap or cancelled, their length is not the real one.
+        '''
+        if num_phones <= 0 or num_tokens <= 0:
+            return
+        value = num_tokens / num_phones
+        with self._lock:
+            ratio, count = self._ratios.get((key, lang), (None, 0))
+            if ratio is None:
+                ratio = value
+            else:
+                # 前几个片段用简单平均, 不让默认值或第一个片段的影响太大
+                momentum = min(self.momentum, count / (count + 1))
+                ratio = momentum * ratio + (1 - momentum) * value
+            self._ratios[(key, lang)] = (ratio, count + 1)
+
+    def clear(self):
+        with self._lock:
+            self._ratios.clear()
@@ -0,0 +1,190 @@
+import threading
+from collections import OrderedDict
+from time import time as ttime
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+import torch
+
+
+def module_nbytes(module:torch.nn.Module)->int:
+    return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+
+
+class ModelEntry:
+    '''
+    One loaded model kept by the registry.
+
+    Args:
+        kind: str, e.g. "t2s" or "vits", only the most recent entry of each kind is pinned.
+        model: the loaded torch module.
+        meta: dict, values read from the checkpoint that the caller needs when the model is reused.
+    '''
+    def __init__(self, kind:str, model:torch.nn.Module, meta:Dict[str, Any]):
+        self.kind = kind
+        self.model = model
+        self.meta = meta
+        self.nbytes = module_nbytes(model)
+        self.offloaded = False
+        # 正在使用这个模型的请求数, 见 ModelRegistry.acquire
+        self.users = 0
+
+
+class ModelRegistry:
+    '''
+    LRU registry of loaded models, so switching back to a recently used character doesn't reload it from disk.
+
+    Models are kept on the inference device within `max_device_mb`. When the budget is exceeded,
+        the least recently used ones are offloaded to CPU within `max_offload_mb`, and released beyond that.
+        The most recently requested model of each kind and the models acquired by running requests are never evicted.
+
+    Args:
+        device: the inference device.
+        max_device_mb: float, memory budget of the models kept on the device besides the active ones, -1 for no limit.
+        max_offload_mb: float, memory budget of the models offloaded to CPU, -1 for no limit.
+            ignored when the device is CPU.
+    '''
+    def __init__(self, device, max_device_mb:float=0, max_offload_mb:float=0):
+        self.device = device
+        self._entries:OrderedDict[Hashable, ModelEntry] = OrderedDict()
+        self._lock = threading.RLock()
+        self.stats:Dict[str, float] = {
+            "hits": 0,
+            "offload_hits": 0,
+            "misses": 0,
+            "load_time": 0.0,
+            "offloads": 0,
+            "releases": 0,
+        }
+        self.resize(max_device_mb, max_offload_mb)
+
+    def resize(self, max_device_mb:float=0, max_offload_mb:float=0):
+        '''
+        Change the memory budgets, the models already loaded are kept within the new ones.
+        '''
+        self.max_device = int(max_device_mb * 1024 * 1024) if max_device_mb >= 0 else -1
+        self.max_offload = int(max_offload_mb * 1024 * 1024) if max_offload_mb >= 0 else -1
+        with self._lock:
+            self._evict()
+
+    def _find(self, model:torch.nn.Module)->ModelEntry:
+        for entry in self._entries.values():
+            if entry.model is model:
+                return entry
+        return None
+
+    def acquire(self, model:torch.nn.Module):
+        '''
+        Mark a model as used by a running request, it is not offloaded or released until `release`.
+        '''
+        with self._lock:
+            entry = self._find(model)
+            if entry is not None:
+                entry.users += 1
+
+    def release(self, model:torch.nn.Module):
+        with self._lock:
+            entry = self._find(model)
+            if entry is not None and entry.users > 0:
+                entry.users -= 1
+                self._evict()
+
+    @property
+    def offload_enabled(self)->bool:
+        return str(self.device) != "cpu"
+
+    def get(self, kind:str, key:Hashable, loader:Callable[[], Tuple[torch.nn.Module, Dict[str, Any]]])->Tuple[torch.nn.Module, Dict[str, Any]]:
+        '''
+        Return (model, meta) of `key`, `loader` is called to load it from disk on a miss.
+        '''
+        key = (kind, key)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                if entry.offloaded:
+                    entry.model = entry.model.to(self.device)
+                    entry.offloaded = False
+                    self.stats["offload_hits"] += 1
+                else:
+                    self.stats["hits"] += 1
+                self._entries.move_to_end(key)
+            else:
+                t0 = ttime()
+                model, meta = loader()
+                self.stats["load_time"] += ttime() - t0
+                self.stats["misses"] += 1
+                entry = ModelEntry(kind, model, meta)
+                self._entries[key] = entry
+            self._evict()
+            return entry.model, entry.meta
+
+    def _pinned(self)->set:
+        pinned = {}
+        for key, entry in self._entries.items():
+            pinned[entry.kind] = key
+        return set(pinned.values()) | {key for key, entry in self._entries.items() if entry.users > 0}
+
+    def _evict(self):
+        pinned = self._pinned()
+        device_bytes = sum(entry.nbytes for key, entry in self._entries.items()
+                           if not entry.offloaded and key not in pinned)
+        offload_bytes = sum(entry.nbytes for entry in self._entries.values() if entry.offloaded)
+        released = False
+        for key in list(self._entries.keys()):
+            if self.max_device < 0 or device_bytes <= self.max_device:
+                break
+            entry = self._entries[key]
+            if key in pinned or entry.offloaded:
+                continue
+            device_bytes -= entry.nbytes
+            if self.offload_enabled and (self.max_offload < 0 or offload_bytes + entry.nbytes <= self.max_offload):
+                entry.model = entry.model.to("cpu")
+                entry.offloaded = True
+                offload_bytes += entry.nbytes
+                self.stats["offloads"] += 1
+            else:
+                del self._entries[key]
+                released = True
+                self.stats["releases"] += 1
+        # 超出CPU预算的已卸载模型直接释放
+        for key in list(self._entries.keys()):
+            if self.max_offload < 0 or offload_bytes <= self.max_offload:
+                break
+            entry = self._entries[key]
+            if not entry.offloaded:
+                continue
+            offload_bytes -= entry.nbytes
+            del self._entries[key]
+            released = True
+            self.stats["releases"] += 1
+        if released and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def discard(self, kind:str, key:Hashable):
+        '''
+        Drop a model, the next `get` loads it from disk again.
+        '''
+        with self._lock:
+            if self._entries.pop((kind, key), None) is not None:
+                self.stats["releases"] += 1
+
+    def set_device(self, device):
+        '''
+        Release all models except the active ones, which the caller moves to the new device.
+        '''
+        with self._lock:
+            self.device = device
+            pinned = self._pinned()
+            for key in list(self._entries.keys()):
+                if key not in pinned:
+                    del self._entries[key]
+                    self.stats["releases"] += 1
+
+    def get_stats(self)->Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["resident"] = [str(key[1]) for key, entry in self._entries.items() if not entry.offloaded]
+            stats["offloaded"] = [str(key[1]) for key, entry in self._entries.items() if entry.offloaded]
+            stats["in_use"] = [str(key[1]) for key, entry in self._entries.items() if entry.users > 0]
+            stats["device_mb"] = round(sum(e.nbytes for e in self._entries.values() if not e.offloaded) / 1024 / 1024, 1)
+            stats["offload_mb"] = round(sum(e.nbytes for e in self._entries.values() if e.offloaded) / 1024 / 1024, 1)
+            return stats
@@ -0,0 +1,63 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+
+class PromptCache:
+    '''
+    LRU cache of the reference prompt features (prompt_semantic, refer_spec, phones, bert_features ...),
+        so requests alternating between references don't recompute them.
+
+    Args:
+        max_entries: int, the maximum number of references kept in memory.
+    '''
+    def __init__(self, max_entries:int=16):
+        self.max_entries = max(int(max_entries), 1)
+        self._entries:OrderedDict[Hashable, dict] = OrderedDict()
+        # (path, mtime, size) -> 内容哈希, 避免每次请求都重新读取整个音频文件
+        self._audio_hashes:Dict[Tuple[str, float, int], str] = {}
+        self.stats:Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+        }
+
+    def audio_hash(self, ref_audio_path:str)->str:
+        stat = os.stat(ref_audio_path)
+        file_key = (os.path.abspath(ref_audio_path), stat.st_mtime, stat.st_size)
+        audio_hash = self._audio_hashes.get(file_key, None)
+        if audio_hash is None:
+            m = hashlib.md5()
+            with open(ref_audio_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    m.update(chunk)
+            audio_hash = m.hexdigest()
+            if len(self._audio_hashes) >= self.max_entries * 4:
+                self._audio_hashes.clear()
+            self._audio_hashes[file_key] = audio_hash
+        return audio_hash
+
+    def make_key(self, ref_audio_path:str, prompt_text:Optional[str], prompt_lang:Optional[str], vits_weights_path:str)->tuple:
+        # prompt_semantic 由 vits 模型提取, 不同模型的缓存不能混用
+        return (self.audio_hash(ref_audio_path), prompt_text, prompt_lang, vits_weights_path)
+
+    def get(self, key:Hashable)->Optional[dict]:
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def put(self, key:Hashable, entry:dict):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
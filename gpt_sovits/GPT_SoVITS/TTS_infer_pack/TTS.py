@@ -25,7 +25,13 @@ from gpt_sovits.GPT_SoVITS.my_utils import load_audio
 from gpt_sovits.GPT_SoVITS.module.mel_processing import spectrogram_torch
 from gpt_sovits.GPT_SoVITS.TTS_infer_pack.text_segmentation_method import splits
 from gpt_sovits.GPT_SoVITS.TTS_infer_pack.TextPreprocessor import TextPreprocessor
+from gpt_sovits.GPT_SoVITS.TTS_infer_pack.BatchScheduler import T2SBatchScheduler
+from gpt_sovits.GPT_SoVITS.TTS_infer_pack.ModelRegistry import ModelRegistry
+from gpt_sovits.GPT_SoVITS.TTS_infer_pack.PromptCache import PromptCache
+from gpt_sovits.GPT_SoVITS.TTS_infer_pack.LengthEstimator import SemanticLengthEstimator
 import pickle
+import threading
+import weakref
 i18n = I18nAuto()
 
 # Rest of the file continues as is...
@@ -215,6 +221,8 @@ class TTS:
         self.bert_tokenizer:AutoTokenizer = None
         self.bert_model:AutoModelForMaskedLM = None
         self.cnhuhbert_model:CNHubert = None
+        # 最近使用过的t2s/vits模型, 切换角色时优先复用
+        self.model_registry:ModelRegistry = ModelRegistry(self.configs.device)
         self._init_models()
         
         self.text_preprocessor:TextPreprocessor = \
@@ -224,7 +232,48 @@ class TTS:
         
         
         self.prompt_cache_path:str = ""
-        self.prompt_cache:dict = {
+        self.prompt_cache:dict = self._new_prompt_cache()
+        # 多条参考音频的缓存, self.prompt_cache 是其中当前使用的一条
+        self.prompt_caches:PromptCache = PromptCache()
+        
+        
+        # 正在进行的请求的取消事件, 见 stop()
+        self._cancel_events:set = set()
+        self.precision:torch.dtype = torch.float16 if self.configs.is_half else torch.float32
+        # 并发请求共享同一个TTS实例时, 保护参考音频缓存的读写
+        self._lock = threading.RLock()
+        self.scheduler:T2SBatchScheduler = None
+        # batch推理时, 不同长度的片段是否打包(不pad)进行prefill
+        self.packed_prefill:bool = False
+        # 投机解码: 前draft_layers层作为draft模型, 0表示不使用, 只用于逐句(非并行)推理
+        self.draft_layers:int = 0
+        self.num_draft_tokens:int = 4
+        # CPU上T2S模型是否使用int8动态量化, t2s_model_int8 是当前T2S模型的设置
+        self.t2s_int8:bool = False
+        self.t2s_model_int8:bool = False
+        # 逐句推理时用torch.compile编译单步decode, kv cache长度按bucket_size分桶
+        self.compiled_decode:bool = False
+        self.decode_bucket_size:int = 256
+        self.decode_warmup_tokens:int = 0
+        self.decode_warmup_top_k:int = 5
+        # VITS的Generator是否trace并freeze成TorchScript
+        self.vits_frozen_decoder:bool = False
+        # VITS按batch并行decode(各片段按长度mask), 否则把片段拼接成一条decode
+        self.vits_batched_decode:bool = False
+        self.vits_max_batch_tokens:int = 1000
+        # 分段返回时, VITS按块decode并逐块返回(单位: semantic token), 0表示整个片段decode完再返回
+        self.vits_stream_chunk_size:int = 0
+        self.vits_stream_crossfade:int = 1
+        # 分段返回时, T2S每生成一些token就交给VITS按块decode, 不等整个片段生成完
+        self.token_streaming:bool = False
+        self.vits_stream_lookahead:int = 4
+        self.vits_stream_latent_window:int = 150
+        # 按音素数估计每个片段的semantic token数, 用于分桶和限制decode步数
+        self.length_estimator:SemanticLengthEstimator = SemanticLengthEstimator()
+
+    @staticmethod
+    def _new_prompt_cache()->dict:
+        return {
             "ref_audio_path" : None,
             "prompt_semantic": None,
             "refer_spec"     : None,
@@ -233,11 +282,28 @@ class TTS:
             "phones"         : None,
             "bert_features"  : None,
             "norm_text"      : None,
+            # VITS模型 -> 参考音频的风格embedding ge, 见 _get_refer_ge
+            "refer_ge": weakref.WeakKeyDictionary(),
         }
-        
-        
-        self.stop_flag:bool = False
-        self.precision:torch.dtype = torch.float16 if self.configs.is_half else torch.float32
+
+    def set_length_estimation(self, cap_ratio:float=0, cap_margin:int=50, default_ratio:float=2.5, momentum:float=0.9):
+        '''
+            To set the semantic length estimator (tokens per phone, tracked per model and language).
+            Args:
+                cap_ratio: float, stop a segment after `estimate * cap_ratio + cap_margin` tokens, 0 to disable the cap.
+                cap_margin: int, added to the cap.
+                default_ratio: float, tokens per phone before any segment of the model/language has been decoded.
+                momentum: float, the weight of the history in the moving average.
+        '''
+        self.length_estimator = SemanticLengthEstimator(default_ratio, momentum, cap_ratio, cap_margin)
+
+    def set_prompt_cache_size(self, max_entries:int=16):
+        '''
+            To set how many reference audios are kept in the in-memory prompt cache.
+            Args:
+                max_entries: int, the maximum number of cached references.
+        '''
+        self.prompt_caches = PromptCache(max_entries)
 
     def _init_models(self,):
         # self.init_t2s_weights(self.configs.t2s_weights_path)
@@ -267,11 +333,35 @@ class TTS:
         if self.configs.is_half and str(self.configs.device)!="cpu":
             self.bert_model = self.bert_model.half()
         
+    def set_model_cache_size(self, max_device_mb:float=0, max_offload_mb:float=0):
+        '''
+            To keep recently used t2s/vits models in memory, so switching characters doesn't reload them from disk.
+            Args:
+                max_device_mb: float, memory budget of the inactive models kept on the device, -1 for no limit.
+                max_offload_mb: float, memory budget of the models offloaded to CPU, -1 for no limit.
+        '''
+        # 在原有的registry上调整, 已加载的模型继续被跟踪
+        self.model_registry.resize(max_device_mb, max_offload_mb)
+
+    def _apply_precision(self, model:torch.nn.Module)->torch.nn.Module:
+        if self.configs.is_half and str(self.configs.device)!="cpu":
+            return model.half()
+        return model.float()
+
     def init_vits_weights(self, weights_path: str):
+        # 和 run 中拷贝模型的部分互斥
+        with self._lock:
+            self.configs.vits_weights_path = weights_path
+            self.configs.save_configs()
+            vits_model, meta = self.model_registry.get("vits", weights_path, lambda: self._load_vits_weights(weights_path))
+            for key, value in meta.items():
+                setattr(self.configs, key, value)
+            self.vits_model = self._apply_precision(vits_model)
+            # 从registry取回的模型保留之前trace的Generator, 只有新加载或开关改变时才重新trace
+            self.vits_model.set_frozen_decoder(self.vits_frozen_decoder)
+
+    def _load_vits_weights(self, weights_path: str):
         print(f"Loading VITS weights from {weights_path}")
-        self.configs.vits_weights_path = weights_path
-        self.configs.save_configs()
-        
         try:
             # Import all necessary modules first
             import sys
@@ -300,18 +390,20 @@ class TTS:
                 dict_s2 = torch.load(weights_path, map_location=self.configs.device)
                 
                 hps = dict_s2["config"]
-                self.configs.filter_length = hps["data"]["filter_length"]
-                self.configs.segment_size = hps["train"]["segment_size"]
-                self.configs.sampling_rate = hps["data"]["sampling_rate"]       
-                self.configs.hop_length = hps["data"]["hop_length"]
-                self.configs.win_length = hps["data"]["win_length"]
-                self.configs.n_speakers = hps["data"]["n_speakers"]
-                self.configs.semantic_frame_rate = "25hz"
+                meta = {
+                    "filter_length": hps["data"]["filter_length"],
+                    "segment_size": hps["train"]["segment_size"],
+                    "sampling_rate": hps["data"]["sampling_rate"],
+                    "hop_length": hps["data"]["hop_length"],
+                    "win_length": hps["data"]["win_length"],
+                    "n_speakers": hps["data"]["n_speakers"],
+                    "semantic_frame_rate": "25hz",
+                }
                 kwargs = hps["model"]
                 vits_model = SynthesizerTrn(
-                    self.configs.filter_length // 2 + 1,
-                    self.configs.segment_size // self.configs.hop_length,
-                    n_speakers=self.configs.n_speakers,
+                    meta["filter_length"] // 2 + 1,
+                    meta["segment_size"] // meta["hop_length"],
+                    n_speakers=meta["n_speakers"],
                     **kwargs
                 )
                 
@@ -321,9 +413,9 @@ class TTS:
                 vits_model = vits_model.to(self.configs.device)
                 vits_model = vits_model.eval()
                 vits_model.load_state_dict(dict_s2["weight"], strict=False)
-                self.vits_model = vits_model
-                if self.configs.is_half and str(self.configs.device)!="cpu":
-                    self.vits_model = self.vits_model.half()
+                # 权重加载之后再去掉weight norm
+                vits_model.prepare_for_inference()
+                return vits_model, meta
             finally:
                 # Restore original sys.modules state
                 sys.modules.clear()
@@ -356,21 +448,43 @@ class TTS:
             raise e
 
         
-    def init_t2s_weights(self, weights_path: str):
+    def init_t2s_weights(self, weights_path: str, t2s_int8:bool=None):
+        '''
+            Args:
+                weights_path: str, the T2S weights.
+                t2s_int8: bool, whether this model uses the int8 dynamic quantization, None for `self.t2s_int8`.
+                    the quantized and the fp32 model are different entries of the model registry,
+                    so switching a character doesn't change the model used by the running requests.
+        '''
+        t2s_int8 = self.t2s_int8 if t2s_int8 is None else bool(t2s_int8)
+        # 和 run 中拷贝模型的部分互斥
+        with self._lock:
+            self.configs.t2s_weights_path = weights_path
+            self.configs.save_configs()
+            self.configs.hz = 50
+            int8 = self._use_t2s_int8(t2s_int8)
+            t2s_model, meta = self.model_registry.get("t2s", self._t2s_registry_key(weights_path, int8),
+                                                      lambda: self._load_t2s_weights(weights_path, int8))
+            self.configs.max_sec = meta["max_sec"]
+            self.t2s_model = self._apply_precision(t2s_model)
+            self.t2s_model_int8 = t2s_int8
+            self.t2s_model.model.set_compiled_decode(self.compiled_decode, self.decode_bucket_size)
+            self._warmup_compiled_decode()
+
+    @staticmethod
+    def _t2s_registry_key(weights_path:str, int8:bool):
+        return (weights_path, "int8") if int8 else weights_path
+
+    def _load_t2s_weights(self, weights_path: str, int8:bool=False):
         print(f"Loading Text2Semantic weights from {weights_path}")
-        self.configs.t2s_weights_path = weights_path
-        self.configs.save_configs()
-        self.configs.hz = 50
         dict_s1 = torch.load(weights_path, map_location=self.configs.device)
         config = dict_s1["config"]
-        self.configs.max_sec = config["data"]["max_sec"]
         t2s_model = Text2SemanticLightningModule(config, "****", is_train=False)
         t2s_model.load_state_dict(dict_s1["weight"])
         t2s_model = t2s_model.to(self.configs.device)
         t2s_model = t2s_model.eval()
-        self.t2s_model = t2s_model
-        if self.configs.is_half and str(self.configs.device)!="cpu":
-            self.t2s_model = self.t2s_model.half()
+        t2s_model.model.set_dynamic_quantization(int8)
+        return t2s_model, {"max_sec": config["data"]["max_sec"]}
         
     def enable_half_precision(self, enable: bool = True):
         '''
@@ -413,7 +527,9 @@ class TTS:
         '''
         self.configs.device = device
         self.configs.save_configs()
+        self.model_registry.set_device(device)
         if self.t2s_model is not None:
+            # int8权重只用于CPU上的fp32推理, 其他设备上模型自动使用fp32权重
             self.t2s_model = self.t2s_model.to(device)
         if self.vits_model is not None:
             self.vits_model = self.vits_model.to(device)
@@ -429,6 +545,10 @@ class TTS:
             Args:
                 ref_audio_path: str, the path of the reference audio.
         '''
+        # 不修改 self.prompt_caches 中的条目
+        self.prompt_cache = dict(self.prompt_cache)
+        self.prompt_cache["ref_audio_key"] = None
+        self.prompt_cache["refer_ge"] = weakref.WeakKeyDictionary()
         self._set_prompt_semantic(ref_audio_path)
         self._set_ref_spec(ref_audio_path)
         
@@ -480,6 +600,27 @@ class TTS:
             prompt_semantic = codes[0, 0].to(self.configs.device)
             self.prompt_cache["prompt_semantic"] = prompt_semantic
     
+    def _get_refer_ge(self, prompt_cache:dict, vits_model)->torch.Tensor:
+        '''
+            The style embedding `ge` of the reference spectrogram only depends on the reference audio,
+                so it is computed once per reference audio and VITS model instead of at every decode.
+            Args:
+                prompt_cache: dict, the prompt cache of the current request.
+                vits_model: SynthesizerTrn.
+        '''
+        ges = prompt_cache.get("refer_ge", None)
+        key = (self.precision, str(self.configs.device))
+        # 同一个参考音频缓存可能被并发的请求共用
+        with self._lock:
+            cached = ges.get(vits_model, None) if ges is not None else None
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        ge = vits_model.extract_ge(prompt_cache["refer_spec"].to(dtype=self.precision, device=self.configs.device))
+        if ges is not None:
+            with self._lock:
+                ges[vits_model] = (key, ge)
+        return ge
+
     def batch_sequences(self, sequences: List[torch.Tensor], axis: int = 0, pad_value: int = 0, max_length:int=None):
         seq = sequences[0]
         ndim = seq.dim()
@@ -508,12 +649,16 @@ class TTS:
                  split_bucket:bool=True, 
                  device:torch.device=torch.device("cpu"),
                  precision:torch.dtype=torch.float32,
+                 semantic_lens:list=None,
                  ):
         _data:list = []
         index_and_len_list = []
         for idx, item in enumerate(data):
-            norm_text_len = len(item["norm_text"])
-            index_and_len_list.append([idx, norm_text_len])
+            # semantic_lens: 每一项估计的semantic token数, 按它分桶; 没有时按文本长度
+            if semantic_lens is not None:
+                index_and_len_list.append([idx, int(math.ceil(semantic_lens[idx]))])
+            else:
+                index_and_len_list.append([idx, len(item["norm_text"])])
 
         batch_index_list = []
         if split_bucket:
@@ -636,11 +781,221 @@ class TTS:
 
     def stop(self,):
         '''
-        Stop the inference process.
+        Stop all running inference requests.
+            to stop a single request, set the `cancel_event` passed in its inputs instead.
+        '''
+        with self._lock:
+            for cancel_event in self._cancel_events:
+                cancel_event.set()
+
+    def enable_batch_scheduler(self, max_batch_size:int=20, max_wait_ms:float=10):
+        '''
+            To merge the T2S segments of concurrent requests into shared decode batches.
+            Args:
+                max_batch_size: int, the maximum number of segments decoded together.
+                max_wait_ms: float, how long to wait for more segments before a batch is launched.
+        '''
+        self.disable_batch_scheduler()
+        self.scheduler = T2SBatchScheduler(max_batch_size, max_wait_ms, self.packed_prefill)
+
+    def set_packed_prefill(self, enabled:bool=True):
+        '''
+            To prefill the segments of a batch packed into one sequence without padding,
+                which saves the compute spent on padding when the segment lengths differ a lot.
+            Args:
+                enabled: bool, used by the batch scheduler and the parallel (batched) inference.
+        '''
+        self.packed_prefill = enabled
+        if self.scheduler is not None:
+            self.scheduler.packed_prefill = enabled
+
+    def set_speculative_decoding(self, draft_layers:int=0, num_draft_tokens:int=4):
+        '''
+            To decode the semantic tokens speculatively: the first layers of the T2S model propose
+                several tokens and the full model verifies them in one forward, the output follows the same distribution.
+                only used when the segments are decoded one by one (not parallel_infer and no batch scheduler).
+            Args:
+                draft_layers: int, how many of the first layers are used as the draft model, 0 to disable.
+                num_draft_tokens: int, how many tokens the draft model proposes in each round.
+        '''
+        self.draft_layers = max(int(draft_layers), 0)
+        self.num_draft_tokens = max(int(num_draft_tokens), 1)
+
+    def set_t2s_dynamic_quantization(self, enable:bool=True):
+        '''
+            To run the linear layers of the T2S model with int8 weights and dynamically quantized activations on CPU,
+                faster than fp32 with a small drift of the tokens. The fp32 weights are kept, other devices use them.
+            Args:
+                enable: bool, the default of the T2S models loaded later, the current model is switched to it.
+                    a request can choose with the "t2s_int8" input of `run`.
         '''
-        self.stop_flag = True
+        self.t2s_int8 = enable
+        if self.t2s_model is not None:
+            self.init_t2s_weights(self.configs.t2s_weights_path, enable)
+
+    def set_compiled_decode(self, enable:bool=True, bucket_size:int=256, warmup_tokens:int=0, warmup_top_k:int=5):
+        '''
+            To decode the semantic tokens with a step compiled by torch.compile (embedding, all layers and sampling
+                in one graph), used when the segments are decoded one by one (not parallel_infer and no batch scheduler).
+                Every kv cache bucket is compiled the first time it is reached, which takes minutes on CPU,
+                the buckets up to `warmup_tokens` are compiled when the T2S model is loaded instead.
+            Args:
+                enable: bool, applied to the loaded T2S model and to the ones loaded later.
+                bucket_size: int, the kv cache capacity is rounded up to a multiple of it.
+                warmup_tokens: int, compile the buckets up to this kv cache length (prompt, text and semantic tokens)
+                    at load time, 0 to compile them in the requests.
+                warmup_top_k: int, the top_k the warmup compiles for, see `T2SDecodeGraph`.
+        '''
+        self.compiled_decode = enable
+        self.decode_bucket_size = bucket_size
+        self.decode_warmup_tokens = max(int(warmup_tokens), 0)
+        self.decode_warmup_top_k = warmup_top_k
+        if enable and self.decode_warmup_tokens == 0:
+            print("compiled decode: every kv cache bucket is compiled the first time a request reaches it, "
+                  "which can take minutes on CPU. set warmup_tokens to compile them when the model is loaded.")
+        if self.t2s_model is not None:
+            with self._lock:
+                self.t2s_model.model.set_compiled_decode(enable, bucket_size)
+                self._warmup_compiled_decode()
+
+    def _warmup_compiled_decode(self):
+        decode_graph = self.t2s_model.model.decode_graph
+        if decode_graph is None or self.decode_warmup_tokens <= 0 or self.t2s_model.model.dynamic_quantization:
+            return
+        t0 = ttime()
+        decode_graph.warmup(self.decode_warmup_tokens, self.decode_warmup_top_k)
+        print(f"compiled decode warmup: {self.decode_warmup_tokens} tokens, {ttime() - t0:.1f}s")
+
+    def set_vits_frozen_decoder(self, enable:bool=True):
+        '''
+            To run the VITS Generator as a traced and frozen TorchScript graph, traced at the first decode
+                (and again after switching precision or device).
+            Args:
+                enable: bool, applied to the loaded VITS model and to the ones loaded later.
+        '''
+        self.vits_frozen_decoder = enable
+        if self.vits_model is not None:
+            self.vits_model.set_frozen_decoder(enable)
+
+    def set_vits_batched_decode(self, enable:bool=True, max_batch_tokens:int=1000):
+        '''
+            To decode the segments of a batch with VITS as the rows of a padded batch (masked by their lengths),
+                instead of concatenating them into one long sequence.
+                The cost of a batch follows its longest segment, and no segment is affected by its neighbours.
+            Args:
+                enable: bool.
+                max_batch_tokens: int, the segments are split into sub-batches whose size * longest length (in semantic tokens)
+                    is at most max_batch_tokens, to bound the peak memory.
+        '''
+        self.vits_batched_decode = enable
+        self.vits_max_batch_tokens = max(int(max_batch_tokens), 1)
+
+    def _vits_batched_decode(self, vits_model:SynthesizerTrn, pred_semantic_list:List[torch.LongTensor],
+                             batch_phones:List[torch.LongTensor], refer_spec:torch.Tensor, ge:torch.Tensor)->List[torch.Tensor]:
+        # 按长度排序后分组, 每组的 片段数*最大长度 不超过 vits_max_batch_tokens
+        order = sorted(range(len(pred_semantic_list)), key=lambda i: pred_semantic_list[i].shape[0])
+        groups:List[List[int]] = []
+        for i in order:
+            length = max(pred_semantic_list[i].shape[0], 1)
+            if len(groups) > 0 and (len(groups[-1]) + 1) * length <= self.vits_max_batch_tokens:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+
+        device = self.configs.device
+        audio_fragments:List[torch.Tensor] = [None]*len(pred_semantic_list)
+        for group in groups:
+            pred_semantic = self.batch_sequences([pred_semantic_list[i] for i in group], axis=0, pad_value=0).unsqueeze(0).to(device)
+            pred_semantic_len = torch.LongTensor([pred_semantic_list[i].shape[0] for i in group]).to(device)
+            phones = self.batch_sequences([batch_phones[i] for i in group], axis=0, pad_value=0).to(device)
+            phones_len = torch.LongTensor([batch_phones[i].shape[-1] for i in group]).to(device)
+            outputs = vits_model.batched_decode(pred_semantic, pred_semantic_len, phones, phones_len, refer_spec, ge=ge)
+            for i, output in zip(group, outputs):
+                audio_fragments[i] = output
+        return audio_fragments
+
+    def set_vits_streaming(self, chunk_size:int=25, crossfade:int=1, token_streaming:bool=False, lookahead:int=4,
+                           latent_window:int=150):
+        '''
+            To decode every segment with VITS chunk by chunk in return_fragment mode (see `SynthesizerTrn.decode_streaming`),
+                every chunk is returned as soon as it is decoded, instead of after the whole segment.
+            Args:
+                chunk_size: int, semantic tokens (25 per second) per chunk, 0 to disable.
+                crossfade: int, latent frames (50 per second) cross-faded at the boundary of two chunks.
+                token_streaming: bool, to start decoding the chunks while the T2S model is still generating the segment
+                    (see `SynthesizerTrn.decode_streaming_tokens`), the first audio only waits for chunk_size + lookahead tokens.
+                    The segments are then generated one by one (no parallel_infer, batch scheduler or speculative decoding).
+                lookahead: int, semantic tokens generated after a chunk before it is decoded, as its right context.
+                latent_window: int, with token_streaming, the semantic tokens before a chunk re-encoded with it,
+                    bounds the cost of every chunk for long segments, 0 to re-encode the whole prefix (O(n^2) in the segment length).
+        '''
+        self.vits_stream_chunk_size = max(int(chunk_size), 0)
+        self.vits_stream_crossfade = max(int(crossfade), 0)
+        self.token_streaming = token_streaming
+        self.vits_stream_lookahead = max(int(lookahead), 0)
+        self.vits_stream_latent_window = max(int(latent_window), 0)
+
+    def _postprocess_chunks(self, chunks, speed_factor:float, fragment_interval:float, cancel_event:threading.Event):
+        # 晚一块返回, 片段的最后一块后面才加上间隔
+        last_chunk:torch.Tensor = None
+        for chunk in chunks:
+            if cancel_event.is_set():
+                return
+            if last_chunk is not None:
+                yield self.audio_postprocess([[last_chunk]], self.configs.sampling_rate, None, speed_factor, False, 0)
+            last_chunk = chunk
+        if last_chunk is not None:
+            yield self.audio_postprocess([[last_chunk]], self.configs.sampling_rate, None, speed_factor, False, fragment_interval)
+
+    def _vits_streaming_decode(self, vits_model:SynthesizerTrn, pred_semantic_list:List[torch.LongTensor],
+                               batch_phones:List[torch.LongTensor], refer_spec:torch.Tensor, ge:torch.Tensor,
+                               speed_factor:float, fragment_interval:float, cancel_event:threading.Event):
+        device = self.configs.device
+        for pred_semantic, phones in zip(pred_semantic_list, batch_phones):
+            chunks = vits_model.decode_streaming(pred_semantic.view(1, 1, -1).to(device), phones.unsqueeze(0).to(device),
+                                                 refer_spec, ge=ge, chunk_size=self.vits_stream_chunk_size,
+                                                 crossfade=self.vits_stream_crossfade)
+            yield from self._postprocess_chunks(chunks, speed_factor, fragment_interval, cancel_event)
+
+    def _token_streaming_decode(self, t2s_model, vits_model:SynthesizerTrn, item:dict,
+                                prompt:torch.LongTensor, early_stop_num:List[int], idx_list:List[int],
+                                refer_spec:torch.Tensor, ge:torch.Tensor, speed_factor:float, fragment_interval:float,
+                                cancel_event:threading.Event, **t2s_kwargs):
+        # 片段逐个生成, T2S每同步一次就把目前的token交给VITS, 够一块就decode返回. 最终的token数记录到idx_list
+        device = self.configs.device
+        for i in range(len(item["all_phones"])):
+            token_stream = t2s_model.infer_panel_stream(item["all_phones"][i].unsqueeze(0),
+                                                        item["all_phones_len"][i],
+                                                        prompt.unsqueeze(0) if prompt is not None else None,
+                                                        item["all_bert_features"][i].unsqueeze(0),
+                                                        early_stop_num=early_stop_num[i],
+                                                        cancel_event=cancel_event,
+                                                        **t2s_kwargs)
+
+            def code_stream():
+                for y, idx, finished in token_stream:
+                    if finished:
+                        idx_list.append(idx)
+                    yield y[0, -idx:].view(1, 1, -1), finished
+
+            chunks = vits_model.decode_streaming_tokens(code_stream(), item["phones"][i].unsqueeze(0).to(device),
+                                                        refer_spec, ge=ge, chunk_size=self.vits_stream_chunk_size,
+                                                        lookahead=self.vits_stream_lookahead,
+                                                        latent_window=self.vits_stream_latent_window,
+                                                        crossfade=self.vits_stream_crossfade)
+            yield from self._postprocess_chunks(chunks, speed_factor, fragment_interval, cancel_event)
+            if cancel_event.is_set():
+                return
+
+    def _use_t2s_int8(self, enable:bool=None)->bool:
+        enable = self.t2s_int8 if enable is None else enable
+        return enable and str(self.configs.device) == "cpu" and not self.configs.is_half
+
+    def disable_batch_scheduler(self):
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
     
-    @torch.no_grad()
     def run(self, inputs:dict):
         """
         Text to speech inference.
@@ -665,13 +1020,29 @@ class TTS:
                     "fragment_interval":0.3,      # float. to control the interval of the audio fragment.
                     "seed": -1,                   # int. random seed for reproducibility.
                     "parallel_infer": True,       # bool. whether to use parallel inference.
-                    "repetition_penalty": 1.35    # float. repetition penalty for T2S model.
+                    "repetition_penalty": 1.35,   # float. repetition penalty for T2S model.
+                    "cancel_event": None,         # threading.Event.(optional) set it to cancel this request.
+                    "t2s_weights_path": None,     # str.(optional) the T2S weights of this request, loaded if not the current ones.
+                    "vits_weights_path": None,    # str.(optional) the VITS weights of this request, loaded if not the current ones.
+                    "t2s_int8": None,             # bool.(optional) whether the T2S model of this request uses int8 weights on CPU.
+                    "length_key": None,           # str.(optional) key of the semantic length statistics, e.g. the character, defaults to the T2S weights.
                 }
         returns:
             Tuple[int, np.ndarray]: sampling rate and audio data.
         """
+        # 请求用到的模型, 在请求结束前不会被 model_registry 卸载或释放
+        leased_models = []
+        try:
+            yield from self._run(inputs, leased_models)
+        finally:
+            for model in leased_models:
+                self.model_registry.release(model)
+
+    @torch.no_grad()
+    def _run(self, inputs:dict, leased_models:list):
         ########## variables initialization ###########
-        self.stop_flag:bool = False
+        # 每个请求有自己的取消事件, 互不影响
+        cancel_event:threading.Event = inputs.get("cancel_event", None) or threading.Event()
         text:str = inputs.get("text", "")
         text_lang:str = inputs.get("text_lang", "")
         
@@ -696,13 +1067,15 @@ class TTS:
         actual_seed = set_seed(seed)
         parallel_infer = inputs.get("parallel_infer", True)
         repetition_penalty = inputs.get("repetition_penalty", 1.35)
+        t2s_weights_path:str = inputs.get("t2s_weights_path", None)
+        vits_weights_path:str = inputs.get("vits_weights_path", None)
+        t2s_int8:bool = inputs.get("t2s_int8", None)
+        length_key:str = inputs.get("length_key", None)
 
         if parallel_infer:
             print(i18n("并行推理模式已开启"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_batch_infer_with_flash_attn
         else:
             print(i18n("并行推理模式已关闭"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_0307
 
         if return_fragment:
             print(i18n("分段返回模式已开启"))
@@ -731,41 +1104,86 @@ class TTS:
 
         ###### setting reference audio and prompt text preprocessing ########
         t0 = ttime()
-        
-        if prompt_cache_path not in ["", None] and os.path.exists(prompt_cache_path):
-            if prompt_cache_path != self.prompt_cache_path:
-                del self.prompt_cache
-                with open(prompt_cache_path, "rb") as f:
-                    self.prompt_cache = pickle.load(f)
-                print(i18n("参考音频缓存已加载"))
-                self.prompt_cache_path = prompt_cache_path
-        elif not test_mode:
-            # when in test mode, the prompt_cache should be set manually.
-            if (ref_audio_path is not None) and (ref_audio_path != self.prompt_cache["ref_audio_path"]):
-                self.set_ref_audio(ref_audio_path)
-                self.prompt_cache["ref_audio_path"] = ref_audio_path
+        with self._lock:
+            # 请求指定的模型在锁内切换, 和下面拷贝模型是原子的, 不受并发请求切换角色的影响
+            if t2s_weights_path in [None, ""]:
+                t2s_weights_path = self.configs.t2s_weights_path
+            if t2s_weights_path != self.configs.t2s_weights_path or \
+                    (t2s_int8 is not None and bool(t2s_int8) != self.t2s_model_int8):
+                self.init_t2s_weights(t2s_weights_path, t2s_int8)
+            if vits_weights_path not in [None, ""] and vits_weights_path != self.configs.vits_weights_path:
+                self.init_vits_weights(vits_weights_path)
 
             if not no_prompt_text:
                 prompt_text = prompt_text.strip("\n")
                 if (prompt_text[-1] not in splits): prompt_text += "。" if prompt_lang != "en" else "."
                 print(i18n("实际输入的参考文本:"), prompt_text)
-                if self.prompt_cache["prompt_text"] != prompt_text:
-                    self.prompt_cache["prompt_text"] = prompt_text
-                    self.prompt_cache["prompt_lang"] = prompt_lang
-                    phones, bert_features, norm_text = \
-                        self.text_preprocessor.segment_and_extract_feature_for_text(
-                                                                            prompt_text, 
-                                                                            prompt_lang)
-                    self.prompt_cache["phones"] = phones
-                    self.prompt_cache["bert_features"] = bert_features
-                    self.prompt_cache["norm_text"] = norm_text
-            
-            if prompt_cache_path not in ["", None]:
-                os.makedirs(os.path.dirname(prompt_cache_path), exist_ok=True)
-                with open(prompt_cache_path, "wb") as f:
-                    pickle.dump(self.prompt_cache, f)
-                print(i18n("参考音频缓存已保存"))
+
+            prompt_cache_key = None
+            if not test_mode and ref_audio_path not in ["", None]:
+                prompt_cache_key = self.prompt_caches.make_key(ref_audio_path,
+                                                               None if no_prompt_text else prompt_text,
+                                                               None if no_prompt_text else prompt_lang,
+                                                               self.configs.vits_weights_path)
+            cached_prompt = self.prompt_caches.get(prompt_cache_key) if prompt_cache_key is not None else None
+
+            if cached_prompt is not None:
+                self.prompt_cache = cached_prompt
                 self.prompt_cache_path = prompt_cache_path
+            elif prompt_cache_path not in ["", None] and os.path.exists(prompt_cache_path):
+                if prompt_cache_path != self.prompt_cache_path:
+                    del self.prompt_cache
+                    with open(prompt_cache_path, "rb") as f:
+                        self.prompt_cache = pickle.load(f)
+                    self.prompt_cache["refer_ge"] = weakref.WeakKeyDictionary()
+                    print(i18n("参考音频缓存已加载"))
+                    self.prompt_cache_path = prompt_cache_path
+                if prompt_cache_key is not None:
+                    self.prompt_caches.put(prompt_cache_key, self.prompt_cache)
+            elif not test_mode:
+                # when in test mode, the prompt_cache should be set manually.
+                # 当前的缓存可能同时存放在 self.prompt_caches 中, 修改前先拷贝一份
+                self.prompt_cache = dict(self.prompt_cache)
+                if prompt_cache_key is not None:
+                    # 音频内容与vits模型都没变时, 只需重新处理参考文本
+                    ref_audio_key = (prompt_cache_key[0], prompt_cache_key[3])
+                    if ref_audio_key != self.prompt_cache.get("ref_audio_key", None):
+                        self.set_ref_audio(ref_audio_path)
+                        self.prompt_cache["ref_audio_path"] = ref_audio_path
+                        self.prompt_cache["ref_audio_key"] = ref_audio_key
+
+                if not no_prompt_text:
+                    if self.prompt_cache["prompt_text"] != prompt_text:
+                        self.prompt_cache["prompt_text"] = prompt_text
+                        self.prompt_cache["prompt_lang"] = prompt_lang
+                        phones, bert_features, norm_text = \
+                            self.text_preprocessor.segment_and_extract_feature_for_text(
+                                                                                prompt_text, 
+                                                                                prompt_lang)
+                        self.prompt_cache["phones"] = phones
+                        self.prompt_cache["bert_features"] = bert_features
+                        self.prompt_cache["norm_text"] = norm_text
+            
+                if prompt_cache_path not in ["", None]:
+                    os.makedirs(os.path.dirname(prompt_cache_path), exist_ok=True)
+                    with open(prompt_cache_path, "wb") as f:
+                        pickle.dump({key: value for key, value in self.prompt_cache.items()
+                                     if key != "refer_ge"}, f)
+                    print(i18n("参考音频缓存已保存"))
+                    self.prompt_cache_path = prompt_cache_path
+                if prompt_cache_key is not None:
+                    self.prompt_caches.put(prompt_cache_key, self.prompt_cache)
+            # 拷贝一份当前请求用到的参考音频缓存和模型, 避免被并发的其他请求修改
+            prompt_cache:dict = dict(self.prompt_cache)
+            t2s_model:Text2SemanticLightningModule = self.t2s_model
+            vits_model:SynthesizerTrn = self.vits_model
+            for model in (t2s_model, vits_model):
+                self.model_registry.acquire(model)
+                leased_models.append(model)
+            # 长度估计按角色区分, 未指定时按模型区分
+            if length_key in [None, ""]:
+                length_key = self.configs.t2s_weights_path
+        length_estimator:SemanticLengthEstimator = self.length_estimator
 
         ###### text preprocessing ########
         t1 = ttime()
@@ -779,13 +1197,16 @@ class TTS:
                 return
 
             batch_index_list:list = None
+            # 按估计的semantic长度分桶, 同一batch里的片段decode步数相近
+            semantic_lens = [length_estimator.estimate(len(item["phones"]), text_lang, length_key) for item in data]
             data, batch_index_list = self.to_batch(data, 
-                                prompt_data=self.prompt_cache if not no_prompt_text else None, 
+                                prompt_data=prompt_cache if not no_prompt_text else None, 
                                 batch_size=batch_size, 
                                 threshold=batch_threshold,
                                 split_bucket=split_bucket,
                                 device=self.configs.device,
-                                precision=self.precision
+                                precision=self.precision,
+                                semantic_lens=semantic_lens,
                                 )
         else:
             print(i18n("############ 切分文本 ############"))
@@ -812,7 +1233,7 @@ class TTS:
                 if len(batch_data) == 0:
                     return None
                 batch, _ = self.to_batch(batch_data, 
-                            prompt_data=self.prompt_cache if not no_prompt_text else None, 
+                            prompt_data=prompt_cache if not no_prompt_text else None, 
                             batch_size=batch_size, 
                             threshold=batch_threshold,
                             split_bucket=False,
@@ -823,12 +1244,17 @@ class TTS:
 
 
         t2 = ttime()
+        with self._lock:
+            self._cancel_events.add(cancel_event)
         try:
             print("############ 推理 ############")
             ###### inference ######
             t_34 = 0.0
             t_45 = 0.0
             audio = []
+            num_segments = 0
+            # token级流式, 见 set_vits_streaming
+            token_streaming = return_fragment and self.vits_stream_chunk_size > 0 and self.token_streaming
             for item in data:
                 t3 = ttime()
                 if return_fragment:
@@ -849,85 +1275,147 @@ class TTS:
                 if no_prompt_text :
                     prompt = None
                 else:
-                    prompt = self.prompt_cache["prompt_semantic"].expand(len(all_phoneme_ids), -1).to(self.configs.device)
-
-
-                pred_semantic_list, idx_list = self.t2s_model.model.infer_panel(
-                    all_phoneme_ids,
-                    all_phoneme_lens,
-                    prompt,
-                    all_bert_features,
-                    # prompt_phone_len=ph_offset,
-                    top_k=top_k,
-                    top_p=top_p,
-                    temperature=temperature,
-                    early_stop_num=self.configs.hz * self.configs.max_sec,
-                    max_len=max_len,
-                    repetition_penalty=repetition_penalty,
-                )
+                    prompt = prompt_cache["prompt_semantic"].to(self.configs.device)
+
+                # 每个片段的decode步数上限, 开启长度估计的上限时按估计的长度收紧, 同时决定预分配的大小
+                early_stop_num = [length_estimator.step_cap(num_phones, text_lang, length_key, self.configs.hz * self.configs.max_sec)
+                                  for num_phones in batch_phones_len.tolist()]
+                if token_streaming:
+                    # T2S边生成, VITS边按块decode返回
+                    idx_list = []
+                    yield from self._token_streaming_decode(t2s_model.model, vits_model, item, prompt,
+                                                            early_stop_num, idx_list,
+                                                            prompt_cache["refer_spec"].to(dtype=self.precision, device=self.configs.device),
+                                                            self._get_refer_ge(prompt_cache, vits_model),
+                                                            speed_factor, fragment_interval, cancel_event,
+                                                            top_k=top_k,
+                                                            top_p=top_p,
+                                                            temperature=temperature,
+                                                            repetition_penalty=repetition_penalty,
+                                                            )
+                elif parallel_infer and self.scheduler is not None:
+                    # 交给调度器, 和其他并发请求的片段合并成同一个batch
+                    # 指定了seed时每个片段用自己的随机数生成器, 同样的seed不受同batch里其他请求的影响
+                    # 没有指定seed时不需要复现, 共用全局的随机数生成器, 采样时不用逐行生成噪声
+                    generators = [torch.Generator(device=self.configs.device).manual_seed(actual_seed + num_segments + i)
+                                  for i in range(len(all_phoneme_ids))] if seed != -1 else None
+                    num_segments += len(all_phoneme_ids)
+                    pred_semantic_list, idx_list = self.scheduler.infer(
+                        t2s_model.model,
+                        all_phoneme_ids,
+                        prompt,
+                        all_bert_features,
+                        top_k=top_k,
+                        top_p=top_p,
+                        temperature=temperature,
+                        early_stop_num=early_stop_num,
+                        repetition_penalty=repetition_penalty,
+                        cancel_event=cancel_event,
+                        generators=generators,
+                    )
+                else:
+                    infer_panel = t2s_model.model.infer_panel_batch_infer_with_flash_attn if parallel_infer \
+                                    else t2s_model.model.infer_panel_0307
+                    pred_semantic_list, idx_list = infer_panel(
+                        all_phoneme_ids,
+                        all_phoneme_lens,
+                        prompt.expand(len(all_phoneme_ids), -1) if prompt is not None else None,
+                        all_bert_features,
+                        # prompt_phone_len=ph_offset,
+                        top_k=top_k,
+                        top_p=top_p,
+                        temperature=temperature,
+                        early_stop_num=early_stop_num,
+                        max_len=max_len,
+                        repetition_penalty=repetition_penalty,
+                        cancel_event=cancel_event,
+                        packed_prefill=self.packed_prefill,
+                        draft_layers=self.draft_layers,
+                        num_draft_tokens=self.num_draft_tokens,
+                    )
                 t4 = ttime()
                 t_34 += t4 - t3
 
-                refer_audio_spec:torch.Tensor = self.prompt_cache["refer_spec"]\
+                if not cancel_event.is_set():
+                    # 只统计遇到EOS正常结束的片段, 达到上限的片段长度不是真实长度
+                    # T2S最多decode 1500步, 没有设置上限的片段也会在1499步被截断
+                    for num_phones, idx, cap in zip(batch_phones_len.tolist(), idx_list, early_stop_num):
+                        if idx < min(1499 if cap == -1 else cap, 1499) - 1:
+                            length_estimator.update(num_phones, idx, text_lang, length_key)
+
+                if cancel_event.is_set():
+                    # 请求已取消, 不再进行vits推理
+                    yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate),
+                                                            dtype=np.int16)
+                    return
+
+                if token_streaming:
+                    print("############ 各阶段耗时: 处理参考音频 [%.3f]s, 文本处理 [%.3f]s, t2s_model + vits_model [%.3f]s ############" % (t1 - t0, t2 - t1, t4 - t3))
+                    continue
+
+                refer_audio_spec:torch.Tensor = prompt_cache["refer_spec"]\
                                                     .to(dtype=self.precision, device=self.configs.device)
+                # 参考音频的ge只算一次, 不再每个batch(分段返回时每个片段)都跑一遍ref_enc
+                refer_ge:torch.Tensor = self._get_refer_ge(prompt_cache, vits_model)
 
                 batch_audio_fragment = []
 
                 # 这里要记得加 torch.no_grad() 不然速度慢一大截
                 # with torch.no_grad():
             
-                # ## vits并行推理 method 1
-                # pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                # pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(self.configs.device)
-                # pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0)
-                # max_len = 0
-                # for i in range(0, len(batch_phones)):
-                #     max_len = max(max_len, batch_phones[i].shape[-1])
-                # batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0, max_length=max_len)
-                # batch_phones = batch_phones.to(self.configs.device)
-                # batch_audio_fragment = (self.vits_model.batched_decode(
-                #         pred_semantic, pred_semantic_len, batch_phones, batch_phones_len,refer_audio_spec
-                #     ))
-
-                # ## vits并行推理 method 2
                 pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                upsample_rate = math.prod(self.vits_model.upsample_rates)
-                audio_frag_idx = [pred_semantic_list[i].shape[0]*2*upsample_rate for i in range(0, len(pred_semantic_list))]
-                audio_frag_end_idx = [ sum(audio_frag_idx[:i+1]) for i in range(0, len(audio_frag_idx))]
-                all_pred_semantic = torch.cat(pred_semantic_list).unsqueeze(0).unsqueeze(0).to(self.configs.device)
-                _batch_phones = torch.cat(batch_phones).unsqueeze(0).to(self.configs.device)
-                _batch_audio_fragment = (self.vits_model.decode(
-                        all_pred_semantic, _batch_phones, refer_audio_spec
-                    ).detach()[0, 0, :])
-                audio_frag_end_idx.insert(0, 0)
-                batch_audio_fragment= [_batch_audio_fragment[audio_frag_end_idx[i-1]:audio_frag_end_idx[i]] for i in range(1, len(audio_frag_end_idx))]
-
-                # ## vits串行推理
-                # for i, idx in enumerate(idx_list):
-                #     phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
-                #     _pred_semantic = (pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0))   # .unsqueeze(0)#mq要多unsqueeze一次
-                #     audio_fragment =(self.vits_model.decode(
-                #             _pred_semantic, phones, refer_audio_spec
-                #         ).detach()[0, 0, :])
-                #     batch_audio_fragment.append(
-                #         audio_fragment
-                #     )  ###试试重建不带上prompt部分
-
-                t5 = ttime()
-                t_45 += t5 - t4
-                if return_fragment:
+                if return_fragment and self.vits_stream_chunk_size > 0:
+                    # ## vits流式推理, 每个片段按块decode, 每块decode完就返回
+                    yield from self._vits_streaming_decode(vits_model, pred_semantic_list, batch_phones,
+                                                           refer_audio_spec, refer_ge,
+                                                           speed_factor, fragment_interval, cancel_event)
+                    t5 = ttime()
+                    t_45 += t5 - t4
                     print("############ 各阶段耗时: 处理参考音频 [%.3f]s, 文本处理 [%.3f]s, t2s_model [%.3f]s, vits_model [%.3f]s ############" % (t1 - t0, t2 - t1, t4 - t3, t5 - t4))
-                    yield self.audio_postprocess([batch_audio_fragment], 
-                                                    self.configs.sampling_rate, 
-                                                    None, 
-                                                    speed_factor, 
-                                                    False,
-                                                    fragment_interval
-                                                    )
                 else:
-                    audio.append(batch_audio_fragment)
+                    if self.vits_batched_decode:
+                        # ## vits并行推理 method 1, 各片段按长度mask后并行decode
+                        batch_audio_fragment = self._vits_batched_decode(vits_model, pred_semantic_list, batch_phones,
+                                                                         refer_audio_spec, refer_ge)
+                    else:
+                        # ## vits并行推理 method 2
+                        upsample_rate = math.prod(vits_model.upsample_rates)
+                        audio_frag_idx = [pred_semantic_list[i].shape[0]*2*upsample_rate for i in range(0, len(pred_semantic_list))]
+                        audio_frag_end_idx = [ sum(audio_frag_idx[:i+1]) for i in range(0, len(audio_frag_idx))]
+                        all_pred_semantic = torch.cat(pred_semantic_list).unsqueeze(0).unsqueeze(0).to(self.configs.device)
+                        _batch_phones = torch.cat(batch_phones).unsqueeze(0).to(self.configs.device)
+                        _batch_audio_fragment = (vits_model.decode(
+                                all_pred_semantic, _batch_phones, refer_audio_spec, ge=refer_ge
+                            ).detach()[0, 0, :])
+                        audio_frag_end_idx.insert(0, 0)
+                        batch_audio_fragment= [_batch_audio_fragment[audio_frag_end_idx[i-1]:audio_frag_end_idx[i]] for i in range(1, len(audio_frag_end_idx))]
+
+                    # ## vits串行推理
+                    # for i, idx in enumerate(idx_list):
+                    #     phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
+                    #     _pred_semantic = (pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0))   # .unsqueeze(0)#mq要多unsqueeze一次
+                    #     audio_fragment =(self.vits_model.decode(
+                    #             _pred_semantic, phones, refer_audio_spec
+                    #         ).detach()[0, 0, :])
+                    #     batch_audio_fragment.append(
+                    #         audio_fragment
+                    #     )  ###试试重建不带上prompt部分
+
+                    t5 = ttime()
+                    t_45 += t5 - t4
+                    if return_fragment:
+                        print("############ 各阶段耗时: 处理参考音频 [%.3f]s, 文本处理 [%.3f]s, t2s_model [%.3f]s, vits_model [%.3f]s ############" % (t1 - t0, t2 - t1, t4 - t3, t5 - t4))
+                        yield self.audio_postprocess([batch_audio_fragment], 
+                                                        self.configs.sampling_rate, 
+                                                        None, 
+                                                        speed_factor, 
+                                                        False,
+                                                        fragment_interval
+                                                        )
+                    else:
+                        audio.append(batch_audio_fragment)
 
-                if self.stop_flag:
+                if cancel_event.is_set():
                     yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate),
                                                             dtype=np.int16)
                     return
@@ -952,10 +1440,15 @@ class TTS:
             del self.vits_model
             self.t2s_model = None
             self.vits_model = None
-            self.init_t2s_weights(self.configs.t2s_weights_path)
+            self.model_registry.discard("t2s", self._t2s_registry_key(self.configs.t2s_weights_path,
+                                                                      self._use_t2s_int8(self.t2s_model_int8)))
+            self.model_registry.discard("vits", self.configs.vits_weights_path)
+            self.init_t2s_weights(self.configs.t2s_weights_path, self.t2s_model_int8)
             self.init_vits_weights(self.configs.vits_weights_path)
             raise e
         finally:
+            with self._lock:
+                self._cancel_events.discard(cancel_event)
             if data is not None:
                 del data
             self.empty_cache()
@@ -9,6 +9,7 @@ from gpt_sovits.GPT_SoVITS.module import modules
 from gpt_sovits.GPT_SoVITS.module import attentions
 from torch.nn import Conv1d, ConvTranspose1d, AvgPool1d, Conv2d
 from torch.nn.utils import weight_norm, remove_weight_norm, spectral_norm
+from torch.nn.utils.weight_norm import WeightNorm
 from gpt_sovits.GPT_SoVITS.module.commons import init_weights, get_padding
 from gpt_sovits.GPT_SoVITS.module.mrte_model import MRTE
 from gpt_sovits.GPT_SoVITS.module.quantize import ResidualVectorQuantizer
@@ -444,21 +445,27 @@ class Generator(torch.nn.Module):
 
         if gin_channels != 0:
             self.cond = nn.Conv1d(gin_channels, upsample_initial_channel, 1)
+        self.upsample_rates = upsample_rates
 
-    def forward(self, x, g=None):
+    def forward(self, x, g=None, x_mask=None):
+        # x_mask: (bsz, 1, T), 可选. batch中各条长度不同时, 每个卷积之前都把padding部分置零,
+        # 有效部分的结果和单条decode(卷积两端补零)时一致, 不受padding和其他条的影响
         x = self.conv_pre(x)
         if g is not None:
             x = x + self.cond(g)
 
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules.LRELU_SLOPE)
+            if x_mask is not None:
+                x = x * x_mask
+                x_mask = torch.repeat_interleave(x_mask, self.upsample_rates[i], dim=2)
             x = self.ups[i](x)
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, x_mask)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, x_mask)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.conv_post(x)
@@ -466,6 +473,25 @@ class Generator(torch.nn.Module):
 
         return x
 
+    def receptive_field(self)->int:
+        '''
+        How many input frames on each side of a frame can change its output samples (rounded up),
+            the windows of a chunked decode need at least this much context to match the whole decode.
+        '''
+        field = (self.conv_pre.kernel_size[0] - 1) // 2 * self.conv_pre.dilation[0]
+        rate = 1
+        for i in range(self.num_upsamples):
+            up = self.ups[i]
+            field += math.ceil(up.kernel_size[0] / up.stride[0]) / rate
+            rate *= up.stride[0]
+            # 同一层的几个resblock并联, 取最大的; 每个resblock内的卷积串联, 相加
+            side = max(sum((conv.kernel_size[0] - 1) // 2 * conv.dilation[0]
+                           for conv in block.modules() if isinstance(conv, nn.Conv1d))
+                       for block in self.resblocks[i * self.num_kernels:(i + 1) * self.num_kernels])
+            field += side / rate
+        field += (self.conv_post.kernel_size[0] - 1) // 2 / rate
+        return math.ceil(field)
+
     def remove_weight_norm(self):
         print("Removing weight norm...")
         for l in self.ups:
@@ -891,6 +917,9 @@ class SynthesizerTrn(nn.Module):
 
         self.quantizer = ResidualVectorQuantizer(dimension=ssl_dim, n_q=1, bins=1024)
         self.freeze_quantizer = freeze_quantizer
+        # 推理时是否使用trace并freeze的Generator, 见 set_frozen_decoder
+        self.frozen_decoder = False
+        self._frozen_dec = None
         # if freeze_quantizer:
         #     self.ssl_proj.requires_grad_(False)
         #     self.quantizer.requires_grad_(False)
@@ -965,15 +994,64 @@ class SynthesizerTrn(nn.Module):
         return o, y_mask, (z, z_p, m_p, logs_p)
 
     @torch.no_grad()
-    def decode(self, codes, text, refer, noise_scale=0.5):
-        ge = None
-        if refer is not None:
-            refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
-            refer_mask = torch.unsqueeze(
-                commons.sequence_mask(refer_lengths, refer.size(2)), 1
-            ).to(refer.dtype)
-            ge = self.ref_enc(refer * refer_mask, refer_mask)
-
+    def extract_ge(self, refer):
+        # 参考音频的风格embedding, 同一条参考音频每次decode都一样, 可以算一次后传给decode
+        refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
+        refer_mask = torch.unsqueeze(
+            commons.sequence_mask(refer_lengths, refer.size(2)), 1
+        ).to(refer.dtype)
+        return self.ref_enc(refer * refer_mask, refer_mask)
+
+    def prepare_for_inference(self):
+        '''
+        Fold the weight norm of every conv (dec, flow, enc_p and its MRTE, ref_enc) into plain weights
+            and drop the modules only used for training, call it after loading the weights.
+        '''
+        # 训练时的posterior encoder, 推理不需要
+        if hasattr(self, "enc_q"):
+            del self.enc_q
+        for module in self.modules():
+            for hook in list(module._forward_pre_hooks.values()):
+                if isinstance(hook, WeightNorm):
+                    remove_weight_norm(module, hook.name)
+        self.requires_grad_(False)
+        self._frozen_dec = None
+        return self
+
+    def set_frozen_decoder(self, enable:bool=True):
+        '''
+        Run the Generator as a traced and frozen TorchScript graph (torch.jit.freeze + optimize_for_inference),
+            traced at the first decode for the current dtype/device. Call `prepare_for_inference` first.
+            The traced graphs stay with the model (e.g. while it is cached in the ModelRegistry),
+            calling it again with the same flag keeps them.
+        '''
+        if enable != self.frozen_decoder:
+            self._frozen_dec = None
+        self.frozen_decoder = enable
+
+    def _apply(self, fn, *args, **kwargs):
+        module = super()._apply(fn, *args, **kwargs)
+        # .to()/.half()/.float() 之后, 只保留与当前权重dtype/device相同的trace, 其余的(例如offload前在GPU上的)释放掉
+        if self._frozen_dec:
+            weight = next(self.dec.parameters())
+            self._frozen_dec = {k: v for k, v in self._frozen_dec.items() if k[:2] == (weight.dtype, weight.device)} or None
+        return module
+
+    def _run_dec(self, z, g=None, x_mask=None):
+        if not self.frozen_decoder or g is None:
+            return self.dec(z, g=g, x_mask=x_mask)
+        inputs = (z, g) if x_mask is None else (z, g, x_mask)
+        key = (z.dtype, z.device, g.shape[0], len(inputs))
+        if self._frozen_dec is None or key not in self._frozen_dec:
+            dec = torch.jit.trace(self.dec, inputs, check_trace=False)
+            frozen_dec = {} if self._frozen_dec is None else self._frozen_dec
+            # 同一个dtype/device下, 带mask和不带mask的各trace一次
+            self._frozen_dec = {k: v for k, v in frozen_dec.items() if k[:3] == key[:3]}
+            self._frozen_dec[key] = torch.jit.optimize_for_inference(torch.jit.freeze(dec.eval()))
+        return self._frozen_dec[key](*inputs)
+
+    def _decode_latent(self, codes, text, ge, noise_scale=0.5, noise=None):
+        # noise: 可选, (1, inter_channels, 帧数) 的标准正态噪声, 不传时重新采样
         y_lengths = torch.LongTensor([codes.size(2) * 2]).to(codes.device)
         text_lengths = torch.LongTensor([text.size(-1)]).to(text.device)
 
@@ -986,23 +1064,125 @@ class SynthesizerTrn(nn.Module):
         x, m_p, logs_p, y_mask = self.enc_p(
             quantized, y_lengths, text, text_lengths, ge
         )
-        z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * noise_scale
+        eps = torch.randn_like(m_p) if noise is None else noise[:, :, :m_p.shape[-1]].to(m_p)
+        z_p = m_p + eps * torch.exp(logs_p) * noise_scale
 
         z = self.flow(z_p, y_mask, g=ge, reverse=True)
+        return (z * y_mask)[:, :, :]
 
-        o = self.dec((z * y_mask)[:, :, :], g=ge)
+    @torch.no_grad()
+    def decode(self, codes, text, refer, noise_scale=0.5, ge=None, noise=None):
+        if ge is None and refer is not None:
+            ge = self.extract_ge(refer)
+
+        z = self._decode_latent(codes, text, ge, noise_scale, noise)
+        o = self._run_dec(z, g=ge)
         return o
-    
-    
+
+    @torch.no_grad()
+    def decode_streaming(self, codes, text, refer, noise_scale=0.5, ge=None, chunk_size=25, context=None, crossfade=1, noise=None):
+        '''
+        Same as `decode` for one segment, but the Generator runs on overlapping windows of the latent
+            and the audio is yielded chunk by chunk, so the first chunk is ready after one window
+            and the memory of the Generator doesn't grow with the segment length.
+            The latent of the whole segment (text encoder and flow, at the frame rate) is computed first.
+
+        Args:
+            chunk_size: int, semantic tokens per chunk.
+            context: int, latent frames decoded on both sides of a chunk and dropped,
+                None for `Generator.receptive_field`, with which the chunks are the same as `decode` up to float error.
+            crossfade: int, latent frames at the boundary of two chunks decoded by both and linearly cross-faded,
+                hides the seams when context is smaller than the receptive field.
+            noise: optional, see `decode_streaming_tokens`.
+        Yields:
+            torch.Tensor, (samples,), the audio of the chunks in order.
+        '''
+        yield from self.decode_streaming_tokens([(codes, True)], text, refer, noise_scale, ge,
+                                                chunk_size, context=context, crossfade=crossfade, noise=noise)
+
     @torch.no_grad()
-    def batched_decode(self, codes, y_lengths, text, text_lengths, refer, noise_scale=0.5):
-        ge = None
-        if refer is not None:
-            refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
-            refer_mask = torch.unsqueeze(
-                commons.sequence_mask(refer_lengths, refer.size(2)), 1
-            ).to(refer.dtype)
-            ge = self.ref_enc(refer * refer_mask, refer_mask)
+    def decode_streaming_tokens(self, code_stream, text, refer, noise_scale=0.5, ge=None, chunk_size=25, lookahead=4,
+                                context=None, crossfade=1, latent_window=0, noise=None):
+        '''
+        `decode_streaming` while the semantic tokens are still being generated:
+            `code_stream` yields (codes, finished), codes (1, 1, T) are all the tokens of the segment so far.
+            Every time there are `chunk_size` new tokens besides the last `lookahead` ones,
+            the latent is recomputed for the tokens so far and the next chunk is decoded.
+            The text encoder attends to the whole sequence, so the latent of a chunk decoded early
+            differs a little from the one of the whole segment, the lookahead tokens and the crossfade keep the seams smooth.
+            The noise of the latent is drawn once per frame and reused by every recomputation.
+
+            Recomputing the latent of the whole prefix for every chunk costs O(T^2) in the segment length
+            (about 0.2 s per chunk at 150 tokens and 8.5 s at 1500 tokens on one CPU thread),
+            `latent_window` bounds it to the last tokens before the chunk.
+
+        Args:
+            lookahead: int, the last semantic tokens only used as right context, decoded with a later chunk.
+            latent_window: int, semantic tokens before a chunk (besides its context frames) kept when recomputing the latent,
+                0 to always recompute the whole prefix.
+            noise: optional, (1, inter_channels, frames) standard normal noise of the latent, e.g. to reproduce a `decode` with the same noise,
+                new noise is drawn for the frames beyond it.
+            chunk_size, context, crossfade: see `decode_streaming`.
+        Yields:
+            torch.Tensor, (samples,), the audio of the chunks in order.
+        '''
+        if ge is None and refer is not None:
+            ge = self.extract_ge(refer)
+
+        rate = 2 if self.semantic_frame_rate == "25hz" else 1
+        chunk_frames = max(int(chunk_size) * rate, 1)
+        lookahead_frames = max(int(lookahead), 0) * rate
+        context = self.dec.receptive_field() if context is None else max(int(context), 0)
+        crossfade = max(int(crossfade), 0)
+        latent_window = max(int(latent_window), 0)
+        hop = int(math.prod(self.upsample_rates))
+        param = next(self.dec.parameters())
+
+        # 已返回的latent帧数; 上一块多decode的crossfade部分, 和下一块的开头混合
+        emitted = 0
+        tail:torch.Tensor = None
+        for codes, finished in code_stream:
+            if not finished and codes.size(2) * rate - lookahead_frames - emitted < chunk_frames:
+                continue
+            if codes.size(2) == 0:
+                break
+            # 每一帧的噪声只采样一次, 重新计算latent时已有的帧沿用之前的噪声
+            num_frames = codes.size(2) * rate
+            if noise is None or noise.shape[-1] < num_frames:
+                extra = torch.randn(1, self.inter_channels, num_frames - (0 if noise is None else noise.shape[-1]),
+                                    dtype=param.dtype, device=param.device)
+                noise = extra if noise is None else torch.cat([noise.to(extra), extra], dim=-1)
+            # 只重新计算chunk之前latent_window个token之后的部分, z的第0帧是第offset帧
+            offset = 0
+            if latent_window > 0:
+                offset = max((emitted - context) // rate - latent_window, 0) * rate
+            z = self._decode_latent(codes[:, :, offset // rate:], text, ge, noise_scale, noise[:, :, offset:])
+            num_frames = offset + z.shape[-1]
+            ready = num_frames if finished else num_frames - lookahead_frames
+            while emitted < ready and (finished or ready - emitted >= chunk_frames):
+                start = emitted
+                end = min(start + chunk_frames, num_frames)
+                out_end = min(end + crossfade, num_frames)
+                lo, hi = max(start - context, offset), min(out_end + context, num_frames)
+                o = self._run_dec(z[:, :, lo - offset:hi - offset], g=ge)[0, 0, (start - lo) * hop:(out_end - lo) * hop]
+                if tail is not None:
+                    n = tail.shape[0]
+                    w = torch.linspace(0, 1, n + 2, dtype=o.dtype, device=o.device)[1:-1]
+                    o[:n] = tail * (1 - w) + o[:n] * w
+                emitted = end
+                if finished and end == num_frames:
+                    yield o
+                    tail = None
+                else:
+                    yield o[:(end - start) * hop]
+                    tail = o[(end - start) * hop:]
+            if finished:
+                break
+
+    @torch.no_grad()
+    def batched_decode(self, codes, y_lengths, text, text_lengths, refer, noise_scale=0.5, ge=None):
+        if ge is None and refer is not None:
+            ge = self.extract_ge(refer)
 
         # y_mask = torch.unsqueeze(commons.sequence_mask(y_lengths, codes.size(2)), 1).to(
         #     codes.dtype
@@ -1026,19 +1206,12 @@ class SynthesizerTrn(nn.Module):
 
         z = self.flow(z_p, y_mask, g=ge, reverse=True)
         z_masked = (z * y_mask)[:, :, :]
-        
-        # 串行。把padding部分去掉再decode
-        o_list:List[torch.Tensor] = []
-        for i in range(z_masked.shape[0]):
-            z_slice = z_masked[i, :, :y_lengths[i]].unsqueeze(0)
-            o = self.dec(z_slice, g=ge)[0, 0, :].detach()
-            o_list.append(o)
-        
-        # 并行（会有问题）。先decode，再把padding的部分去掉
-        # o = self.dec(z_masked, g=ge)
-        # upsample_rate = int(math.prod(self.upsample_rates))
-        # o_lengths = y_lengths*upsample_rate
-        # o_list = [o[i, 0, :idx].detach() for i, idx in enumerate(o_lengths)]
+
+        # 并行。Generator按长度mask, padding部分不会影响有效部分, 再把padding的部分去掉
+        o = self._run_dec(z_masked, g=ge, x_mask=y_mask)
+        upsample_rate = int(math.prod(self.upsample_rates))
+        o_lengths = (y_lengths * upsample_rate).tolist()
+        o_list:List[torch.Tensor] = [o[i, 0, :length].detach() for i, length in enumerate(o_lengths)]
 
         return o_list
 
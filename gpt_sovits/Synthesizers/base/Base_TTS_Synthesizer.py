@@ -10,6 +10,7 @@ from typing import Dict, List, Union, Generator, Tuple
 from typing_extensions import Literal
 import numpy as np
 import wave,io
+import threading
 
 class Base_TTS_Synthesizer(ABC):
     """
@@ -42,6 +43,7 @@ class Base_TTS_Synthesizer(ABC):
         task: TTS_Task,
         return_type: Literal["filepath", "numpy"] = "numpy",
         save_path: Optional[str] = None,
+        cancel_event: Optional[threading.Event] = None,
     ) -> Union[str, Generator[Tuple[int, np.ndarray], None, None], Any]:
         """
         Generates speech from a given TTS task.
@@ -50,6 +52,7 @@ class Base_TTS_Synthesizer(ABC):
             task (TTS_Task): The task containing data and parameters for speech synthesis.
             return_type (Literal["filepath", "numpy"], optional): The type of return value, either a file path or audio data.
             save_path (str, optional): The path to save the audio file.
+            cancel_event (threading.Event, optional): Once set, the synthesis of this task stops as soon as possible.
         Returns:
             Union[str, Generator[Tuple[int, np.ndarray], None, None], Any]: Depending on the return_type, returns a file path, a generator of audio data, or other types.
 
@@ -92,6 +95,15 @@ class Base_TTS_Synthesizer(ABC):
         """
         pass
 
+    def after_fork(self):
+        """
+        Called in every worker process of the pre-fork server, right after it is forked.
+
+        Threads of the parent process don't exist in the worker, subclasses running
+        background threads should restart them here.
+        """
+        pass
+
 
 def get_wave_header_chunk(sample_rate: int, channels: int = 1, sample_width: int = 2):
     """
@@ -2,7 +2,7 @@ import io, wave
 import os, json, sys
 import pkg_resources
 import threading
-from typing import Any, Union, Generator, Literal, List, Dict, Tuple
+from typing import Any, Union, Generator, Literal, List, Dict, Optional, Tuple
 from gpt_sovits.Synthesizers.base import Base_TTS_Synthesizer, load_config
 import re
 from .gsv_task import GSV_TTS_Task as TTS_Task
@@ -41,10 +41,35 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
     save_prompt_cache:bool = True
     prompt_cache_dir:str = "cache/prompt_cache"
     default_character:str = None
+    continuous_batching:bool = False
+    max_batch_size:int = 20
+    batch_wait_ms:float = 10
+    packed_prefill:bool = False
+    speculative_draft_layers:int = 0
+    speculative_draft_tokens:int = 4
+    t2s_int8:bool = False
+    compiled_decode:bool = False
+    decode_bucket_size:int = 256
+    decode_warmup_tokens:int = 1024
+    vits_frozen_decoder:bool = False
+    vits_batched_decode:bool = False
+    vits_max_batch_tokens:int = 1000
+    vits_stream_chunk_size:int = 0
+    vits_stream_crossfade:int = 1
+    token_streaming:bool = False
+    vits_stream_lookahead:int = 4
+    vits_stream_latent_window:int = 150
+    semantic_len_cap_ratio:float = 0
+    semantic_len_cap_margin:int = 50
+    model_cache_size_mb:float = 0
+    model_offload_size_mb:float = 0
+    prompt_cache_size:int = 16
 
     ui_config:dict = None
     tts_pipline:TTS = None
     character:str = None
+    # 角色 -> 模型路径, 请求带上自己角色的模型, 见 generate_from_text
+    character_models:Dict[str, Dict[str, Any]] = None
 
     def __init__(self, config_path:str=None, **kwargs):
         super().__init__()
@@ -67,6 +92,23 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
         tts_config.cnhubert_base_path = self.cnhubert_base_path
         tts_config.bert_base_path = self.bert_base_path
         self.tts_pipline = TTS(tts_config)
+        self.tts_pipline.set_packed_prefill(self.packed_prefill)
+        self.tts_pipline.set_speculative_decoding(self.speculative_draft_layers, self.speculative_draft_tokens)
+        # 按 get_wav_from_text_api 的默认 top_k 预热
+        self.tts_pipline.set_compiled_decode(self.compiled_decode, self.decode_bucket_size, self.decode_warmup_tokens,
+                                             warmup_top_k=12)
+        self.tts_pipline.set_vits_frozen_decoder(self.vits_frozen_decoder)
+        self.tts_pipline.set_vits_batched_decode(self.vits_batched_decode, self.vits_max_batch_tokens)
+        self.tts_pipline.set_vits_streaming(self.vits_stream_chunk_size, self.vits_stream_crossfade,
+                                            self.token_streaming, self.vits_stream_lookahead,
+                                            self.vits_stream_latent_window)
+        self.tts_pipline.set_length_estimation(self.semantic_len_cap_ratio, self.semantic_len_cap_margin)
+        if self.continuous_batching:
+            self.tts_pipline.enable_batch_scheduler(self.max_batch_size, self.batch_wait_ms)
+        self.tts_pipline.set_model_cache_size(self.model_cache_size_mb, self.model_offload_size_mb)
+        self.tts_pipline.set_prompt_cache_size(self.prompt_cache_size)
+        self._character_lock = threading.RLock()
+        self.character_models = {}
 
         module_dir = os.path.dirname(os.path.abspath(__file__))
         configs_dir = os.path.join(module_dir, "configs")
@@ -95,15 +137,30 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
             wav_buf.seek(0)
             return wav_buf.read()
         chunks = self.tts_pipline.run(params)
+        cancel_event = params.get("cancel_event", None)
         yield wave_header_chunk()
         # chunk is tuple[int, np.ndarray], 代表了sample_rate和音频数据
         for chunk in chunks:
+            if cancel_event is not None and cancel_event.is_set():
+                chunks.close()
+                return
             sample_rate, audio_data = chunk
             if audio_data is not None:
                 return_data = audio_data.tobytes()
                 del audio_data
                 yield return_data
 
+    def after_fork(self):
+        # 调度线程不会被fork, 在子进程中重新启动
+        if self.tts_pipline.scheduler is not None:
+            self.tts_pipline.enable_batch_scheduler(self.max_batch_size, self.batch_wait_ms)
+
+    def get_model_stats(self) -> dict:
+        stats = self.tts_pipline.model_registry.get_stats()
+        stats["character"] = self.character
+        stats["prompt_cache"] = dict(self.tts_pipline.prompt_caches.stats, entries=len(self.tts_pipline.prompt_caches))
+        return stats
+
     def get_characters(self) -> dict:
         characters_and_emotions = {}
         # self.models_path = os.environ.get('models_path', 'trained')
@@ -142,6 +199,10 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
         return self.load_character(character)
 
     def load_character(self, character):
+        with self._character_lock:
+            return self._load_character(character)
+
+    def _load_character(self, character):
         if character in ["", None]:
             if self.character not in ["", None]:
                 return
@@ -176,19 +237,28 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
                 raise Exception("找不到模型文件！请把有效模型放置在模型文件夹下，确保其中至少有pth、ckpt和wav三种文件。")
         
         self.character = character
+        # 角色的infer_config.json中可以单独设置是否在CPU上使用int8量化的T2S模型
+        t2s_int8 = bool(config.get("t2s_int8", self.t2s_int8))
+        # length_key: 语义长度估计按角色统计
+        self.character_models[character] = {"t2s_weights_path": gpt_path, "vits_weights_path": sovits_path,
+                                            "t2s_int8": t2s_int8, "length_key": character}
 
         t0 = tt()
-        self.tts_pipline.init_t2s_weights(gpt_path)
+        self.tts_pipline.init_t2s_weights(gpt_path, t2s_int8)
         self.tts_pipline.init_vits_weights(sovits_path)
         t1 = tt()
         print(f"加载角色成功: {character}, 耗时: {t1-t0:.2f}s")
 
-    def generate_from_text(self, task: TTS_Task):
-        self.load_character(task.character)
-        task.character = self.character
-        # 加载环境配置
-        if task.ref_audio_path is None or not os.path.exists(task.ref_audio_path):
-            task.ref_audio_path, task.prompt_text, task.prompt_language = self.get_ref_infos(self.character, task.emotion)
+    def generate_from_text(self, task: TTS_Task, cancel_event: Optional[threading.Event] = None):
+        # 角色, 模型路径和参考音频在同一个锁内确定, 之后即使其他请求切换了角色,
+        # TTS.run 也会按这里记录的模型路径推理
+        with self._character_lock:
+            self.load_character(task.character)
+            task.character = self.character
+            model_paths = dict(self.character_models.get(self.character, {}))
+            # 加载环境配置
+            if task.ref_audio_path is None or not os.path.exists(task.ref_audio_path):
+                task.ref_audio_path, task.prompt_text, task.prompt_language = self.get_ref_infos(self.character, task.emotion)
 
         return self.get_wav_from_text_api(
             text=task.text,
@@ -206,7 +276,9 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
             seed=task.seed,
             parallel_infer=task.parallel_infer,
             repetition_penalty=task.repetition_penalty,
-            stream=task.stream
+            stream=task.stream,
+            cancel_event=cancel_event,
+            **model_paths,
         )
 
     def generate_from_ssml(self, task: TTS_Task):
@@ -218,12 +290,13 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
         task: TTS_Task,
         return_type: Literal["filepath", "numpy"] = "numpy",
         save_path: str = None,
+        cancel_event: Optional[threading.Event] = None,
     ) -> Union[str, Generator[Tuple[int, np.ndarray], None, None], Any]:
         if self.debug_mode:
             print(f"task: {task}")
         gen = None
         if task.task_type == "text":
-            gen = self.generate_from_text(task)
+            gen = self.generate_from_text(task, cancel_event)
         elif task.task_type == "ssml":
             gen = self.generate_from_ssml(task)
 
@@ -231,7 +304,7 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
             return gen
         elif return_type == "filepath":
             if save_path is None:
-                save_path = f"tmp_audio/{datetime.now().strftime('%Y%m%d%H%M%S')}.{task.format}"
+                save_path = f"tmp_audio/{datetime.now().strftime('%Y%m%d%H%M%S%f')}.{task.format}"
             sr, audio_data = next(gen)
             os.makedirs(os.path.dirname(save_path), exist_ok=True)
             sf.write(save_path, audio_data, sr)
@@ -258,7 +331,7 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
         for emotion_name, details in emotion_dict.items():
             if emotion_name == emotion:
                 relative_path = details['ref_wav_path']
-                ref_audio_path = os.path.join(os.path.join(self.models_path,self.character), relative_path)
+                ref_audio_path = os.path.join(character_path, relative_path)
                 prompt_text = details['prompt_text']
                 prompt_language = details['prompt_language']
                 
@@ -283,6 +356,11 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
         stream=False,
         parallel_infer=True,
         repetition_penalty=1.35,
+        cancel_event=None,
+        t2s_weights_path=None,
+        vits_weights_path=None,
+        t2s_int8=None,
+        length_key=None,
         **kwargs
     ):
 
@@ -328,7 +406,12 @@ class GSV_Synthesizer(Base_TTS_Synthesizer):
             "return_fragment":stream,
             "seed": seed,
             "parallel_infer": parallel_infer,
-            "repetition_penalty": repetition_penalty
+            "repetition_penalty": repetition_penalty,
+            "cancel_event": cancel_event,
+            "t2s_weights_path": t2s_weights_path,
+            "vits_weights_path": vits_weights_path,
+            "t2s_int8": t2s_int8,
+            "length_key": length_key,
         }
         # 调用原始的get_tts_wav函数
         # 注意：这里假设get_tts_wav函数及其所需的其它依赖已经定义并可用
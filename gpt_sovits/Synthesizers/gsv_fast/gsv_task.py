@@ -62,4 +62,11 @@ class GSV_TTS_Task(Base_TTS_Task):
             m.update(str(self.temperature).encode())
             m.update(str(self.cut_method).encode())
             m.update(str(self.emotion).encode())
+            m.update(str(self.ref_audio_path).encode())
+            m.update(str(self.prompt_text).encode())
+            m.update(str(self.prompt_language).encode())
+            m.update(str(self.seed).encode())
+            m.update(str(self.repetition_penalty).encode())
+        # 不同格式的音频文件不能互相替代
+        m.update(str(self.format).encode())
         return m.hexdigest()
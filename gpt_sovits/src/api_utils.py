@@ -35,4 +35,239 @@ def get_gradio_frp(server_name, server_port, share_token) -> str:
     share_url = urlunparse(
         (share_server_protocol,) + parsed_url[1:]
     )
-    return share_url
\ No newline at end of file
+    return share_url
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time as ttime
+
+class TTS_Worker_Pool:
+    """
+    推理专用的有界线程池, 让合成任务不阻塞事件循环
+
+    Args:
+        max_workers: 同时进行合成的线程数
+        max_queue_size: 排队等待的最大任务数, 超过后拒绝新的任务
+        queue_timeout: 任务排队超过该秒数后不再执行, 抛出 TimeoutError, -1 表示不限制
+    """
+    def __init__(self, max_workers:int=1, max_queue_size:int=8, queue_timeout:float=-1):
+        self.max_workers = max(int(max_workers), 1)
+        self.max_queue_size = max(int(max_queue_size), 0)
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tts_worker")
+        self._lock = threading.Lock()
+        self._pending = 0  # 已接收但未完成的任务数(运行中 + 排队中)
+        self._avg_time = 5.0  # 单个任务耗时的滑动平均, 用于估计 Retry-After
+
+    @property
+    def running(self)->int:
+        return min(self._pending, self.max_workers)
+
+    @property
+    def queue_depth(self)->int:
+        return max(self._pending - self.max_workers, 0)
+
+    def try_acquire(self)->bool:
+        """占用一个名额, 队列已满时返回 False"""
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue_size:
+                return False
+            self._pending += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._pending = max(self._pending - 1, 0)
+
+    def _record(self, elapsed:float):
+        with self._lock:
+            self._avg_time = 0.8 * self._avg_time + 0.2 * elapsed
+
+    def retry_after(self)->int:
+        """估计排在队尾的任务需要等待的秒数"""
+        return max(int((self.queue_depth + 1) * self._avg_time / self.max_workers) + 1, 1)
+
+    def _check_timeout(self, submit_time:float):
+        if self.queue_timeout >= 0 and ttime() - submit_time > self.queue_timeout:
+            raise TimeoutError(f"Task waited in queue for more than {self.queue_timeout}s")
+
+    def _call(self, submit_time:float, cancel_event:threading.Event, func, *args):
+        self._check_timeout(submit_time)
+        if cancel_event is not None and cancel_event.is_set():
+            # 排队期间请求已被取消, 不再执行
+            return None
+        t0 = ttime()
+        try:
+            return func(*args)
+        finally:
+            self._record(ttime() - t0)
+
+    async def run(self, func, *args, cancel_event:threading.Event=None):
+        """
+        在线程池中执行 func, 调用前需先 try_acquire
+
+        cancel_event 在任务开始前被设置时不再执行 func, 直接返回 None
+        """
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, ttime(), cancel_event, func, *args)
+        finally:
+            self.release()
+
+    async def iterate(self, func, *args, cancel_event:threading.Event=None):
+        """
+        在线程池中调用 func 得到同步生成器并逐块迭代, 调用前需先 try_acquire
+
+        第一块在返回前就已生成, 因此排队超时与合成错误都能在发送响应头之前抛出
+        迭代结束或中断(如客户端断开)时会设置 cancel_event, 通知工作线程中的合成尽快停止
+        """
+        t0 = ttime()
+        loop = asyncio.get_running_loop()
+        sentinel = object()
+        gen = None
+        pending = None  # 工作线程中正在执行的 start/next
+
+        def start():
+            nonlocal gen
+            gen = func(*args)
+            return next(gen, sentinel)
+
+        def submit(fn, *fn_args):
+            nonlocal pending
+            pending = self._executor.submit(fn, *fn_args)
+            return asyncio.wrap_future(pending, loop=loop)
+
+        def finish():
+            try:
+                if gen is not None:
+                    gen.close()
+            finally:
+                self.release()
+
+        def close():
+            if cancel_event is not None:
+                cancel_event.set()
+            if not pending.done():
+                # 客户端断开时生成器可能仍在工作线程中执行 next(),
+                # 回调在它返回后于同一工作线程中执行, 再关闭生成器并释放名额
+                pending.add_done_callback(lambda _: finish())
+                return
+            try:
+                self._executor.submit(finish)
+            except RuntimeError:
+                # 线程池已关闭
+                finish()
+
+        try:
+            first = await submit(self._call, t0, cancel_event, start)
+            if first is None:
+                first = sentinel
+        except BaseException:
+            close()
+            raise
+
+        async def stream():
+            try:
+                chunk = first
+                while chunk is not sentinel:
+                    yield chunk
+                    chunk = await submit(next, gen, sentinel)
+            finally:
+                close()
+        return stream()
+
+    def status(self)->dict:
+        return {
+            "running": self.running,
+            "queue_depth": self.queue_depth,
+            "max_workers": self.max_workers,
+            "max_queue_size": self.max_queue_size,
+        }
+
+
+async def watch_disconnect(request, cancel_event:threading.Event, interval:float=0.2):
+    """
+    客户端断开连接时设置 cancel_event, 需作为后台任务运行, 请求处理完后取消
+    """
+    while not cancel_event.is_set():
+        if await request.is_disconnected():
+            cancel_event.set()
+            return
+        await asyncio.sleep(interval)
+
+
+import os
+import gc
+import signal
+
+def serve_prefork(app, host:str, port:int, workers:int, init_worker=None, **uvicorn_kwargs):
+    """
+    预先fork多个工作进程, 共享同一个监听端口
+
+    父进程中已加载的模型权重在fork后以写时复制的方式被所有子进程共享, 不会占用N倍内存.
+    子进程意外退出时会被重新拉起.
+
+    Args:
+        app: ASGI 应用
+        workers: 工作进程数
+        init_worker: 子进程启动后调用的函数, 参数为 worker_id
+    """
+    import uvicorn
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    # 把现有对象移出gc的追踪范围, 避免子进程gc时改写引用计数所在的页面, 破坏写时复制
+    gc.collect()
+    gc.freeze()
+
+    def spawn(worker_id:int)->int:
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            if init_worker is not None:
+                init_worker(worker_id)
+            config = uvicorn.Config(app, **uvicorn_kwargs)
+            uvicorn.Server(config).run(sockets=[sock])
+        except BaseException as e:
+            print(f"Worker {worker_id} exited with error: {e}")
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    children = {spawn(i): i for i in range(workers)}
+    print(f"INFO:     Started {workers} workers on {host}:{port}")
+
+    stopping = False
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_id = children.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+        print(f"Worker {worker_id} (pid {pid}) exited with status {status}, restarting")
+        children[spawn(worker_id)] = worker_id
+    sock.close()
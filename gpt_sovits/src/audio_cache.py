@@ -0,0 +1,133 @@
+import os
+import shutil
+import sqlite3
+import threading
+from time import time as ttime
+from typing import Optional
+
+
+class Audio_Cache:
+    """
+    持久化的合成音频缓存, 以任务的 md5 为键, 用 sqlite 记录索引, 重启后依然有效
+
+    超过容量上限时按最近最少使用(LRU)的顺序淘汰, 最近 evict_grace 秒内被访问过的条目不淘汰,
+    避免删除其他请求(可能在其他进程中)刚拿到、还在发送的文件, 此时缓存可能暂时超出上限.
+    多个进程可以共用同一个缓存目录, sqlite 负责进程间的加锁, 命中统计也记录在数据库中.
+
+    Args:
+        cache_dir: 缓存目录, 音频文件与索引数据库都存放在这里
+        max_size_mb: 缓存文件总大小上限(MB), -1 表示不限制
+        max_entries: 缓存条目数上限, -1 表示不限制
+        evict_grace: 最近访问过的条目的保护时间(秒)
+    """
+    def __init__(self, cache_dir:str="cache/audio_cache", max_size_mb:float=1024, max_entries:int=-1, evict_grace:float=60):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 1024 * 1024) if max_size_mb >= 0 else -1
+        self.max_entries = max_entries
+        self.evict_grace = evict_grace
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn:sqlite3.Connection = None
+        self._pid:int = None
+        with self._lock:
+            self._get_conn().execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON entries (last_access)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _get_conn(self)->sqlite3.Connection:
+        # sqlite 连接不能跨进程使用, fork 之后重新打开
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(os.path.join(self.cache_dir, "index.db"),
+                                         timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _count(conn:sqlite3.Connection, name:str, n:int=1):
+        conn.execute("INSERT INTO counters (name, value) VALUES (?, ?) "
+                     "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, n))
+
+    def get(self, key:str)->Optional[str]:
+        """返回缓存的音频路径, 未命中时返回 None"""
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and not os.path.exists(row[0]):
+                # 文件被外部删除, 索引一并清理
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._count(conn, "misses")
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (ttime(), key))
+            self._count(conn, "hits")
+            return row[0]
+
+    def put(self, key:str, src_path:str)->str:
+        """
+        将 src_path 处的音频移入缓存, 返回缓存中的路径
+        """
+        ext = os.path.splitext(src_path)[1]
+        path = os.path.join(self.cache_dir, f"{key}{ext}")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.move(src_path, tmp_path)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        now = ttime()
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("INSERT OR REPLACE INTO entries (key, path, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                         (key, path, size, now, now))
+            self._evict(conn, keep=key)
+        return path
+
+    def _evict(self, conn:sqlite3.Connection, keep:str):
+        if self.max_size < 0 and self.max_entries < 0:
+            return
+        total_size, count = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM entries").fetchone()
+        if (self.max_size < 0 or total_size <= self.max_size) and (self.max_entries < 0 or count <= self.max_entries):
+            return
+        evictions = 0
+        recent = ttime() - self.evict_grace
+        for key, path, size, last_access in conn.execute(
+                "SELECT key, path, size, last_access FROM entries ORDER BY last_access ASC").fetchall():
+            if (self.max_size < 0 or total_size <= self.max_size) and (self.max_entries < 0 or count <= self.max_entries):
+                break
+            if last_access > recent:
+                # 按访问时间排序, 之后的条目都是最近访问过的
+                break
+            if key == keep:
+                continue
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            count -= 1
+            evictions += 1
+        if evictions > 0:
+            self._count(conn, "evictions", evictions)
+
+    def stats(self)->dict:
+        """所有共用该缓存目录的进程的统计"""
+        with self._lock:
+            conn = self._get_conn()
+            total_size, count = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM entries").fetchone()
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        requests = hits + misses
+        return {
+            "entries": count,
+            "size_mb": round(total_size / 1024 / 1024, 2),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / requests, 4) if requests > 0 else 0.0,
+            "evictions": counters.get("evictions", 0),
+        }
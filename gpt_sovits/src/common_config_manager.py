@@ -13,6 +13,13 @@ class Api_Config(BaseModel):
     tts_port: int = 5000
     tts_host: str = "0.0.0.0" 
     synthesizer: str = "gsv_fast"
+    tts_workers: int = 1
+    max_queue_size: int = 8
+    queue_timeout: float = -1
+    workers: int = 1
+    cache_dir: str = "cache/audio_cache"
+    cache_max_size_mb: float = 1024
+    cache_max_entries: int = -1
 
 
     def __init__(self, config_path=None):
@@ -24,7 +31,7 @@ class Api_Config(BaseModel):
         assert os.path.exists(self.config_path), f"配置文件不存在: {self.config_path}"
         with open(self.config_path, 'r', encoding='utf-8') as f:
             all_config = load_config(self.config_path)
-        config = all_config.get("common", {})
+        config = all_config.get("pure_api_config", all_config.get("common", {}))
         for key, value in config.items():
             setattr(self, key, value)
         
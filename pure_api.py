@@ -9,14 +9,18 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from gpt_sovits.src.common_config_manager import __version__, api_config
 import soundfile as sf
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import tempfile
 import uvicorn  
 import json
+import asyncio
+import threading
 
 # 将当前文件所在的目录添加到 sys.path
 from gpt_sovits.Synthesizers.base import Base_TTS_Task, Base_TTS_Synthesizer
+from gpt_sovits.src.api_utils import TTS_Worker_Pool, watch_disconnect
+from gpt_sovits.src.audio_cache import Audio_Cache
 
 # 创建合成器实例
 tts_synthesizer:Base_TTS_Synthesizer = None
@@ -25,13 +29,49 @@ def set_tts_synthesizer(synthesizer:Base_TTS_Synthesizer):
     global tts_synthesizer
     tts_synthesizer = synthesizer
 
-# 存储临时文件的字典
-temp_files = {}
+# 合成结果的磁盘缓存, 第一次使用时创建
+audio_cache:Audio_Cache = None
+
+def get_audio_cache()->Audio_Cache:
+    global audio_cache
+    if audio_cache is None:
+        audio_cache = Audio_Cache(api_config.cache_dir, api_config.cache_max_size_mb, api_config.cache_max_entries)
+    return audio_cache
+
+# 推理线程池, 第一次请求时创建
+worker_pool:TTS_Worker_Pool = None
+
+def get_worker_pool()->TTS_Worker_Pool:
+    global worker_pool
+    if worker_pool is None:
+        worker_pool = TTS_Worker_Pool(api_config.tts_workers, api_config.max_queue_size, api_config.queue_timeout)
+    return worker_pool
+
+def busy_response(status_code:int, detail:str)->JSONResponse:
+    pool = get_worker_pool()
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": detail, **pool.status()},
+        headers={"Retry-After": str(pool.retry_after()), "X-Queue-Depth": str(pool.queue_depth)},
+    )
 
 async def character_list(request: Request):
     res = JSONResponse(tts_synthesizer.get_characters())
     return res
 
+async def queue_status(request: Request):
+    return JSONResponse(get_worker_pool().status())
+
+async def cache_status(request: Request):
+    # sqlite 查询是同步的, 放到默认线程池中执行, 不阻塞事件循环
+    stats = await asyncio.get_running_loop().run_in_executor(None, get_audio_cache().stats)
+    return JSONResponse(stats)
+
+async def model_status(request: Request):
+    if not hasattr(tts_synthesizer, "get_model_stats"):
+        return JSONResponse({})
+    return JSONResponse(tts_synthesizer.get_model_stats())
+
 async def tts(request: Request):
     
     from time import time as tt
@@ -52,25 +92,60 @@ async def tts(request: Request):
         return HTTPException(status_code=400, detail="SSML is empty")
     md5_value = task.md5
     if task.stream == False:
-        # TODO: use SQL instead of dict
-        if task.save_temp and md5_value in temp_files:
-            return FileResponse(path=temp_files[md5_value], media_type=f'audio/{task.format}')
+        loop = asyncio.get_running_loop()
+        # 缓存的 sqlite 读写是同步的, 放到默认线程池中执行, 不阻塞事件循环, 也不占用推理线程池的名额
+        cached_path = await loop.run_in_executor(None, get_audio_cache().get, md5_value) if task.save_temp else None
+        if cached_path is not None:
+            return FileResponse(path=cached_path, media_type=f'audio/{task.format}')
         else:
-            # 假设 gen 是你的音频生成器
+            if tts_synthesizer is None:
+                return busy_response(503, "TTS synthesizer is not ready")
+            pool = get_worker_pool()
+            if not pool.try_acquire():
+                return busy_response(429, "Too many requests in queue")
+            # 在推理线程池中合成, 不阻塞事件循环; 客户端断开后取消合成, 释放名额
+            cancel_event = threading.Event()
+            watcher = asyncio.ensure_future(watch_disconnect(request, cancel_event))
             try:
-                save_path = tts_synthesizer.generate(task, return_type="filepath")
+                save_path = await pool.run(tts_synthesizer.generate, task, "filepath", None, cancel_event,
+                                           cancel_event=cancel_event)
+            except TimeoutError as e:
+                return busy_response(503, str(e))
             except Exception as e:
                 return HTTPException(status_code=500, detail=str(e))
+            finally:
+                watcher.cancel()
+            if cancel_event.is_set():
+                # 合成被中途取消, 结果不完整, 不写入缓存
+                if save_path is not None and os.path.exists(save_path):
+                    os.remove(save_path)
+                return Response(status_code=499)
             if task.save_temp:
-                temp_files[md5_value] = save_path
+                save_path = await loop.run_in_executor(None, get_audio_cache().put, md5_value, save_path)
 
             t2 = tt()
             print(f"total time: {t2-t1}")
             # 返回文件响应，FileResponse 会负责将文件发送给客户端
             return FileResponse(save_path, media_type=f"audio/{task.format}", filename=os.path.basename(save_path))
     else:
-        gen = tts_synthesizer.generate(task, return_type="numpy")
-        return StreamingResponse(gen,  media_type='audio/wav')
+        if tts_synthesizer is None:
+            return busy_response(503, "TTS synthesizer is not ready")
+        pool = get_worker_pool()
+        if not pool.try_acquire():
+            return busy_response(429, "Too many requests in queue")
+        # 响应开始后, 客户端断开会中断流式迭代, 由 iterate 负责设置 cancel_event
+        cancel_event = threading.Event()
+        watcher = asyncio.ensure_future(watch_disconnect(request, cancel_event))
+        try:
+            stream = await pool.iterate(tts_synthesizer.generate, task, "numpy", None, cancel_event,
+                                        cancel_event=cancel_event)
+        except TimeoutError as e:
+            return busy_response(503, str(e))
+        except Exception as e:
+            return HTTPException(status_code=500, detail=str(e))
+        finally:
+            watcher.cancel()
+        return StreamingResponse(stream,  media_type='audio/wav')
 
 
 
@@ -78,17 +153,37 @@ async def tts(request: Request):
 if __name__ == "__main__":
     # 动态导入合成器模块, 此处可写成 from gpt_sovits.Synthesizers.xxx import TTS_Synthesizer, TTS_Task
     from importlib import import_module
-    from gpt_sovits.src.api_utils import get_localhost_ipv4_address
+    from gpt_sovits.src.api_utils import get_localhost_ipv4_address, serve_prefork
     synthesizer_name = api_config.synthesizer
     synthesizer_module = import_module(f"gpt_sovits.Synthesizers.{synthesizer_name}")
     TTS_Synthesizer = synthesizer_module.TTS_Synthesizer
     TTS_Task = synthesizer_module.TTS_Task
     # 初始化合成器的类
     tts_synthesizer = TTS_Synthesizer(debug_mode=True)
-    
-    # 生成一句话充当测试，减少第一次请求的等待时间
-    gen = tts_synthesizer.generate(tts_synthesizer.params_parser({"text":"你好，世界"}) )
-    next(gen)
+
+    def warm_up():
+        # 生成一句话充当测试，减少第一次请求的等待时间
+        gen = tts_synthesizer.generate(tts_synthesizer.params_parser({"text":"你好，世界"}) )
+        next(gen)
+
+    workers = api_config.workers
+    if workers > 1 and not hasattr(os, "fork"):
+        print("Multi-process mode needs os.fork, which is not available on this platform, using 1 worker")
+        workers = 1
+    if workers > 1 and str(getattr(tts_synthesizer, "device", "cpu")).startswith("cuda"):
+        # CUDA 上下文不能在fork后继续使用
+        print("Multi-process mode only supports CPU inference, using 1 worker")
+        workers = 1
+
+    def init_worker(worker_id:int):
+        import torch
+        # 各进程平分CPU核心, 避免线程数过多互相抢占
+        torch.set_num_threads(max((os.cpu_count() or 1) // workers, 1))
+        tts_synthesizer.after_fork()
+        warm_up()
+
+    if workers == 1:
+        warm_up()
     
     # 打印一些辅助信息
     print(f"Backend Version: {__version__}")
@@ -110,5 +205,12 @@ if __name__ == "__main__":
     )
     app.add_api_route('/tts', tts, methods=["GET", "POST"])
     app.add_api_route('/character_list', character_list, methods=["GET"])
-    uvicorn.run(app, host=tts_host, port=tts_port)
+    app.add_api_route('/queue_status', queue_status, methods=["GET"])
+    app.add_api_route('/cache_status', cache_status, methods=["GET"])
+    app.add_api_route('/model_status', model_status, methods=["GET"])
+    if workers > 1:
+        # 模型已在父进程中加载, 子进程通过写时复制共享权重
+        serve_prefork(app, tts_host, tts_port, workers, init_worker=init_worker)
+    else:
+        uvicorn.run(app, host=tts_host, port=tts_port)
 
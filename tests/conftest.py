@@ -0,0 +1,32 @@
+# Small randomly initialized models for the decode tests, see benchmarks/common.py.
+#   python -m pytest -q tests
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+import torch
+
+from benchmarks.common import build_t2s_model, build_vits_model
+
+
+@pytest.fixture(scope="session")
+def t2s_model():
+    return build_t2s_model(4)
+
+
+@pytest.fixture(scope="session")
+def vits():
+    return build_vits_model()
+
+
+@pytest.fixture(scope="session")
+def t2s_inputs():
+    '''
+    (text tokens, bert features, prompt) of 3 segments of different lengths sharing one prompt.
+    '''
+    g = torch.Generator().manual_seed(1)
+    lens = [8, 20, 13]
+    x = [torch.randint(0, 512, (n,), generator=g) for n in lens]
+    bert = [torch.randn(1024, n, generator=g) for n in lens]
+    prompt = torch.randint(0, 1024, (30,), generator=g)
+    return x, bert, prompt
@@ -0,0 +1,100 @@
+# Greedy decoding (top_k=1) of the T2S model is deterministic, every decode path must generate the same tokens.
+import pytest
+import torch
+import torch.nn.functional as F
+
+from gpt_sovits.GPT_SoVITS.AR.models.t2s_engine import T2SDecodeEngine
+
+MAX_TOKENS = 40
+
+
+def pad(sequences):
+    length = max(item.shape[-1] for item in sequences)
+    return torch.stack([F.pad(item, (0, length - item.shape[-1])) for item in sequences])
+
+
+def sequential(model, x, bert, prompt, **kwargs):
+    '''
+    Returns the rows of y (the prompt followed by the semantic tokens) of the segments decoded one by one.
+    '''
+    x_lens = torch.LongTensor([item.shape[0] for item in x])
+    y_list, _ = model.infer_panel_0307(x, x_lens, prompt.expand(len(x), -1), bert,
+                                       top_k=1, early_stop_num=MAX_TOKENS, **kwargs)
+    return y_list
+
+
+def batched(model, x, bert, prompt, padded=True, **kwargs):
+    '''
+    Same as `sequential` for the segments decoded as one batch,
+        passed as padded tensors or as lists of tensors of different lengths (as in TTS.run).
+    '''
+    x_lens = torch.LongTensor([item.shape[0] for item in x])
+    if padded:
+        x, bert = pad(x), pad(bert)
+    y_list, _ = model.infer_panel_batch_infer_with_flash_attn(x, x_lens, prompt.expand(len(x), -1),
+                                                              bert, top_k=1, early_stop_num=MAX_TOKENS, **kwargs)
+    return y_list
+
+
+def assert_tokens_equal(expected, actual):
+    assert len(expected) == len(actual)
+    for a, b in zip(expected, actual):
+        assert torch.equal(a, b)
+
+
+@torch.no_grad()
+def test_packed_prefill_matches_padded_and_sequential(t2s_model, t2s_inputs):
+    x, bert, prompt = t2s_inputs
+    reference = sequential(t2s_model, x, bert, prompt)
+    assert_tokens_equal(reference, batched(t2s_model, x, bert, prompt))
+    assert_tokens_equal(reference, batched(t2s_model, x, bert, prompt, packed_prefill=True))
+    assert_tokens_equal(reference, batched(t2s_model, x, bert, prompt, padded=False, packed_prefill=True))
+
+
+@torch.no_grad()
+def test_speculative_greedy_matches_normal(t2s_model, t2s_inputs):
+    x, bert, prompt = t2s_inputs
+    reference = sequential(t2s_model, x, bert, prompt)
+    for draft_layers, num_draft_tokens in ((1, 2), (2, 4)):
+        actual = sequential(t2s_model, x, bert, prompt, draft_layers=draft_layers, num_draft_tokens=num_draft_tokens)
+        assert_tokens_equal(reference, actual)
+
+
+@pytest.mark.parametrize("sync_every", [1, 8])
+@torch.no_grad()
+def test_engine_matches_sequential(t2s_model, t2s_inputs, sync_every):
+    x, bert, prompt = t2s_inputs
+    reference = sequential(t2s_model, x, bert, prompt)
+    engine = T2SDecodeEngine(t2s_model, top_k=1, sync_every=sync_every)
+    results = {}
+
+    def add(i):
+        seq_ids, finished = engine.add([x[i]], torch.LongTensor([x[i].shape[0]]), [prompt], [bert[i]],
+                                       early_stop_num=MAX_TOKENS)
+        results.update({seq_id: tokens for seq_id, tokens, idx in finished})
+        return seq_ids[0]
+
+    # 序列在decode中途加入, 与已有的行左pad对齐
+    seq_ids = [add(0)]
+    for step in range(2 * MAX_TOKENS):
+        if step in (5, 13):
+            seq_ids.append(add(len(seq_ids)))
+        results.update({seq_id: tokens for seq_id, tokens, idx in engine.step()})
+    assert engine.num_active == 0
+    assert_tokens_equal(reference, [results[seq_id] for seq_id in seq_ids])
+
+
+@torch.no_grad()
+def test_stream_prefixes_never_change(t2s_model, t2s_inputs):
+    x, bert, prompt = t2s_inputs
+    prefixes = []
+    for y, idx, finished in t2s_model.infer_panel_stream(x[1].unsqueeze(0), torch.LongTensor([x[1].shape[0]]),
+                                                         prompt.unsqueeze(0), bert[1].unsqueeze(0),
+                                                         top_k=1, early_stop_num=MAX_TOKENS, sync_every=4):
+        prefixes.append(y[0].clone())
+    assert finished
+    assert len(prefixes) > 2
+    final = prefixes[-1]
+    for prefix in prefixes:
+        assert torch.equal(prefix, final[:prefix.shape[0]])
+    assert_tokens_equal(sequential(t2s_model, x[1:2], bert[1:2], prompt), [final])
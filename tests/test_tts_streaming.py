@@ -0,0 +1,50 @@
+# `TTS._token_streaming_decode` with the prompt as TTS.run passes it: the 1-D prompt_semantic of the reference audio.
+import math
+import threading
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+try:
+    from gpt_sovits.GPT_SoVITS.TTS_infer_pack.TTS import TTS
+except (ImportError, LookupError) as e:
+    # 前端依赖(nltk数据等)缺失时无法导入TTS.py
+    pytest.skip(f"TTS.py can't be imported: {e!r}", allow_module_level=True)
+
+MAX_TOKENS = 30
+
+
+@torch.no_grad()
+def test_token_streaming_decode_with_reference_prompt(t2s_model, vits, t2s_inputs):
+    vits_model, hps = vits
+    x, bert, prompt = t2s_inputs
+    x, bert = x[:2], bert[:2]
+    # 只用到下面这些配置, 不加载权重
+    tts = TTS.__new__(TTS)
+    tts.configs = SimpleNamespace(device="cpu", sampling_rate=hps["data"]["sampling_rate"])
+    tts.precision = torch.float32
+    tts.vits_stream_chunk_size = 10
+    tts.vits_stream_lookahead = 4
+    tts.vits_stream_latent_window = 150
+    tts.vits_stream_crossfade = 1
+
+    g = torch.Generator().manual_seed(2)
+    item = {
+        "all_phones": x,
+        "all_phones_len": torch.LongTensor([item.shape[0] for item in x]),
+        "all_bert_features": bert,
+        "phones": [torch.randint(1, 300, (item.shape[0],), generator=g) for item in x],
+    }
+    refer = torch.rand(1, hps["data"]["filter_length"] // 2 + 1, 250, generator=g)
+    idx_list = []
+    chunks = list(tts._token_streaming_decode(t2s_model, vits_model, item, prompt, [MAX_TOKENS]*len(x), idx_list,
+                                              refer, vits_model.extract_ge(refer), 1.0, 0, threading.Event(), top_k=1))
+
+    expected = [t2s_model.infer_panel_with_flash_attn_only(x_item.unsqueeze(0), item["all_phones_len"][i], prompt.unsqueeze(0),
+                                                           bert_item.unsqueeze(0), top_k=1, early_stop_num=MAX_TOKENS)[1]
+                for i, (x_item, bert_item) in enumerate(zip(x, bert))]
+    assert idx_list == expected
+    assert len(chunks) > len(x)
+    upsample_rate = 2 * math.prod(vits_model.upsample_rates)
+    assert sum(audio.shape[0] for sr, audio in chunks) == sum(idx_list) * upsample_rate
@@ -0,0 +1,92 @@
+# The batched and chunked VITS decodes must reproduce the plain `SynthesizerTrn.decode` of every segment.
+import torch
+import torch.nn.functional as F
+
+
+def reference_inputs(hps, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    refer = torch.rand(1, hps["data"]["filter_length"] // 2 + 1, 250, generator=g)
+    return g, refer
+
+
+def pad(sequences):
+    length = max(item.shape[-1] for item in sequences)
+    return torch.stack([F.pad(item, (0, length - item.shape[-1])) for item in sequences])
+
+
+@torch.no_grad()
+def test_batched_decode_matches_per_item(vits):
+    model, hps = vits
+    g, refer = reference_inputs(hps)
+    ge = model.extract_ge(refer)
+    lens = [20, 35, 12]
+    codes = [torch.randint(0, 1024, (n,), generator=g) for n in lens]
+    phones = [torch.randint(1, 300, (max(n // 2, 1),), generator=g) for n in lens]
+    audios = model.batched_decode(pad(codes).unsqueeze(0), torch.LongTensor(lens),
+                                  pad(phones), torch.LongTensor([p.shape[0] for p in phones]),
+                                  refer, noise_scale=0, ge=ge)
+    assert len(audios) == len(lens)
+    for c, p, audio in zip(codes, phones, audios):
+        expected = model.decode(c.view(1, 1, -1), p.unsqueeze(0), refer, noise_scale=0, ge=ge)[0, 0]
+        assert audio.shape == expected.shape
+        torch.testing.assert_close(audio, expected, rtol=0, atol=1e-4)
+
+
+@torch.no_grad()
+def test_chunked_decode_matches_whole(vits):
+    model, hps = vits
+    g, refer = reference_inputs(hps)
+    ge = model.extract_ge(refer)
+    codes = torch.randint(0, 1024, (1, 1, 80), generator=g)
+    text = torch.randint(1, 300, (1, 40), generator=g)
+    noise = torch.randn(1, model.inter_channels, codes.shape[-1] * 2, generator=g)
+    expected = model.decode(codes, text, refer, noise_scale=0.5, ge=ge, noise=noise)[0, 0]
+    # 默认context为Generator的感受野, 分块结果与整段decode只差浮点误差
+    chunks = list(model.decode_streaming(codes, text, refer, noise_scale=0.5, ge=ge, chunk_size=25, noise=noise))
+    assert len(chunks) > 1
+    torch.testing.assert_close(torch.cat(chunks), expected, rtol=0, atol=1e-4)
+
+
+@torch.no_grad()
+def test_token_streaming_decode_matches_whole(vits):
+    model, hps = vits
+    g, refer = reference_inputs(hps)
+    ge = model.extract_ge(refer)
+    codes = torch.randint(0, 1024, (1, 1, 80), generator=g)
+    text = torch.randint(1, 300, (1, 40), generator=g)
+    noise = torch.randn(1, model.inter_channels, codes.shape[-1] * 2, generator=g)
+    expected = model.decode(codes, text, refer, noise_scale=0.5, ge=ge, noise=noise)[0, 0]
+
+    def code_stream():
+        for end in range(10, codes.shape[-1] + 1, 10):
+            yield codes[..., :end], end == codes.shape[-1]
+
+    chunks = list(model.decode_streaming_tokens(code_stream(), text, refer, noise_scale=0.5, ge=ge,
+                                                chunk_size=25, lookahead=4, noise=noise))
+    assert len(chunks) > 1
+    audio = torch.cat(chunks)
+    assert audio.shape == expected.shape
+    # 提前decode的块只看到部分文本, latent与整段略有差异
+    torch.testing.assert_close(audio, expected, rtol=0, atol=1e-3)
+
+
+@torch.no_grad()
+def test_frozen_decoder_is_kept_with_the_model(vits):
+    model, hps = vits
+    g, refer = reference_inputs(hps)
+    ge = model.extract_ge(refer)
+    codes = torch.randint(0, 1024, (1, 1, 20), generator=g)
+    text = torch.randint(1, 300, (1, 10), generator=g)
+    expected = model.decode(codes, text, refer, noise_scale=0, ge=ge)
+    try:
+        model.set_frozen_decoder(True)
+        torch.testing.assert_close(model.decode(codes, text, refer, noise_scale=0, ge=ge), expected, rtol=0, atol=1e-4)
+        traced = dict(model._frozen_dec)
+        # 切换角色时TTS对registry中的模型重新调用 .float() 和 set_frozen_decoder, trace不应被丢弃
+        model.float().set_frozen_decoder(True)
+        assert model._frozen_dec == traced
+        # 转换dtype后旧的trace失效
+        model.double()
+        assert model._frozen_dec is None
+    finally:
+        model.float().set_frozen_decoder(False)